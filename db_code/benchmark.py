@@ -0,0 +1,216 @@
+import argparse
+import functools
+import logging
+import multiprocessing
+import os.path
+import pickle
+import resource
+import time
+from datetime import datetime
+import pandas as pd
+import utils
+import dimensions
+import schema
+import synthetic
+import init_xmode_db as xdb
+from config import engine, integer_device_keys, encode_ping_strings
+from metrics import current_rss_mb
+
+#---
+# Ingestion benchmark
+#
+# Generates a synthetic dataset, then runs each loader against the
+# configured database from a clean pings table and reports rows/sec, peak RSS
+# and the time spent in each loading stage. Every loader runs in its own
+# forked process; its peak RSS is reported as growth over its size at the
+# fork, so the parent's pages are not counted. Stage times are taken by wrapping the
+# stage functions of init_xmode_db in that process; loaders that parse in
+# pool workers only report their total time, and streaming loaders render
+# while COPY reads, so their copy time includes rendering. The pooled loader
+# copies on its writer's threads, outside copy_ping_payload. The orm and csv
+# baselines load the pending files one at a time and write raw advertiser ids
+# and strings, so they need integer_device_keys and encode_ping_strings off.
+#
+# The run truncates pings, so point config.py at a scratch database:
+#   python benchmark.py --work_dir /tmp/xmode_bench --rows 200000 --reset
+
+def _each_file(load, fm, n):
+    # the row-at-a-time loaders take a single file and its index
+    pending = fm.files_to_process[fm.files_to_process['status'] == 0].head(n)
+    for index, path in zip(pending['index'], pending['path']):
+        load([path], int(index))
+
+loaders = {
+    'orm': lambda fm, n, args: _each_file(xdb.init_ping_table_temp, fm, n),
+    'csv': lambda fm, n, args: _each_file(xdb.init_ping_table2, fm, n),
+    'copy': lambda fm, n, args: xdb.init_ping_table3(fm, n),
+    'copy_binary': lambda fm, n, args: xdb.init_ping_table3(fm, n, binary=True),
+    'copy_stream': lambda fm, n, args: xdb.init_ping_table3(fm, n, args.chunksize),
+    'pipeline': lambda fm, n, args: xdb.init_ping_table_pipelined(fm, n, args.chunksize),
+    'parallel': lambda fm, n, args: xdb.init_ping_table_parallel(fm, n, args.num_workers),
+    'manifest': lambda fm, n, args: xdb.init_ping_table_manifest(fm, n, args.num_workers, args.chunksize),
+    'pooled': lambda fm, n, args: xdb.init_ping_table_pooled(fm, n, args.num_workers, args.chunksize)
+}
+
+# stage -> function in init_xmode_db whose time is attributed to it
+stages = {
+    'read': 'read_ping_file',
+    'clean': 'clean_ping_frame',
+    'render': 'render_ping_frame',
+    'copy': 'copy_ping_payload'
+}
+
+def _timed(fn, totals, stage):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        t1 = time.perf_counter()
+        try:
+            out = fn(*args, **kwargs)
+        finally:
+            totals[stage] = totals[stage] + time.perf_counter() - t1
+        if hasattr(out, '__next__'):
+            # chunked reads do their work as they are iterated
+            return(_timed_iter(out, totals, stage))
+        return(out)
+    return(wrapper)
+
+def _timed_iter(it, totals, stage):
+    while True:
+        t1 = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            totals[stage] = totals[stage] + time.perf_counter() - t1
+        yield item
+
+def setup_database(work_dir):
+    # dimension tables of the synthetic masterlists
+    with open(os.path.join(work_dir, 'xmode_venue_masterlist.pickle'), 'rb') as f:
+        venues_tab = pickle.load(f)
+    with open(os.path.join(work_dir, 'xmode_tx_device_masterlist.pickle'), 'rb') as f:
+        device_tab = pickle.load(f)
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    dimensions.load_venue_dimensions(cur, venues_tab)
+    dimensions.load_device_dimensions(cur, device_tab)
+    raw_conn.commit()
+    raw_conn.close()
+
+def count_pings():
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    cur.execute("SELECT count(*) FROM pings")
+    n = cur.fetchone()[0]
+    raw_conn.close()
+    return(n)
+
+def reset(work_dir, files):
+    # empty pings and a fresh file list with every file pending
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    cur.execute("TRUNCATE pings, ingest_manifest, rid_allocator")
+    raw_conn.commit()
+    raw_conn.close()
+    pd.DataFrame({
+        'index': range(0, len(files)),
+        'path': [f[0] for f in files],
+        'status': [0] * len(files),
+        'nrow': [0] * len(files),
+        'rows': [f[1] for f in files]
+    }).to_csv(os.path.join(work_dir, 'files_to_process.csv'), sep=",", header=True, index=False)
+    if os.path.exists(os.path.join(work_dir, 'error_files.csv')):
+        os.remove(os.path.join(work_dir, 'error_files.csv'))
+
+def _run_loader(name, work_dir, num_files, args, conn):
+    # runs in the forked child; the parent disposed its pool before forking
+    rss_at_fork = current_rss_mb()
+    totals = {s: 0.0 for s in stages}
+    for stage, fn in stages.items():
+        setattr(xdb, fn, _timed(getattr(xdb, fn), totals, stage))
+    result = {'loader': name, 'error': None}
+    try:
+        fileManager = utils.FileManager(work_dir + '/')
+        t1 = time.perf_counter()
+        loaders[name](fileManager, num_files, args)
+        result['seconds'] = time.perf_counter() - t1
+    except Exception as e:
+        result['error'] = repr(e)
+        result['seconds'] = 0.0
+    result['rows'] = count_pings()
+    # ru_maxrss is in KiB on Linux; pool workers count as children and were
+    # forked from this process, so they start from its pages too
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    result['peak_rss_delta_mb'] = max(peak - rss_at_fork, 0.0)
+    result.update({'t_' + s: v for s, v in totals.items()})
+    conn.send(result)
+    conn.close()
+
+def run_loader(name, work_dir, files, args):
+    reset(work_dir, files)
+    # pooled connections must not be shared with the child
+    engine.dispose()
+    ctx = multiprocessing.get_context('fork')
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_run_loader, args=(name, work_dir, len(files), args, send))
+    proc.start()
+    send.close()
+    result = recv.recv()
+    proc.join()
+    result['rows_per_sec'] = result['rows'] / result['seconds'] if result['seconds'] else 0.0
+    return(result)
+
+def report(results):
+    tab = pd.DataFrame(results)
+    cols = ['loader', 'rows', 'seconds', 'rows_per_sec', 'peak_rss_delta_mb'] + ['t_' + s for s in stages] + ['error']
+    logging.info("\n" + tab[cols].to_string(index=False, float_format=lambda x: f"{x:0.2f}"))
+    return(tab[cols])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loglevel', type=str)
+    parser.add_argument('--work_dir', type=str, required=True)
+    parser.add_argument('--loaders', type=str, default=','.join(l for l in loaders if l != 'orm'),
+                        help=f"comma separated, from {', '.join(loaders)}")
+    parser.add_argument('--num_files', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=100000, help='rows per file')
+    parser.add_argument('--devices', type=int, default=5000)
+    parser.add_argument('--dirty_rate', type=float, default=0.001)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunksize', type=int, default=50000)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--results', type=str, help='CSV file results are appended to')
+    parser.add_argument('--reset', action='store_true', help='allow truncating a non-empty pings table')
+    args = parser.parse_args()
+    utils.initLogger(args)
+
+    names = args.loaders.split(',')
+    for name in names:
+        if name not in loaders:
+            utils.ERROR(f"Unknown loader {name}")
+        if name in ('orm', 'csv') and (integer_device_keys or encode_ping_strings):
+            utils.ERROR(f"The {name} loader writes raw advertiser ids and strings, set integer_device_keys and encode_ping_strings to False")
+
+    files = synthetic.generate_dataset(args.work_dir, args.num_files, args.rows, args.devices,
+                                       dirty_rate=args.dirty_rate, seed=args.seed)
+    schema.create_schema(engine)
+    if count_pings() > 0 and not args.reset:
+        utils.ERROR("pings is not empty, rerun with --reset against a scratch database")
+    setup_database(args.work_dir)
+
+    results = []
+    for name in names:
+        logging.info(f"Benchmarking {name}")
+        results.append(run_loader(name, args.work_dir, files, args))
+    tab = report(results)
+
+    if args.results:
+        tab.insert(0, 'run_at', datetime.now().isoformat(timespec='seconds'))
+        tab.insert(1, 'dataset', f"{args.num_files}x{args.rows} seed {args.seed}")
+        tab.to_csv(args.results, mode='a', header=not os.path.exists(args.results), index=False)
+
+
+if __name__ == "__main__":
+    main()
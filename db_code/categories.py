@@ -0,0 +1,150 @@
+import logging
+import time
+import numpy as np
+from config import engine
+
+#---
+# In-memory venue <-> category index
+#
+# venue_venue_category is loaded once into two CSR layouts (category ->
+# sorted venue ids, venue -> sorted category ids), so membership lookups are
+# array slices instead of many-to-many queries. A boolean mask over venue ids
+# is built per category on first use, which turns "pings in category X" into
+# one fancy-indexing step over a venue_id column.
+#
+# The index remembers a signature of the venue tables (max ids and the
+# association count) and reloads when it changes; get_category_index checks
+# it at most every check_interval seconds.
+
+check_interval = 60
+
+def _csr(keys, values, size):
+    # offsets and values grouped by key, values sorted within a key
+    order = np.lexsort((values, keys))
+    ptr = np.zeros(size + 1, dtype=np.int64)
+    np.add.at(ptr, keys + 1, 1)
+    return(np.cumsum(ptr), values[order])
+
+class CategoryIndex():
+    def __init__(self):
+        self.signature = None
+        self.category_ids = {}
+        self.venue_ids = {}
+        self.category_names = {}
+        self.venue_names = {}
+        self._masks = {}
+
+    def _signature(self, cur):
+        cur.execute("""
+            SELECT (SELECT coalesce(max(id), 0) FROM venue),
+                   (SELECT coalesce(max(id), 0) FROM venue_category),
+                   (SELECT count(*) FROM venue_venue_category)
+        """)
+        return(tuple(cur.fetchone()))
+
+    def load(self, cur):
+        t1 = time.perf_counter()
+        self.signature = self._signature(cur)
+        cur.execute("SELECT id, name FROM venue_category")
+        self.category_names = dict(cur.fetchall())
+        self.category_ids = {n: i for i, n in self.category_names.items()}
+        cur.execute("SELECT id, name FROM venue")
+        self.venue_names = dict(cur.fetchall())
+        self.venue_ids = {n: i for i, n in self.venue_names.items()}
+        cur.execute("SELECT venue_id, venue_category_id FROM venue_venue_category")
+        pairs = np.array(cur.fetchall(), dtype=np.int32).reshape(-1, 2)
+
+        self.n_venues = self.signature[0] + 1
+        self.n_categories = self.signature[1] + 1
+        self.cat_ptr, self.cat_venues = _csr(pairs[:, 1], pairs[:, 0], self.n_categories)
+        self.venue_ptr, self.venue_cats = _csr(pairs[:, 0], pairs[:, 1], self.n_venues)
+        self._masks = {}
+        t2 = time.perf_counter()
+        logging.debug(f"\tcategory index: {len(pairs)} venue categories loaded: {t2-t1:0.4f} seconds")
+        return(self)
+
+    def is_stale(self, cur):
+        return(self.signature != self._signature(cur))
+
+    def refresh(self, cur):
+        # reload if the venue tables changed; returns True if reloaded
+        if self.signature is not None and not self.is_stale(cur):
+            return(False)
+        self.load(cur)
+        return(True)
+
+    def _category_id(self, category):
+        return(self.category_ids[category] if isinstance(category, str) else int(category))
+
+    def _venue_id(self, venue):
+        return(self.venue_ids[venue] if isinstance(venue, str) else int(venue))
+
+    def venues_in(self, category):
+        # sorted venue ids of a category, given by name or id
+        c = self._category_id(category)
+        if c >= self.n_categories:
+            return(self.cat_venues[:0])
+        return(self.cat_venues[self.cat_ptr[c]:self.cat_ptr[c + 1]])
+
+    def categories_of(self, venue):
+        # sorted category ids of a venue, given by name or id
+        v = self._venue_id(venue)
+        if v >= self.n_venues:
+            return(self.venue_cats[:0])
+        return(self.venue_cats[self.venue_ptr[v]:self.venue_ptr[v + 1]])
+
+    def category_names_of(self, venue):
+        return([self.category_names[c] for c in self.categories_of(venue)])
+
+    def venue_mask(self, *categories):
+        # boolean array over venue ids, True for venues in any of the categories
+        key = tuple(sorted(self._category_id(c) for c in categories))
+        if key not in self._masks:
+            mask = np.zeros(self.n_venues, dtype=bool)
+            for c in key:
+                mask[self.venues_in(c)] = True
+            self._masks[key] = mask
+        return(self._masks[key])
+
+    def in_category(self, venue_id, *categories):
+        # vectorized membership test for a venue_id column; nulls (NaN/None)
+        # and unknown ids are False
+        mask = self.venue_mask(*categories)
+        v = np.asarray(venue_id, dtype=np.float64)
+        ok = ~np.isnan(v) & (v >= 0) & (v < len(mask))
+        out = np.zeros(len(v), dtype=bool)
+        out[ok] = mask[v[ok].astype(np.int64)]
+        return(out)
+
+    def pings_in_category(self, *categories):
+        # SQL predicate and parameters selecting pings in any of the categories
+        venues = np.flatnonzero(self.venue_mask(*categories))
+        return("venue_id = ANY(%s)", [venues.tolist()])
+
+_index = {'index': None, 'checked': 0.0}
+
+def get_category_index(cur=None):
+    # shared index for this process, reloaded when the venue tables change
+    now = time.monotonic()
+    index = _index['index']
+    if index is not None and now - _index['checked'] < check_interval:
+        return(index)
+    own_conn = cur is None
+    if own_conn:
+        conn = engine.raw_connection()
+        cur = conn.cursor()
+    try:
+        if index is None:
+            index = CategoryIndex().load(cur)
+        elif index.refresh(cur):
+            logging.info("\tvenue tables changed, category index reloaded")
+    finally:
+        if own_conn:
+            conn.close()
+    _index['index'] = index
+    _index['checked'] = now
+    return(index)
+
+def invalidate():
+    # forces the next get_category_index to check the venue tables
+    _index['checked'] = 0.0
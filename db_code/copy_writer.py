@@ -0,0 +1,146 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+import pgcopy
+from streams import CopyStream
+from config import engine, copy_buffer_size, copy_connections
+
+#---
+# Multi-connection COPY writer
+#
+# A single backend parsing COPY input caps a loader at one server core. A
+# CopyWriter holds num_connections pooled connections, each with a thread and
+# a bounded queue of batches, so that many backends parse COPY input at once
+# while the caller keeps rendering. Every batch is one COPY and one commit on
+# its connection. Batches with the same key (e.g. a partition) always go to
+# the same connection, unkeyed batches (e.g. rid ranges) go round robin.
+#
+# Results come back through completed() as (tag, rows, bytes, seconds, error)
+# in the order batches finish; error is None or the exception the batch failed
+# with, failing to connect included. A connection that cannot be rolled back
+# is replaced for the next batch, and batches for a connection whose thread
+# has died come back as errors instead of blocking submit() and close().
+# report() logs rows/sec per connection.
+
+class CopyWriter():
+    def __init__(self, table='pings', num_connections=copy_connections, binary=False, queue_size=2):
+        self.table = table
+        self.binary = binary
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(num_connections)]
+        self.results = queue.Queue()
+        self.stats = [{'batches': 0, 'rows': 0, 'bytes': 0, 'seconds': 0.0, 'errors': 0} for _ in range(num_connections)]
+        self._next = itertools.cycle(range(num_connections))
+        self._started = time.perf_counter()
+        self.threads = [threading.Thread(target=self._run, args=(i,), daemon=True) for i in range(num_connections)]
+        for t in self.threads:
+            t.start()
+
+    def _copy(self, cur, payload):
+        if self.binary:
+            stream = CopyStream([pgcopy.HEADER, payload, pgcopy.TRAILER], binary=True)
+            pgcopy.copy_binary(cur, self.table, stream, copy_buffer_size)
+        else:
+            cur.copy_from(CopyStream([payload]), self.table, sep='\t', null='Null', size=copy_buffer_size)
+
+    def _run(self, i):
+        raw_conn = None
+        stats = self.stats[i]
+        try:
+            while True:
+                item = self.queues[i].get()
+                if item is None:
+                    return
+                payload, rows, tag = item
+                t1 = time.perf_counter()
+                error = None
+                try:
+                    if raw_conn is None:
+                        raw_conn = engine.raw_connection()
+                    self._copy(raw_conn.cursor(), payload)
+                    raw_conn.commit()
+                except Exception as e:
+                    error = e
+                    raw_conn = self._rollback(raw_conn)
+                seconds = time.perf_counter() - t1
+                stats['batches'] = stats['batches'] + 1
+                stats['seconds'] = stats['seconds'] + seconds
+                if error is None:
+                    stats['rows'] = stats['rows'] + rows
+                    stats['bytes'] = stats['bytes'] + len(payload)
+                else:
+                    stats['errors'] = stats['errors'] + 1
+                self.results.put((tag, rows, len(payload), seconds, error))
+        finally:
+            if raw_conn is not None:
+                raw_conn.close()
+
+    def _rollback(self, raw_conn):
+        # the connection to use for the next batch, None to reconnect
+        if raw_conn is None:
+            return(None)
+        try:
+            raw_conn.rollback()
+            return(raw_conn)
+        except Exception:
+            raw_conn.invalidate()
+            return(None)
+
+    def _put(self, i, item):
+        # False once connection i's thread is gone
+        while self.threads[i].is_alive():
+            try:
+                self.queues[i].put(item, timeout=1.0)
+                return(True)
+            except queue.Full:
+                pass
+        return(False)
+
+    def _fail(self, item, error):
+        payload, rows, tag = item
+        self.results.put((tag, rows, len(payload), 0.0, error))
+
+    def submit(self, payload, rows, tag=None, key=None):
+        # blocks while the chosen connection has queue_size batches waiting
+        i = hash(key) % len(self.queues) if key is not None else next(self._next)
+        if not self._put(i, (payload, rows, tag)):
+            self._fail((payload, rows, tag), RuntimeError(f"copy connection {i} is not running"))
+
+    def completed(self, wait=False):
+        # results of the batches finished since the last call; with wait,
+        # blocks for at least one, so only with batches outstanding
+        out = []
+        if wait:
+            out.append(self.results.get())
+        while True:
+            try:
+                out.append(self.results.get_nowait())
+            except queue.Empty:
+                return(out)
+
+    def close(self):
+        # waits for every submitted batch and returns the remaining results
+        for i in range(len(self.queues)):
+            self._put(i, None)
+        for t in self.threads:
+            t.join()
+        # batches left behind by a thread that died
+        for i, q in enumerate(self.queues):
+            while True:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    self._fail(item, RuntimeError(f"copy connection {i} is not running"))
+        return(self.completed())
+
+    def report(self):
+        elapsed = time.perf_counter() - self._started
+        for i, s in enumerate(self.stats):
+            rate = s['rows'] / s['seconds'] if s['seconds'] else 0.0
+            logging.info(f"\tconnection {i}: {s['batches']} batches, {s['rows']} rows, {s['bytes'] / 2**20:0.1f} MB, "
+                         f"{s['seconds']:0.4f}s busy ({s['seconds'] / elapsed:0.0%}), {rate:0.0f} rows/sec, {s['errors']} errors")
+        rows = sum(s['rows'] for s in self.stats)
+        logging.info(f"\ttotal: {rows} rows in {elapsed:0.4f} seconds, {rows / elapsed if elapsed else 0.0:0.0f} rows/sec")
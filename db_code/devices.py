@@ -0,0 +1,97 @@
+import logging
+import zlib
+import numpy as np
+import pandas as pd
+from config import integer_device_keys
+
+#---
+# advertiser_id -> device key lookup used during ingestion
+#
+# Known devices are held in a pandas Index (hashed, vectorized lookups over
+# millions of ids) with a small dict for devices registered since the load.
+# Devices missing from the masterlist are inserted in bulk instead of failing
+# the pings foreign key, through the cursor the loader passes in; loaders
+# running side by side pass one of a short transaction of its own so the
+# registration lock is not held through their COPY. With
+# integer_device_keys the compact device.key is returned, otherwise the
+# advertiser_id itself.
+
+# advisory lock key taken while registering devices, so concurrent loaders
+# that find the same new devices wait on each other instead of deadlocking
+# on the device primary key
+DEVICE_LOCK = zlib.crc32(b'device')
+
+# device.key is only read when pings reference it
+_key_column = 'key' if integer_device_keys else '0'
+
+class DeviceCache():
+    def __init__(self):
+        self.index = pd.Index([], dtype=object)
+        self.keys = np.empty(0, dtype=np.int64)
+        self.extra = {}
+        self.pending = set()
+
+    def load(self, session):
+        rows = session.execute(f"SELECT id, {_key_column} FROM device").fetchall()
+        self.index = pd.Index([r[0] for r in rows], dtype=object)
+        self.keys = np.array([r[1] for r in rows], dtype=np.int64)
+        self.extra = {}
+        return(self)
+
+    def __len__(self):
+        return(len(self.index) + len(self.extra))
+
+    def _lookup(self, ids):
+        # keys for an array of distinct ids, -1 where unknown
+        pos = self.index.get_indexer(ids)
+        keys = np.full(len(ids), -1, dtype=np.int64)
+        hit = pos >= 0
+        keys[hit] = self.keys[pos[hit]]
+        if self.extra:
+            miss = np.flatnonzero(pos < 0)
+            keys[miss] = [self.extra.get(i, -1) for i in ids[miss]]
+        return(keys)
+
+    def map(self, advertiser_ids, cur=None):
+        codes, uniques = pd.factorize(advertiser_ids)
+        uniques = np.asarray(uniques, dtype=object)
+        keys = self._lookup(uniques)
+        unknown = uniques[keys < 0]
+        if len(unknown):
+            if cur is not None:
+                self.register(cur, list(unknown))
+                keys = self._lookup(uniques)
+            else:
+                logging.error(f"{len(unknown)} devices not found in database")
+
+        if not integer_device_keys:
+            return(advertiser_ids)
+        mapped = np.append(keys, -1).take(codes)
+        out = pd.Series(mapped.astype(object), index=advertiser_ids.index)
+        out[mapped < 0] = None
+        return(out)
+
+    def register(self, cur, ids):
+        # inserts run in cur's transaction, which should be short: the lock is
+        # held until it ends. Call commit() or rollback() on the cache alongside
+        # the connection
+        ids = sorted(ids)
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (DEVICE_LOCK,))
+        cur.execute(
+            "INSERT INTO device (id, platform) SELECT unnest(%s::text[]), 'unknown' ON CONFLICT (id) DO NOTHING",
+            (ids,)
+        )
+        n = cur.rowcount
+        cur.execute(f"SELECT id, {_key_column} FROM device WHERE id = ANY(%s)", (ids,))
+        for d, key in cur.fetchall():
+            self.extra[d] = key
+            self.pending.add(d)
+        logging.info(f"\tregistered {n} devices missing from the masterlist")
+
+    def commit(self):
+        self.pending = set()
+
+    def rollback(self):
+        for d in self.pending:
+            del self.extra[d]
+        self.pending = set()
@@ -0,0 +1,96 @@
+import logging
+import zlib
+import numpy as np
+import pandas as pd
+from sqlalchemy import SmallInteger
+from utils import Pings, ping_dictionaries
+
+#---
+# Dictionary encoding of low-cardinality ping columns
+#
+# With encode_ping_strings set, final_country, user_agent, publisher_id,
+# background, heading and wifi_bssid are stored in pings as integer codes into
+# one ping_<column> table each, and the pings_text view joins the text back.
+# Each loader keeps the value -> code maps in memory; a chunk is factorized
+# and only its distinct values are looked up. New values are registered in the
+# loader's transaction, like new venues.
+
+class CodeCache():
+    def __init__(self, column):
+        self.column = column
+        self.table = ping_dictionaries[column]
+        self.pg_type = 'int2' if isinstance(self.table.c.id.type, SmallInteger) else 'int4'
+        # advisory lock key so concurrent loaders never number a value twice
+        self.lock = zlib.crc32(self.table.name.encode())
+        self.codes = {}
+        self.pending = set()
+        self.missing = set()
+
+    def load(self, session):
+        self.codes = {}
+        for code, value in session.execute(self.table.select()):
+            self.codes[value] = code
+        return(self)
+
+    def __len__(self):
+        return(len(self.codes))
+
+    def map(self, values, cur=None):
+        # returns an object Series of codes, None where the value is missing
+        if values.dtype != object:
+            # numeric columns (heading) are keyed by their text rendering
+            values = values.astype(object).where(values.isna(), values.astype(str))
+        codes, uniques = pd.factorize(values)
+        unknown = [u for u in uniques if u not in self.codes]
+        if unknown:
+            if cur is not None:
+                self.register(cur, unknown)
+            else:
+                new = [u for u in unknown if u not in self.missing]
+                if new:
+                    logging.error(f"{len(new)} {self.column} values not found in {self.table.name}")
+                    self.missing.update(new)
+
+        ids = np.empty(len(uniques) + 1, dtype=object)
+        for i, u in enumerate(uniques):
+            ids[i] = self.codes.get(u)
+        ids[-1] = None
+        return(pd.Series(ids.take(codes), index=values.index, dtype=object))
+
+    def register(self, cur, values):
+        # inserts run in the caller's transaction; call commit() or rollback()
+        # on the cache alongside the connection
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (self.lock,))
+        cur.execute(f"SELECT id, value FROM {self.table.name} WHERE value = ANY(%s)", (list(values),))
+        for code, value in cur.fetchall():
+            self.codes[value] = code
+        new = [v for v in values if v not in self.codes]
+        if new:
+            cur.execute(f"INSERT INTO {self.table.name} (value) SELECT unnest(%s::text[]) RETURNING id, value", (new,))
+            for code, value in cur.fetchall():
+                self.codes[value] = code
+                self.pending.add(value)
+            logging.debug(f"\tregistered {len(new)} new {self.column} values")
+
+    def commit(self):
+        self.pending = set()
+
+    def rollback(self):
+        for value in self.pending:
+            del self.codes[value]
+        self.pending = set()
+
+def pings_text_view():
+    # pings with the encoded columns joined back to their text
+    cols = []
+    joins = []
+    for c in Pings.__table__.columns:
+        if c.name in ping_dictionaries:
+            t = ping_dictionaries[c.name].name
+            cols.append(f"{t}.value AS {c.name}")
+            joins.append(f"LEFT JOIN {t} ON {t}.id = p.{c.name}")
+        else:
+            cols.append(f"p.{c.name}")
+    cols = ',\n    '.join(cols)
+    joins = '\n'.join(joins)
+    return(f"CREATE OR REPLACE VIEW pings_text AS\nSELECT\n    {cols}\nFROM pings p\n{joins}")
@@ -0,0 +1,142 @@
+import logging
+import time
+from config import copy_buffer_size
+from streams import CopyStream
+
+#---
+# Bulk loaders for the venue and device dimension tables
+#
+# Surrogate keys are assigned in memory, continuing from the current max id,
+# and rows are written with COPY. Rows already present are left alone, so the
+# loaders can be re-run against a new masterlist to add just the new entries.
+
+_copy_escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def copy_value(v):
+    if v is None:
+        return('\\N')
+    return(str(v).translate(_copy_escapes))
+
+def copy_rows(cur, table, columns, rows, batch_size=10000):
+    # rows may be a generator; they are rendered in batches as COPY reads them
+    def blocks():
+        lines = []
+        for row in rows:
+            lines.append('\t'.join([copy_value(v) for v in row]))
+            if len(lines) == batch_size:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    cur.copy_from(CopyStream(blocks()), table, sep='\t', null='\\N', columns=columns, size=copy_buffer_size)
+
+def fetch_keys(cur, table, name_col):
+    cur.execute(f"SELECT {name_col}, id FROM {table}")
+    return(dict(cur.fetchall()))
+
+def assign_keys(keys, names, cur, table):
+    # adds ids for names not in keys, returns the new (id, name) rows
+    cur.execute(f"SELECT coalesce(max(id), 0) FROM {table}")
+    next_id = cur.fetchone()[0] + 1
+    rows = []
+    for name in names:
+        if name not in keys:
+            keys[name] = next_id
+            rows.append((next_id, name))
+            next_id = next_id + 1
+    return(rows)
+
+def sync_sequence(cur, table):
+    # keep serial defaults ahead of the ids assigned here
+    cur.execute(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), greatest(coalesce(max(id), 0), 1), max(id) IS NOT NULL) FROM {table}"
+    )
+
+def load_venue_dimensions(cur, venues_tab):
+    # venues_tab: venue name -> list of category names
+    t1 = time.perf_counter()
+    venue_keys = fetch_keys(cur, 'venue', 'name')
+    category_keys = fetch_keys(cur, 'venue_category', 'name')
+    cur.execute("SELECT venue_id, venue_category_id FROM venue_venue_category")
+    pairs = set(cur.fetchall())
+
+    categories = {}
+    for v in venues_tab:
+        for k in venues_tab[v]:
+            categories[k] = True
+    new_categories = assign_keys(category_keys, categories, cur, 'venue_category')
+    new_venues = assign_keys(venue_keys, venues_tab, cur, 'venue')
+
+    new_pairs = []
+    for v in venues_tab:
+        v_id = venue_keys[v]
+        for k in venues_tab[v]:
+            pair = (v_id, category_keys[k])
+            if pair not in pairs:
+                pairs.add(pair)
+                new_pairs.append(pair)
+
+    copy_rows(cur, 'venue_category', ('id', 'name'), new_categories)
+    copy_rows(cur, 'venue', ('id', 'name'), new_venues)
+    copy_rows(cur, 'venue_venue_category', ('venue_id', 'venue_category_id'), new_pairs)
+    sync_sequence(cur, 'venue_category')
+    sync_sequence(cur, 'venue')
+
+    t2 = time.perf_counter()
+    logging.info(f"\tvenue: {len(new_venues)} new\tvenue_category: {len(new_categories)} new\tvenue_venue_category: {len(new_pairs)} new")
+    logging.info(f"\tComplete: {t2-t1:0.4f} seconds\n")
+    return(venue_keys, category_keys)
+
+def load_device_dimensions(cur, device_tab):
+    # device_tab: advertiser_id -> [platform, carrier, model]
+    t1 = time.perf_counter()
+    carrier_keys = fetch_keys(cur, 'carrier', 'carrier_name')
+    model_keys = fetch_keys(cur, 'device_model', 'model_name')
+
+    carriers = {}
+    models = {}
+    for d in device_tab:
+        l = device_tab[d]
+        carriers[l[1]] = True
+        models[l[2]] = True
+    new_carriers = assign_keys(carrier_keys, carriers, cur, 'carrier')
+    new_models = assign_keys(model_keys, models, cur, 'device_model')
+    copy_rows(cur, 'carrier', ('id', 'carrier_name'), new_carriers)
+    copy_rows(cur, 'device_model', ('id', 'model_name'), new_models)
+    sync_sequence(cur, 'carrier')
+    sync_sequence(cur, 'device_model')
+
+    columns = ('id', 'model_id', 'carrier_name', 'platform')
+    cur.execute("SELECT EXISTS (SELECT 1 FROM device)")
+    if not cur.fetchone()[0]:
+        # fresh table: compact device keys are numbered in memory as well
+        rows = ((d, i, model_keys[l[2]], carrier_keys[l[1]], l[0]) for i, (d, l) in enumerate(device_tab.items(), 1))
+        copy_rows(cur, 'device', ('id', 'key') + columns[1:], rows)
+        cur.execute("SELECT setval('device_key_seq', %s)", (max(len(device_tab), 1),))
+        n_upsert = len(device_tab)
+    else:
+        # stage the masterlist and merge it: update devices whose attributes
+        # changed, insert new ones (which draw their key from device_key_seq)
+        rows = ((d, model_keys[l[2]], carrier_keys[l[1]], l[0]) for d, l in device_tab.items())
+        cur.execute("CREATE TEMP TABLE device_stage (id varchar PRIMARY KEY, model_id integer, carrier_name integer, platform varchar) ON COMMIT DROP")
+        copy_rows(cur, 'device_stage', columns, rows)
+        cur.execute("""
+            UPDATE device SET model_id = s.model_id, carrier_name = s.carrier_name, platform = s.platform
+            FROM device_stage s
+            WHERE device.id = s.id
+              AND (device.model_id, device.carrier_name, device.platform)
+                  IS DISTINCT FROM (s.model_id, s.carrier_name, s.platform)
+        """)
+        n_upsert = cur.rowcount
+        cur.execute("""
+            INSERT INTO device (id, model_id, carrier_name, platform)
+            SELECT s.id, s.model_id, s.carrier_name, s.platform FROM device_stage s
+            WHERE NOT EXISTS (SELECT 1 FROM device d WHERE d.id = s.id)
+        """)
+        n_upsert = n_upsert + cur.rowcount
+
+    t2 = time.perf_counter()
+    logging.info(f"\tcarrier: {len(new_carriers)} new\tdevice_model: {len(new_models)} new\tdevice: {n_upsert} inserted/updated")
+    logging.info(f"\tComplete: {t2-t1:0.4f} seconds\n")
+    return(carrier_keys, model_keys)
@@ -0,0 +1,345 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+import utils
+from config import dx_data_set_id, dx_bucket, dx_requests_per_second, dx_concurrent_jobs, dx_assets_per_job
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+#---
+# AWS Data Exchange export scheduler
+#
+# Replaces the paging/create_job/start_job cells of
+# misc_scripts/aws_dx_pull.ipynb. Revisions of a data set are listed, their
+# assets paged concurrently (one thread per revision) and grouped into
+# ExportAssetsToS3 jobs of at most dx_assets_per_job assets. Every API call
+# takes a token from a per-operation bucket sized to the service quota, and
+# throttling errors back off and retry. At most dx_concurrent_jobs jobs run at
+# once; the running ones are polled together every poll_interval seconds and
+# failed jobs are recreated up to max_attempts times.
+#
+# Revisions are planned newest first and an asset whose S3 key is already
+# exported (or scheduled) from a revision at least as new is skipped, so
+# republished revisions only export what they change. All state goes to a
+# JSON-lines journal, so an interrupted pull resumes where it stopped:
+#   python dx_export.py --state dx_state.jsonl --since 2020-03-01
+# and runs against the local stub client with --stub.
+
+PENDING = 'PENDING'         # planned, no job yet
+CREATED = 'CREATED'         # job created, not started
+STARTED = 'STARTED'         # started, state not polled yet
+COMPLETED = 'COMPLETED'
+FAILED = 'FAILED'           # gave up after max_attempts
+running_states = {STARTED, 'WAITING', 'IN_PROGRESS'}
+retry_states = {'ERROR', 'CANCELLED', 'TIMED_OUT'}
+
+throttle_codes = {'ThrottlingException', 'ServiceLimitExceededException', 'TooManyRequestsException'}
+
+def error_code(e):
+    # botocore ClientError code, None for other exceptions
+    return(getattr(e, 'response', {}).get('Error', {}).get('Code'))
+
+class TokenBucket():
+    # blocking token bucket: rate tokens per second, bursts of up to capacity
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+        self.waited = 0.0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, n=1):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= n:
+                    self.tokens = self.tokens - n
+                    return
+                wait = (n - self.tokens) / self.rate
+                self.waited = self.waited + wait
+            self.sleep(wait)
+
+    def drain(self):
+        # after a throttling error, every caller waits for fresh tokens
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+class RateLimitedClient():
+    # calls client operations through one TokenBucket per operation and
+    # retries throttling errors with exponential backoff
+    def __init__(self, client, rates=dx_requests_per_second, default_rate=5, retries=8, backoff=1.0, max_backoff=60.0, sleep=time.sleep):
+        self.client = client
+        self.rates = rates
+        self.default_rate = default_rate
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.buckets = {}
+        self.calls = {}
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def _bucket(self, op):
+        with self.lock:
+            if op not in self.buckets:
+                self.buckets[op] = TokenBucket(self.rates.get(op, self.default_rate), sleep=self.sleep)
+                self.calls[op] = 0
+            self.calls[op] = self.calls[op] + 1
+            return(self.buckets[op])
+
+    def call(self, op, **kwargs):
+        bucket = self._bucket(op)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                return(getattr(self.client, op)(**kwargs))
+            except Exception as e:
+                if error_code(e) not in throttle_codes or attempt == self.retries:
+                    raise
+                with self.lock:
+                    self.throttled = self.throttled + 1
+                bucket.drain()
+                self.sleep(min(self.backoff * 2**attempt, self.max_backoff))
+                attempt = attempt + 1
+
+class JobStore():
+    # export state: revisions already planned and one entry per export job.
+    # Changes are appended to a JSON-lines journal at path and replayed on
+    # load; the journal is compacted when loaded. path=None keeps it in memory.
+    def __init__(self, path=None):
+        self.path = path
+        self.revisions = {}
+        self.jobs = {}
+        self.lock = threading.RLock()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        self._apply(json.loads(line))
+            self._compact()
+
+    def _apply(self, entry):
+        table = self.revisions if entry['kind'] == 'revision' else self.jobs
+        table.setdefault(entry['key'], {}).update(entry['fields'])
+
+    def _compact(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for kind, table in (('revision', self.revisions), ('job', self.jobs)):
+                for key, fields in table.items():
+                    f.write(json.dumps({'kind': kind, 'key': key, 'fields': fields}) + '\n')
+        os.replace(tmp, self.path)
+
+    def _write(self, kind, key, fields):
+        entry = {'kind': kind, 'key': key, 'fields': fields}
+        with self.lock:
+            self._apply(entry)
+            if self.path is not None:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+
+    def update_revision(self, revision_id, **fields):
+        self._write('revision', revision_id, fields)
+
+    def update_job(self, key, **fields):
+        fields['updated_at'] = time.time()
+        self._write('job', key, fields)
+
+    def keys_in_state(self, *states):
+        with self.lock:
+            return([k for k, j in self.jobs.items() if j['state'] in states])
+
+    def exported_keys(self):
+        # S3 key -> created_at of the newest revision exporting it
+        claimed = {}
+        with self.lock:
+            for job in self.jobs.values():
+                if job['state'] == FAILED:
+                    continue
+                for _, name in job['assets']:
+                    claimed[name] = max(claimed.get(name, ''), job['created_at'])
+        return(claimed)
+
+    def counts(self):
+        out = {}
+        with self.lock:
+            for job in self.jobs.values():
+                out[job['state']] = out.get(job['state'], 0) + 1
+        return(out)
+
+def _created_at(revision):
+    created = revision.get('CreatedAt', '')
+    return(created.isoformat() if isinstance(created, datetime) else str(created))
+
+def list_revisions(api, data_set_id, since=None):
+    # revisions of the data set newest first, each id once
+    revisions = {}
+    token = {}
+    while True:
+        resp = api.call('list_data_set_revisions', DataSetId=data_set_id, **token)
+        for rev in resp.get('Revisions', []):
+            revisions.setdefault(rev['Id'], rev)
+        if not resp.get('NextToken'):
+            break
+        token = {'NextToken': resp['NextToken']}
+    out = sorted(revisions.values(), key=_created_at, reverse=True)
+    if since is not None:
+        out = [r for r in out if _created_at(r) >= since]
+    return(out)
+
+def list_assets(api, data_set_id, revision_id, page_size=dx_assets_per_job):
+    # every asset of a revision, following NextToken
+    assets = []
+    token = {}
+    while True:
+        resp = api.call('list_revision_assets', DataSetId=data_set_id, RevisionId=revision_id, MaxResults=page_size, **token)
+        assets.extend(resp.get('Assets', []))
+        if not resp.get('NextToken'):
+            break
+        token = {'NextToken': resp['NextToken']}
+    return(assets)
+
+def plan_exports(api, store, data_set_id, since=None, num_threads=8, assets_per_job=dx_assets_per_job):
+    # lists new revisions and records their export jobs as PENDING
+    t1 = time.perf_counter()
+    revisions = [r for r in list_revisions(api, data_set_id, since) if r['Id'] not in store.revisions]
+    logging.info(f"Planning exports of {len(revisions)} new revisions")
+    with ThreadPool(num_threads) as pool:
+        listed = pool.map(lambda r: list_assets(api, data_set_id, r['Id'], assets_per_job), revisions)
+
+    claimed = store.exported_keys()
+    for rev, assets in zip(revisions, listed):
+        created = _created_at(rev)
+        keep = []
+        for a in assets:
+            if claimed.get(a['Name'], '') >= created:
+                continue
+            claimed[a['Name']] = created
+            keep.append([a['Id'], a['Name']])
+        for n in range(0, len(keep), assets_per_job):
+            store.update_job(f"{rev['Id']}:{n // assets_per_job:04d}", revision_id=rev['Id'], created_at=created,
+                             assets=keep[n:n + assets_per_job], state=PENDING, job_id=None, attempts=0, error=None)
+        store.update_revision(rev['Id'], created_at=created, comment=rev.get('Comment'), assets=len(assets), exported=len(keep))
+        if len(keep) < len(assets):
+            logging.info(f"\t{rev['Id']}: {len(assets) - len(keep)} of {len(assets)} assets already exported from a newer revision")
+    t2 = time.perf_counter()
+    logging.info(f"\tComplete: {t2-t1:0.4f} seconds\n")
+
+def _start(api, store, key, data_set_id, bucket, prefix, max_attempts):
+    job = store.jobs[key]
+    try:
+        if job['state'] == PENDING:
+            resp = api.call('create_job', Type='EXPORT_ASSETS_TO_S3', Details={
+                'ExportAssetsToS3': {
+                    'AssetDestinations': [{'AssetId': i, 'Bucket': bucket, 'Key': prefix + name} for i, name in job['assets']],
+                    'DataSetId': data_set_id,
+                    'RevisionId': job['revision_id']
+                }
+            })
+            store.update_job(key, state=CREATED, job_id=resp['Id'], attempts=job['attempts'] + 1)
+        try:
+            api.call('start_job', JobId=store.jobs[key]['job_id'])
+        except Exception as e:
+            # started before an interruption; polling finds its state
+            if error_code(e) != 'ConflictException':
+                raise
+        store.update_job(key, state=STARTED)
+    except Exception as e:
+        failures = job.get('start_failures', 0) + 1
+        logging.info(f"\t{key}: {e!r}")
+        store.update_job(key, start_failures=failures, error=repr(e), state=FAILED if failures >= max_attempts else store.jobs[key]['state'])
+
+def _poll(api, store, key, max_attempts):
+    job = store.jobs[key]
+    try:
+        resp = api.call('get_job', JobId=job['job_id'])
+    except Exception as e:
+        # counted like start failures; a job that cannot be read is given up on
+        failures = job.get('poll_failures', 0) + 1
+        logging.info(f"\t{key}: {e!r}")
+        store.update_job(key, poll_failures=failures, error=repr(e), state=FAILED if failures >= max_attempts else job['state'])
+        return
+    if job.get('poll_failures'):
+        store.update_job(key, poll_failures=0)
+    state = resp['State']
+    if state in retry_states:
+        error = json.dumps(resp.get('Errors', []), default=str)
+        if job['attempts'] < max_attempts:
+            logging.info(f"\t{key}: job {job['job_id']} {state}, retrying")
+            store.update_job(key, state=PENDING, job_id=None, error=error)
+        else:
+            logging.info(f"\t{key}: job {job['job_id']} {state}, giving up")
+            store.update_job(key, state=FAILED, error=error)
+    elif state != job['state']:
+        store.update_job(key, state=state)
+
+def run_exports(api, store, data_set_id, bucket, prefix='', concurrent_jobs=dx_concurrent_jobs, poll_interval=30.0, max_attempts=3, num_threads=8, sleep=time.sleep):
+    # creates, starts and polls jobs until none is left pending or running
+    t1 = time.perf_counter()
+    logging.info(f"Running exports to s3://{bucket}/{prefix}: {store.counts()}")
+    with ThreadPool(num_threads) as pool:
+        while True:
+            running = store.keys_in_state(*running_states)
+            waiting = store.keys_in_state(CREATED, PENDING)
+            if not running and not waiting:
+                break
+            start = waiting[:max(0, concurrent_jobs - len(running))]
+            pool.map(lambda k: _start(api, store, k, data_set_id, bucket, prefix, max_attempts), start)
+            pool.map(lambda k: _poll(api, store, k, max_attempts), store.keys_in_state(*running_states))
+            logging.debug(f"\t{store.counts()}")
+            sleep(poll_interval)
+    t2 = time.perf_counter()
+    logging.info(f"\tComplete: {store.counts()} in {t2-t1:0.4f} seconds, {api.throttled} throttled calls\n")
+    return(store.counts())
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loglevel', type=str)
+    parser.add_argument('--state', type=str, required=True, help='JSON-lines job journal, resumed if it exists')
+    parser.add_argument('--data_set_id', type=str, default=dx_data_set_id)
+    parser.add_argument('--bucket', type=str, default=dx_bucket)
+    parser.add_argument('--prefix', type=str, default='', help='prepended to every S3 key')
+    parser.add_argument('--since', type=str, help='only revisions created on or after YYYY-MM-DD')
+    parser.add_argument('--concurrent_jobs', type=int, default=dx_concurrent_jobs)
+    parser.add_argument('--poll_interval', type=float, default=30.0)
+    parser.add_argument('--max_attempts', type=int, default=3)
+    parser.add_argument('--plan_only', action='store_true', help='record the jobs without running them')
+    parser.add_argument('--stub', action='store_true', help='run against dx_stub.StubDataExchange')
+    args = parser.parse_args()
+    utils.initLogger(args)
+
+    if args.stub:
+        import dx_stub
+        client = dx_stub.StubDataExchange()
+    elif boto3 is None:
+        utils.ERROR("boto3 is required, or use --stub")
+    else:
+        client = boto3.client('dataexchange')
+    api = RateLimitedClient(client)
+    store = JobStore(args.state)
+    plan_exports(api, store, args.data_set_id, args.since)
+    if not args.plan_only:
+        run_exports(api, store, args.data_set_id, args.bucket, args.prefix, args.concurrent_jobs, args.poll_interval, args.max_attempts)
+
+
+if __name__ == "__main__":
+    main()
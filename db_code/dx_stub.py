@@ -0,0 +1,125 @@
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+import numpy as np
+
+#---
+# Local stand-in for the boto3 dataexchange client
+#
+# Implements the calls dx_export makes (list_data_set_revisions,
+# list_revision_assets, create_job, start_job, get_job) over a synthetic data
+# set, enforcing the parts of the service that matter to the scheduler:
+# per-operation request rates (ThrottlingException), the number of concurrent
+# export jobs (ServiceLimitExceededException), assets per job, paging with
+# NextToken and restarting a started job (ConflictException). Jobs complete
+# job_seconds after they start, or end in ERROR with probability error_rate.
+# Every duplicate_every-th revision republishes the assets of the one before
+# it. Exported keys are collected in .exported.
+
+class StubClientError(Exception):
+    # shaped like botocore.exceptions.ClientError
+    def __init__(self, code, message=''):
+        super().__init__(f"{code}: {message}")
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+class StubDataExchange():
+    def __init__(self, num_revisions=30, assets_per_revision=250, duplicate_every=10, page_size=100,
+                 requests_per_second=10, concurrent_jobs=10, assets_per_job=100, job_seconds=0.05,
+                 error_rate=0.0, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.page_size = page_size
+        self.requests_per_second = requests_per_second
+        self.concurrent_jobs = concurrent_jobs
+        self.assets_per_job = assets_per_job
+        self.job_seconds = job_seconds
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.jobs = {}
+        self.exported = []
+
+        start = datetime(2020, 3, 1, tzinfo=timezone.utc)
+        self.revisions = []
+        self.assets = {}
+        for i in range(0, num_revisions):
+            rev = {'Id': self.rng.bytes(16).hex(), 'CreatedAt': start + timedelta(days=i)}
+            if duplicate_every and i > 0 and i % duplicate_every == 0:
+                prev = self.revisions[-1]
+                rev['Comment'] = prev['Comment'] + ' (republished)'
+                names = [a['Name'] for a in self.assets[prev['Id']]]
+            else:
+                rev['Comment'] = f"X-Mode {rev['CreatedAt']:%Y-%m-%d}"
+                names = [f"{rev['CreatedAt']:%Y/%m/%d}/part-{n:05d}.csv.gz" for n in range(0, assets_per_revision)]
+            self.revisions.append(rev)
+            self.assets[rev['Id']] = [{'Id': uuid.uuid4().hex, 'Name': name, 'RevisionId': rev['Id']} for name in names]
+
+    def _request(self, op):
+        # sliding one second window of calls per operation
+        now = time.monotonic()
+        with self.lock:
+            window = self.calls.setdefault(op, deque())
+            while window and window[0] <= now - 1.0:
+                window.popleft()
+            if len(window) >= self.requests_per_second:
+                raise StubClientError('ThrottlingException', f"Rate exceeded for {op}")
+            window.append(now)
+
+    def _page(self, items, key, NextToken=None, MaxResults=None):
+        start = int(NextToken or 0)
+        end = start + min(MaxResults or self.page_size, self.page_size)
+        out = {key: items[start:end]}
+        if end < len(items):
+            out['NextToken'] = str(end)
+        return(out)
+
+    def list_data_set_revisions(self, DataSetId, NextToken=None, MaxResults=None):
+        self._request('list_data_set_revisions')
+        return(self._page(self.revisions, 'Revisions', NextToken, MaxResults))
+
+    def list_revision_assets(self, DataSetId, RevisionId, NextToken=None, MaxResults=None):
+        self._request('list_revision_assets')
+        if RevisionId not in self.assets:
+            raise StubClientError('ResourceNotFoundException', RevisionId)
+        return(self._page(self.assets[RevisionId], 'Assets', NextToken, MaxResults))
+
+    def create_job(self, Type, Details):
+        self._request('create_job')
+        destinations = Details['ExportAssetsToS3']['AssetDestinations']
+        if len(destinations) > self.assets_per_job:
+            raise StubClientError('ValidationException', f"{len(destinations)} assets in one job")
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = {'Id': job_id, 'State': 'WAITING', 'Details': Details, 'started': None}
+        return({'Id': job_id, 'State': 'WAITING'})
+
+    def _update(self, job):
+        if job['State'] == 'IN_PROGRESS' and time.monotonic() - job['started'] >= self.job_seconds:
+            if self.rng.random() < self.error_rate:
+                job['State'] = 'ERROR'
+                job['Errors'] = [{'Code': 'INTERNAL_SERVER_EXCEPTION', 'Message': 'stub failure'}]
+            else:
+                job['State'] = 'COMPLETED'
+                self.exported.extend(d['Key'] for d in job['Details']['ExportAssetsToS3']['AssetDestinations'])
+
+    def start_job(self, JobId):
+        self._request('start_job')
+        with self.lock:
+            job = self.jobs[JobId]
+            if job['started'] is not None:
+                raise StubClientError('ConflictException', f"Job {JobId} already started")
+            for other in self.jobs.values():
+                self._update(other)
+            if sum(j['State'] == 'IN_PROGRESS' for j in self.jobs.values()) >= self.concurrent_jobs:
+                raise StubClientError('ServiceLimitExceededException', 'Too many concurrent export jobs')
+            job['State'] = 'IN_PROGRESS'
+            job['started'] = time.monotonic()
+        return({})
+
+    def get_job(self, JobId):
+        self._request('get_job')
+        with self.lock:
+            job = self.jobs[JobId]
+            self._update(job)
+            return({'Id': JobId, 'State': job['State'], 'Errors': job.get('Errors', [])})
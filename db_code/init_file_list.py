@@ -0,0 +1,151 @@
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import os.path
+import time
+import zlib
+import pandas as pd
+import utils
+import storage
+
+#---
+# Builds files_to_process.csv for a directory or s3:// prefix of X-Mode
+# part-*.csv.gz files.
+#
+# Every file is read once in large compressed blocks: the compressed bytes are
+# hashed for a fingerprint and the decompressed blocks are scanned for
+# newlines, with files spread over a process pool. Results are cached by
+# path, mtime and size so re-running over a growing directory only touches
+# new files. The data row count (header excluded) goes to the rows column of
+# the file list, which lets the parallel loader reserve rid ranges up front;
+# nrow stays the rid end the loaders record for processed files.
+
+read_block_size = 1 << 22
+
+def count_rows(path):
+    # returns (path, data rows, fingerprint); files not ending in .gz are
+    # counted as they are, like storage.open_file reads them
+    h = hashlib.blake2b(digest_size=16)
+    gz = path.endswith('.gz')
+    d = zlib.decompressobj(wbits=47)
+    nlines = 0
+    last = b'\n'
+    with storage.open_raw(path) as f:
+        while True:
+            block = f.read(read_block_size)
+            if not block:
+                break
+            h.update(block)
+            if not gz:
+                nlines = nlines + block.count(b'\n')
+                last = block[-1:]
+                block = b''
+            while block:
+                out = d.decompress(block)
+                if out:
+                    nlines = nlines + out.count(b'\n')
+                    last = out[-1:]
+                block = b''
+                if d.eof:
+                    # concatenated gzip members
+                    block = d.unused_data
+                    d = zlib.decompressobj(wbits=47)
+        out = d.flush()
+        if out:
+            nlines = nlines + out.count(b'\n')
+            last = out[-1:]
+    if last != b'\n':
+        nlines = nlines + 1
+    return(path, max(nlines - 1, 0), h.hexdigest())
+
+def load_cache(cache_path):
+    if os.path.exists(cache_path):
+        cache = pd.read_csv(cache_path, dtype={'path':'str','mtime':'float','size':'int','nrow':'int','fingerprint':'str'})
+    else:
+        cache = pd.DataFrame({
+                    'path': pd.Series([], dtype='str'),
+                    'mtime': pd.Series([], dtype='float'),
+                    'size': pd.Series([], dtype='int'),
+                    'nrow': pd.Series([], dtype='int'),
+                    'fingerprint': pd.Series([], dtype='str')})
+    return(cache)
+
+def count_files(files, cache_path, num_workers):
+    cache = load_cache(cache_path)
+    known = {(r.path, r.mtime, r.size): (r.nrow, r.fingerprint) for r in cache.itertuples()}
+
+    stats = {f: storage.stat(f) for f in files}
+    todo = [f for f in files if (f, stats[f][1], stats[f][0]) not in known]
+    logging.info(f"\t{len(files) - len(todo)} files cached, counting {len(todo)}")
+
+    t1 = time.perf_counter()
+    counted = {}
+    if todo:
+        with multiprocessing.Pool(num_workers) as pool:
+            for path, nrow, fingerprint in pool.imap_unordered(count_rows, todo):
+                counted[path] = (nrow, fingerprint)
+                logging.debug(f"\t{path}: {nrow} rows")
+    t2 = time.perf_counter()
+    logging.info(f"\tComplete: {t2-t1:0.4f} seconds\n")
+
+    rows = []
+    for f in files:
+        key = (f, stats[f][1], stats[f][0])
+        nrow, fingerprint = counted[f] if f in counted else known[key]
+        rows.append({'path':f, 'mtime':key[1], 'size':key[2], 'nrow':nrow, 'fingerprint':fingerprint})
+    result = pd.DataFrame(rows, columns=['path','mtime','size','nrow','fingerprint'])
+
+    # keep entries for files outside this run
+    others = cache[~cache['path'].isin(files)]
+    pd.concat([others, result], ignore_index=True).to_csv(cache_path, sep=",", header=True, index=False)
+    return(result)
+
+def build_file_list(xmode_dir, wd, num_workers):
+    logging.info(f"Building file list for {xmode_dir}")
+    files = storage.list_files(xmode_dir)
+    counts = count_files(files, wd + 'file_counts_cache.csv', num_workers)
+
+    files_to_process_path = wd + 'files_to_process.csv'
+    if os.path.exists(files_to_process_path):
+        files_tab = pd.read_csv(files_to_process_path, usecols=lambda c: c in utils.file_list_dtypes, dtype=utils.file_list_dtypes)
+    else:
+        files_tab = pd.DataFrame({c: pd.Series([], dtype=t) for c, t in utils.file_list_dtypes.items()})
+
+    # processed files keep their rid_end in nrow; lists written before the
+    # rows column held row counts in nrow of pending files
+    nrows = dict(zip(counts['path'], counts['nrow']))
+    pending = files_tab['status'] == 0
+    files_tab.loc[pending, 'nrow'] = 0
+    files_tab['rows'] = files_tab['path'].map(nrows).fillna(0).astype('int')
+
+    new = [f for f in files if f not in set(files_tab['path'])]
+    start = int(files_tab['index'].max()) + 1 if len(files_tab) > 0 else 0
+    if new:
+        files_tab = pd.concat([files_tab, pd.DataFrame({
+            'index': range(start, start + len(new)),
+            'path': new,
+            'status': [0]*len(new),
+            'nrow': [0]*len(new),
+            'rows': [nrows[f] for f in new]
+        })], ignore_index=True)
+
+    files_tab.to_csv(files_to_process_path, sep=",", header=True, index=False)
+    logging.info(f"\t{len(new)} new files, {int((files_tab['status'] == 0).sum())} pending, {int(files_tab.loc[files_tab['status'] == 0, 'rows'].sum())} rows pending")
+    return(files_tab)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loglevel', type=str)
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--source', type=str, help='directory or s3://bucket/prefix of the part files')
+    args = parser.parse_args()
+    utils.initLogger(args)
+
+    wd = "/Users/jadrake/Documents/Misc/COVID/Mobility/xmode/"
+    xmode_dir = args.source or wd + "filtered/"
+    build_file_list(xmode_dir, wd + 'db_code/', args.num_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,13 @@ import numpy as np
 import psycopg2
 import argparse
 import utils
+import dimensions
+import pgcopy
+import timezones
+import schema
+import spatial
+import manifest
+import sanitize
 from utils import Base, Venue, Venue_category, Device, Carrier, Device_model, Pings
 import logging
 import pickle
@@ -11,7 +18,17 @@ import time
 import glob
 import io
 import csv, gzip
+import itertools
+import multiprocessing
+import queue
+import threading
 from datetime import datetime
+from streams import CopyStream
+from ping_io import read_ping_file, read_ping_times, clean_ping_frame
+from venues import VenueCache
+from lookups import PingLookups
+from metrics import FileMetrics, stage, timed_chunks, write_metrics, commit_metrics
+from copy_writer import CopyWriter
 from timezonefinder import TimezoneFinder
 from pytz import timezone, utc
 from pytz.exceptions import UnknownTimeZoneError
@@ -21,92 +38,44 @@ def init_venue_tables():
     logging.info("Initializing venue and venue category tables")
     logging.info(f"\tLoading: {aux_tables_dir + 'xmode_venue_masterlist.pickle'}" )
 
-    t1 = time.perf_counter()
-
-    with open(aux_tables_dir + 'xmode_venue_masterlist.pickle','rb') as f:
-        venues_tab = pickle.load(f)
-
-    #get unique categories
-    v_cat_tab = {}
-    c = 1
-    for v in venues_tab:
-        temp = venues_tab[v]
-        for k in temp:
-            if k not in v_cat_tab:
-                v_cat_tab[k] = Venue_category(name=k)
-                c = c + 1
-
-
-    for v in venues_tab:
-        temp_cats = venues_tab[v]
-        venue = Venue(name = v)
-
-        for l in temp_cats:
-            if v_cat_tab[l]:
-                venue.venue_category.append(v_cat_tab[l])
-        session.add(venue)
-
-
-    for k in v_cat_tab:
-        session.add(v_cat_tab[k])
-
-    #t = session.query(Venue_category.name).filter_by(name = 'Businesses and Services')
-    session.commit()
+    m = FileMetrics(None, aux_tables_dir + 'xmode_venue_masterlist.pickle').start()
+    with m.stage('parse') as st:
+        with open(aux_tables_dir + 'xmode_venue_masterlist.pickle','rb') as f:
+            venues_tab = pickle.load(f)
+        st.add('parse', rows=len(venues_tab))
 
     logging.info("Pushing to database")
-    t2 = time.perf_counter()
-    logging.info(f"\tComplete: {t2-t1:0.4f} seconds\n")
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    with m.stage('copy'):
+        dimensions.load_venue_dimensions(cur, venues_tab)
+    with m.stage('commit'):
+        raw_conn.commit()
+    m.stop()
+    commit_metrics(m.records(), raw_conn)
+    raw_conn.close()
 
 def init_device_tables():
 
     logging.info("Loading master list of devices")
     logging.info(f"\tLoading: {aux_tables_dir + 'xmode_tx_device_masterlist.pickle'}")
 
-    with open(aux_tables_dir + 'xmode_tx_device_masterlist.pickle','rb') as f:
-        device_tab = pickle.load(f)
-
-    #construct set of unique device_models and carriers
-    device_models = {}
-    carriers = {}
-
-    t1 = time.perf_counter()
-    c1 = 0
-    c2 = 1
-    for d in device_tab:
-        l = device_tab[d]
-        temp_platform = l[0]
-        temp_carrier = l[1]
-        temp_model = l[2]
-        if temp_carrier not in carriers:
-            carriers[temp_carrier] = Carrier(carrier_name=temp_carrier)
-            session.add(carriers[temp_carrier])
-        if temp_model not in device_models:
-            device_models[temp_model] = Device_model(model_name=temp_model)
-            session.add(device_models[temp_model])
-
-
+    m = FileMetrics(None, aux_tables_dir + 'xmode_tx_device_masterlist.pickle').start()
+    with m.stage('parse') as st:
+        with open(aux_tables_dir + 'xmode_tx_device_masterlist.pickle','rb') as f:
+            device_tab = pickle.load(f)
+        st.add('parse', rows=len(device_tab))
 
-    session.commit()
-
-    n = len(device_tab)
-    for d in device_tab:
-        l = device_tab[d]
-        temp_platform = l[0]
-        temp_carrier = l[1]
-        temp_model = l[2]
-
-        dev = Device(id=d, platform=temp_platform)
-        dev.carrier.append(carriers[temp_carrier])
-        dev.model.append(device_models[temp_model])
-        session.add(dev)
-        c1 = c1 + 1
-        if c1 % 10000 == 0:
-            print(f"\t{100*c1/n:0.4f} complete")
-            session.commit()
-
-    session.commit()
-    t2 = time.perf_counter()
-    logging.info(f"\tComplete: {t2-t1:0.4f} seconds\n")
+    logging.info("Pushing to database")
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    with m.stage('copy'):
+        dimensions.load_device_dimensions(cur, device_tab)
+    with m.stage('commit'):
+        raw_conn.commit()
+    m.stop()
+    commit_metrics(m.records(), raw_conn)
+    raw_conn.close()
 
 def get_header_index(header):
     inds = {}
@@ -136,17 +105,156 @@ def get_header_index(header):
     return(inds)
 
 def get_venue_table():
-    venue_tab = {}
-    for v in session.query(Venue).order_by(Venue.id):
-        venue_tab[v.name] = v.id
-    return(venue_tab)
-
-
-
-def init_ping_table3(fileManager, num_files):
+    return(VenueCache().load(session).venue_tab)
+
+
+
+_tz_grid = None
+
+def get_tz_grid():
+    global _tz_grid
+    if _tz_grid is None:
+        _tz_grid = timezones.TimezoneGrid()
+        if tz_preload_bbox is not None:
+            _tz_grid.preload(*tz_preload_bbox)
+    return(_tz_grid)
+
+def ping_tz_names(dat):
+    if not resolve_timezones:
+        return(np.full(len(dat), None, dtype=object))
+    return(get_tz_grid().resolve(dat['latitude'], dat['longitude']))
+
+def map_ping_frame(dat, lookups, cur=None):
+    # device, venue and dictionary codes, unknown values are registered through
+    # cur when given; adds the derived tz_name and cell columns. Non-numeric
+    # dwell times become missing
+    dat['advertiser_id'] = lookups.devices.map(dat['advertiser_id'], cur)
+    dat['venue_name'] = lookups.venues.map(dat['venue_name'], cur)
+    for column in lookups.codes:
+        dat[column] = lookups.codes[column].map(dat[column], cur)
+    dat['dwell_time'] = pd.to_numeric(dat['dwell_time'], errors='coerce')
+    dat['tz_name'] = ping_tz_names(dat)
+    dat['cell'] = spatial.cell_ids(dat['latitude'], dat['longitude'])
+    return(dat)
+
+def format_ping_frame(dat, index, rid_start):
+    # mapped frame in pings table order, for the text COPY path; missing
+    # values are written as Null by to_csv(na_rep='Null')
+    dat = dat.copy(deep=False)
+    dat.insert(0, 'rid', range(rid_start, rid_start + len(dat)))
+    dat.insert(len(dat.columns) - 2,'source',[index]*len(dat))
+    #utc timestamp, local time is timestamp AT TIME ZONE tz_name
+    dat.insert(3, 'timestamp', pd.to_datetime(dat['location_at'], unit='s', utc=True))
+    return(dat)
+
+def float8_values(col):
+    # compact float32 columns go through their shortest decimal text, so 1.1
+    # is sent as 1.1 and not widened to 1.100000023841858. The text path
+    # already writes the short form (to_csv), only binary COPY needs this
+    if col.dtype == np.float32:
+        return(col.astype(str).astype(np.float64))
+    return(col)
+
+def ping_copy_fields(dat, index, rid_start, lookups):
+    # typed columns of a mapped frame in pings table order, for the binary
+    # COPY path
+    n = len(dat)
+    return([
+        ('int4', np.arange(rid_start, rid_start + n)),
+        ('int4' if integer_device_keys else 'text', dat['advertiser_id']),
+        ('int4', dat['location_at']),
+        ('timestamptz', dat['location_at']),
+        ('float8', dat['latitude']),
+        ('float8', dat['longitude']),
+        ('float8', float8_values(dat['altitude'])),
+        ('float8', float8_values(dat['horizontal_accuracy'])),
+        ('float8', float8_values(dat['vertical_accuracy'])),
+        (lookups.string_type('heading'), dat['heading']),
+        ('float8', float8_values(dat['speed'])),
+        ('text', dat['ipv_4']),
+        ('text', dat['ipv_6']),
+        (lookups.string_type('final_country'), dat['final_country']),
+        (lookups.string_type('user_agent'), dat['user_agent']),
+        (lookups.string_type('background'), dat['background']),
+        (lookups.string_type('publisher_id'), dat['publisher_id']),
+        ('text', dat['wifi_ssid']),
+        (lookups.string_type('wifi_bssid'), dat['wifi_bssid']),
+        ('int4', dat['venue_name']),
+        ('float8', dat['dwell_time']),
+        ('int4', np.full(n, index)),
+        ('text', dat['tz_name']),
+        ('int8', dat['cell'])
+    ])
+
+def render_ping_frame(dat, index, rid_start, lookups, cur=None, binary=False, metrics=None):
+    # COPY payload for one cleaned frame: tab separated text or binary tuples
+    with stage(metrics, 'map', rows=len(dat)):
+        dat = map_ping_frame(dat, lookups, cur)
+    with stage(metrics, 'serialize', rows=len(dat)) as m:
+        if binary:
+            payload = pgcopy.encode_tuples(ping_copy_fields(dat, index, rid_start, lookups))
+        else:
+            payload = format_ping_frame(dat, index, rid_start).to_csv(sep='\t', header=False, index=False, na_rep='Null')
+        if m is not None:
+            m.add('serialize', nbytes=len(payload))
+    return(payload)
+
+def copy_ping_payload(cur, blocks, binary=False):
+    if binary:
+        stream = CopyStream(itertools.chain([pgcopy.HEADER], blocks, [pgcopy.TRAILER]), binary=True)
+        pgcopy.copy_binary(cur, 'pings', stream, copy_buffer_size)
+    else:
+        cur.copy_from(CopyStream(blocks), 'pings', sep='\t', null='Null', size=copy_buffer_size)
+
+def ensure_file_partitions(cur, inFile):
+    # creates the partitions for every location_at in a file and commits, for
+    # loaders that stream a file into one open COPY and so cannot create them
+    # per chunk. Costs an extra read of the location_at column.
+    if not schema.is_partitioned(cur):
+        return(0)
+    starts = set()
+    for chunk in read_ping_times(inFile):
+        starts.update(np.unique(chunk['location_at'].to_numpy() // ping_partition_interval).tolist())
+    return(schema.ensure_partitions(cur, np.array(sorted(starts), dtype=np.int64) * ping_partition_interval))
+
+def stream_ping_file(cur, inFile, index, lookups, chunksize, lookup_cur, binary=False, metrics=None):
+    # only one parsed chunk and its text rendering are held in memory at a time;
+    # COPY starts consuming rows as soon as the first chunk is formatted.
+    # cur is busy with COPY while chunks are formatted, so rids are drawn and
+    # new venues registered through a separate lookup_cur. Partitions cannot
+    # be created mid-COPY either, the caller creates them beforehand with
+    # ensure_file_partitions. Returns (rows, first rid, last rid + 1).
+    nrow = [0]
+    rids = [None, None]
+
+    def blocks():
+        for chunk in timed_chunks(metrics, read_ping_file(inFile, chunksize, metrics=metrics)):
+            with stage(metrics, 'clean', rows=len(chunk)):
+                chunk = clean_ping_frame(chunk)
+            with stage(metrics, 'prepare'):
+                rid_start = allocate_rids(lookup_cur, len(chunk))
+                lookup_cur.connection.commit()
+            payload = render_ping_frame(chunk, index, rid_start, lookups, lookup_cur, binary, metrics)
+            with stage(metrics, 'commit'):
+                lookup_cur.connection.commit()
+                lookups.commit()
+            if rids[0] is None:
+                rids[0] = rid_start
+            rids[1] = rid_start + len(chunk)
+            nrow[0] = nrow[0] + len(chunk)
+            yield payload
+
+    # the stages above run inside COPY and are not counted as copy time
+    with stage(metrics, 'copy') as m:
+        copy_ping_payload(cur, blocks(), binary)
+        if m is not None:
+            m.add('copy', rows=nrow[0])
+    return(nrow[0], rids[0], rids[1])
+
+def init_ping_table3(fileManager, num_files, chunksize=None, binary=False):
 
     logging.info("Importing raw data")
-    venue_tab = get_venue_table()
+    lookups = PingLookups().load(session)
 
     # Open connection
     # The SQLAlchemy connection to the database
@@ -157,7 +265,12 @@ def init_ping_table3(fileManager, num_files):
     cur = raw_conn.cursor()
     cur.execute('SELECT version()')
     print(cur.fetchone()[0])
-
+    if chunksize:
+        # rids and new venues found while streaming are committed on their own connection
+        lookup_conn = engine.raw_connection()
+        lookup_cur = lookup_conn.cursor()
+    init_rid_allocator(cur, processed_rid_next(fileManager))
+    raw_conn.commit()
 
     file_tab = fileManager.files_to_process
     n = file_tab.shape[0]
@@ -169,75 +282,44 @@ def init_ping_table3(fileManager, num_files):
         status = file_tab.iloc[f,2]
         try:
             if status == 0: #hasn't been processed yet
-                rid_start = 0
-
-                #get index range
-                if index == 0:
-                    #processing very first file
-                    rid_start = 1
+                m = FileMetrics(index, inFile).start()
+                if chunksize:
+                    logging.info(f"Streaming {inFile} in chunks of {chunksize} rows")
+                    with m.stage('prepare'):
+                        ensure_file_partitions(cur, inFile)
+                    nrow, rid_start, rid_end = stream_ping_file(cur, inFile, index, lookups, chunksize, lookup_cur, binary, m)
                 else:
-                    rid_start = file_tab.iloc[(f-1),3] + 1
-
-                t1 = time.perf_counter()
-                logging.info(f"Loading {inFile}")
-                dat = pd.read_csv(
-                    inFile,
-                    usecols = [e for e in ping_dtypes],
-                    dtype = ping_dtypes,
-                    escapechar="\\"
-                )
-
-                # string formatting
-                dat['wifi_ssid'] = dat['wifi_ssid'].str.replace('"', '')
-                dat['wifi_ssid'] = dat['wifi_ssid'].str.strip()
-                dat['wifi_ssid'] = dat['wifi_ssid'].replace('<unknown ssid>', np.nan)
-                dat['wifi_bssid'] = dat['wifi_bssid'].replace('<unknown bssid>', np.nan)
-                #dat.replace(r'^\s*$', np.nan, regex=True, inplace=True)
-
-
-                dat = dat.fillna('Null')
-                dat.insert(0, 'rid', range(rid_start, rid_start + len(dat)))
-                dat.insert(len(dat.columns),'source',[index]*len(dat))
-                #add additional datetime unaware
-                dat.insert(3, 'timestamp_notz', pd.to_datetime(dat['location_at'], unit='s'))
-
-                logging.info(f"\tindex: {index}\trid_start: {rid_start}\trid_end:{rid_start + len(dat)}")
-
-                # venue id
-                venue = dat['venue_name']
-                v_id = []
-                for v in venue:
-                    if v == 'Null':
-                        v_id.append('Null')
-                    else:
-                        if v in venue_tab:
-                            v_id.append(str(venue_tab[v]))
-                        else:
-                            logging.error("Venue " + v + " not found in database")
-                dat['venue_name'] = v_id
-
-                #write to csv in memory
-                output = io.StringIO()
-                dat.to_csv(output, sep='\t', header=False, index=False)
-                output.seek(0)
-
-                t2 = time.perf_counter()
-                logging.info(f"\tComplete: {t2-t1:0.4f} seconds\n")
-                logging.info("\tPushing to db")
-
-                t1 = time.perf_counter()
-                #push to db
-                cur.copy_from(output, 'pings', sep='\t', null='Null')
+                    logging.info(f"Loading {inFile}")
+                    with m.stage('parse') as st:
+                        dat = read_ping_file(inFile, metrics=m)
+                        st.add('parse', rows=len(dat))
+                    with m.stage('clean', rows=len(dat)):
+                        dat = clean_ping_frame(dat)
+                    with m.stage('prepare'):
+                        # drawn in its own short transaction, like the parallel loader
+                        rid_start = allocate_rids(cur, len(dat))
+                        raw_conn.commit()
+                        schema.ensure_partitions(cur, dat['location_at'])
+                    payload = render_ping_frame(dat, index, rid_start, lookups, cur, binary, m)
+                    nrow = len(dat)
+                    rid_end = rid_start + nrow
+                    with m.stage('copy', rows=nrow, nbytes=len(payload)):
+                        copy_ping_payload(cur, [payload], binary)
                 # Commit inserts to DB
-                raw_conn.commit()
+                with m.stage('commit'):
+                    raw_conn.commit()
+                    lookups.commit()
+                m.stop()
+                commit_metrics(m.records(), raw_conn)
 
-                t2 = time.perf_counter()
-                logging.info(f"\tComplete: {t2-t1:0.4f} seconds\n")
+                logging.info(f"\tindex: {index}\trid_start: {rid_start}\trid_end:{rid_end}")
+                logging.info(f"\t{m.summary()}")
+                logging.info(f"\tComplete: {m.total():0.4f} seconds\n")
 
                 num_files_processed = num_files_processed + 1
                 #update status and nrow
                 fileManager.files_to_process.iloc[f,2] = 1
-                fileManager.files_to_process.iloc[f,3] = rid_start + len(dat)
+                fileManager.files_to_process.iloc[f,3] = rid_end
 
                 if num_files_processed == num_files:
                     break
@@ -248,9 +330,8 @@ def init_ping_table3(fileManager, num_files):
             logging.info(f"\tadding record to {fileManager.file_errors_path}")
             if raw_conn:
                 raw_conn.rollback()
-            fileManager.file_errors = fileManager.file_errors.append(
-                {'index':index, 'path':inFile,'status':0}, ignore_index=True
-            )
+            lookups.rollback()
+            fileManager.add_file_error(index, inFile)
 
             logging.info(f"\tremoving record from {fileManager.files_to_process_path}")
             ind = fileManager.files_to_process.index[f]
@@ -262,10 +343,622 @@ def init_ping_table3(fileManager, num_files):
     fileManager.update_file_list()
 
 
+#---
+# Parallel ingestion
+#
+# Every pending file gets a contiguous rid range before any worker starts, so
+# files can be parsed and copied in any order. Files with a known row count
+# (rows > 0, from init_file_list) are reserved up front from the file list; the
+# rest draw a range from the rid_allocator table once their row count is known.
+# The other loaders draw every file's or chunk's rids from the same allocator,
+# so ids stay unique whichever loaders are mixed across runs.
+
+def processed_rid_next(fileManager):
+    # first rid after the ranges of files already processed
+    done = fileManager.files_to_process[fileManager.files_to_process['status'] == 1]
+    return(int(done['nrow'].max()) + 1 if len(done) > 0 else 1)
+
+def allocate_rids(cur, nrow):
+    # row lock on the allocator serializes concurrent workers
+    cur.execute(
+        "UPDATE rid_allocator SET next_rid = next_rid + %s + 1 WHERE id = 1 RETURNING next_rid - %s - 1",
+        (nrow, nrow)
+    )
+    return(cur.fetchone()[0])
+
+def reserve_rid_ranges(fileManager, num_files):
+    file_tab = fileManager.files_to_process
 
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    cur.execute("SELECT coalesce(max(id), 0) FROM pings")
+    rid_next = max(cur.fetchone()[0] + 1, processed_rid_next(fileManager))
+
+    jobs = []
+    for f in range(0, file_tab.shape[0]):
+        if file_tab.iloc[f,2] != 0:
+            continue
+        index = int(file_tab.iloc[f,0])
+        inFile = file_tab.iloc[f,1]
+        nrow = int(file_tab['rows'].iloc[f])
+        if nrow > 0:
+            jobs.append((f, index, inFile, rid_next, rid_next + nrow))
+            rid_next = rid_next + nrow + 1
+        else:
+            jobs.append((f, index, inFile, 0, 0))
+        if len(jobs) == num_files:
+            break
+
+    # ranges drawn later by the workers must start after the up-front reservations
+    init_rid_allocator(cur, rid_next)
+    raw_conn.commit()
+    raw_conn.close()
+    return(jobs)
+
+def init_rid_allocator(cur, rid_next=1):
+    cur.execute("SELECT coalesce(max(id), 0) + 1 FROM pings")
+    rid_next = max(rid_next, cur.fetchone()[0])
+    cur.execute("INSERT INTO rid_allocator (id, next_rid) VALUES (1, %s) ON CONFLICT (id) DO UPDATE SET next_rid = greatest(rid_allocator.next_rid, excluded.next_rid)", (rid_next,))
+
+_worker_lookups = None
+_worker_binary = False
+
+def _init_ping_worker(binary):
+    global _worker_lookups, _worker_binary
+    # the parent disposed its pool before forking, so every connection here is new
+    _worker_lookups = PingLookups().load(session)
+    session.close()
+    _worker_binary = binary
+
+def load_ping_file(job):
+    f, index, inFile, rid_start, rid_limit = job
+
+    raw_conn = None
+    lookup_conn = None
+    m = FileMetrics(index, inFile).start()
+    try:
+        raw_conn = engine.raw_connection()
+        cur = raw_conn.cursor()
+        # new devices, venues and codes are registered and committed on their
+        # own connection, so their locks are not held through this file's COPY
+        lookup_conn = engine.raw_connection()
+        with m.stage('parse') as st:
+            dat = read_ping_file(inFile, metrics=m)
+            st.add('parse', rows=len(dat))
+        with m.stage('clean', rows=len(dat)):
+            dat = clean_ping_frame(dat)
+        with m.stage('prepare'):
+            if rid_start == 0:
+                rid_start = allocate_rids(cur, len(dat))
+                raw_conn.commit()
+            elif rid_start + len(dat) > rid_limit:
+                raise ValueError(f"{len(dat)} rows exceed reserved range {rid_start}-{rid_limit}")
+            schema.ensure_partitions(cur, dat['location_at'])
+        payload = render_ping_frame(dat, index, rid_start, _worker_lookups, lookup_conn.cursor(), _worker_binary, m)
+        with m.stage('commit'):
+            lookup_conn.commit()
+            _worker_lookups.commit()
+
+        with m.stage('copy', rows=len(dat), nbytes=len(payload)):
+            copy_ping_payload(cur, [payload], _worker_binary)
+        with m.stage('commit'):
+            raw_conn.commit()
+        m.stop()
+        commit_metrics(m.records(), raw_conn)
+        t_push = m.stages['copy']['seconds'] + m.stages['commit']['seconds']
+        return((f, rid_start, rid_start + len(dat), None, m.total() - t_push, t_push, m.rss_mb))
+    except Exception as e:
+        # missing or corrupt files (OSError, EOFError, parser errors) are
+        # recorded like database errors instead of aborting the pool
+        m.stop()
+        if raw_conn is not None:
+            raw_conn.rollback()
+        if lookup_conn is not None:
+            lookup_conn.rollback()
+        _worker_lookups.rollback()
+        return((f, rid_start, 0, f"{type(e).__name__}: {e}", 0, 0, m.rss_mb))
+    finally:
+        if raw_conn is not None:
+            raw_conn.close()
+        if lookup_conn is not None:
+            lookup_conn.close()
+
+def init_ping_table_parallel(fileManager, num_files, num_workers, binary=False):
+
+    logging.info(f"Importing raw data with {num_workers} workers")
+    jobs = reserve_rid_ranges(fileManager, num_files)
+    # workers load their own lookups; nothing checked out or pooled may be
+    # forked, a child closing an inherited socket would close the parent's
+    session.close()
+    engine.dispose()
 
+    t1 = time.perf_counter()
+    nrows = 0
+    failed = []
+    with multiprocessing.Pool(num_workers, initializer=_init_ping_worker, initargs=(binary,)) as pool:
+        for f, rid_start, rid_end, err, t_load, t_push, rss_mb in pool.imap_unordered(load_ping_file, jobs):
+            index = fileManager.files_to_process.iloc[f,0]
+            inFile = fileManager.files_to_process.iloc[f,1]
+            if err is None:
+                logging.info(f"Loaded {inFile}")
+                logging.info(f"\tindex: {index}\trid_start: {rid_start}\trid_end:{rid_end}")
+                logging.info(f"\tLoading: {t_load:0.4f} seconds\tPushing to db: {t_push:0.4f} seconds\tworker rss: {rss_mb:0.0f} MB\n")
+                fileManager.files_to_process.iloc[f,2] = 1
+                fileManager.files_to_process.iloc[f,3] = rid_end
+                nrows = nrows + rid_end - rid_start
+            else:
+                logging.info(f"ERROR")
+                logging.info(f"\tFile: {inFile}")
+                logging.info(f"\t{err}")
+                logging.info(f"\tadding record to {fileManager.file_errors_path}")
+                fileManager.add_file_error(index, inFile)
+                failed.append(f)
+            # positions stay valid until the pool is drained
+            fileManager.update_file_list()
 
-def init_ping_table2(fileList):
+    if failed:
+        logging.info(f"\tremoving {len(failed)} records from {fileManager.files_to_process_path}")
+        fileManager.files_to_process = fileManager.files_to_process.drop(fileManager.files_to_process.index[failed])
+    fileManager.update_file_list()
+
+    t2 = time.perf_counter()
+    logging.info(f"\tComplete: {nrows} rows in {t2-t1:0.4f} seconds ({nrows/(t2-t1):0.0f} rows/sec)\n")
+
+
+
+
+#---
+# Manifest-driven ingestion
+#
+# Files are claimed from the ingest_manifest table and loaded in chunks of
+# checkpoint_rows rows. Each chunk commits together with its manifest
+# checkpoint, so an interrupted file resumes after its last committed chunk and
+# any number of worker processes (on any host) can share one manifest.
+
+def load_claimed_file(raw_conn, cur, worker, claimed, lookups, lookup_conn, chunksize, binary=False):
+    # new devices, venues and codes are registered and committed through
+    # lookup_conn, so their locks are not held through a chunk's COPY
+    file_id, inFile, rid_first, rows_done = claimed
+    if rows_done:
+        logging.info(f"Resuming {inFile} at row {rows_done}")
+    else:
+        logging.info(f"Loading {inFile}")
+
+    m = FileMetrics(file_id, inFile).start()
+    try:
+        for chunk in timed_chunks(m, read_ping_file(inFile, chunksize, rows_done, metrics=m)):
+            with m.stage('clean', rows=len(chunk)):
+                chunk = clean_ping_frame(chunk)
+            with m.stage('prepare'):
+                # rids are drawn in their own short transaction so workers never
+                # wait on each other's COPY
+                rid_start = allocate_rids(cur, len(chunk))
+                raw_conn.commit()
+                schema.ensure_partitions(cur, chunk['location_at'])
+
+            payload = render_ping_frame(chunk, file_id, rid_start, lookups, lookup_conn.cursor(), binary, m)
+            with m.stage('commit'):
+                lookup_conn.commit()
+                lookups.commit()
+            with m.stage('copy', rows=len(chunk), nbytes=len(payload)):
+                copy_ping_payload(cur, [payload], binary)
+            rows_done = rows_done + len(chunk)
+            with m.stage('commit'):
+                manifest.checkpoint(cur, file_id, worker, rid_start, rid_start + len(chunk), rows_done)
+                raw_conn.commit()
+            logging.debug(f"\tcheckpoint {inFile}: {rows_done} rows")
+    finally:
+        m.stop()
+
+    # metrics rows are committed with the finished file
+    write_metrics(m.records(), cur)
+    manifest.finish(cur, file_id, worker)
+    logging.info(f"\t{m.summary()}")
+    logging.info(f"\tindex: {file_id}\trows: {rows_done}\tComplete: {m.total():0.4f} seconds\n")
+    return(rows_done)
+
+def manifest_worker(job):
+    n, num_files, chunksize, binary = job
+    worker = manifest.worker_name(n)
+    lookups = PingLookups().load(session)
+    session.close()
+
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    lookup_conn = engine.raw_connection()
+    num_files_processed = 0
+    while not num_files or num_files_processed < num_files:
+        claimed = manifest.claim(cur, worker)
+        if claimed is None:
+            break
+        try:
+            load_claimed_file(raw_conn, cur, worker, claimed, lookups, lookup_conn, chunksize, binary)
+        except Exception as e:
+            # any failure (a missing or corrupt file too) fails this file only,
+            # instead of leaving it RUNNING and ending the worker
+            logging.info(f"ERROR")
+            logging.info(f"\tFile: {claimed[1]}")
+            logging.info(f"\t{type(e).__name__}: {e}")
+            raw_conn.rollback()
+            lookup_conn.rollback()
+            lookups.rollback()
+            manifest.fail(cur, claimed[0], worker, e)
+        num_files_processed = num_files_processed + 1
+    lookup_conn.close()
+    raw_conn.close()
+    return(num_files_processed)
+
+def init_ping_table_manifest(fileManager, num_files, num_workers=1, chunksize=None, binary=False):
+
+    logging.info(f"Importing raw data from manifest with {num_workers} workers")
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    n = manifest.seed_from_file_list(cur, fileManager)
+    init_rid_allocator(cur, processed_rid_next(fileManager))
+    raw_conn.commit()
+    raw_conn.close()
+    logging.info(f"\t{n} files in manifest")
+
+    chunksize = chunksize or checkpoint_rows
+    # num_files caps the files taken by each worker
+    jobs = [(w, num_files, chunksize, binary) for w in range(0, num_workers)]
+    t1 = time.perf_counter()
+    if num_workers > 1:
+        # nothing checked out or pooled may be forked, a child closing an
+        # inherited socket would close the parent's
+        session.close()
+        engine.dispose()
+        with multiprocessing.Pool(num_workers) as pool:
+            nfiles = sum(pool.map(manifest_worker, jobs))
+    else:
+        nfiles = manifest_worker(jobs[0])
+    t2 = time.perf_counter()
+    logging.info(f"\t{nfiles} files processed in {t2-t1:0.4f} seconds")
+
+    raw_conn = engine.raw_connection()
+    manifest.export_file_list(raw_conn.cursor(), fileManager)
+    raw_conn.close()
+
+
+#---
+# Pipelined ingestion
+#
+# A parser thread reads, cleans and formats file/chunk N+1 while the main
+# thread copies N into postgres. The bounded queue applies backpressure to the
+# parser when the database falls behind. Each file is still committed as one
+# transaction. A file the parser fails on is sent to the main thread as an
+# error marker, which rolls back the chunks already copied and records it.
+
+def init_ping_table_pipelined(fileManager, num_files, chunksize=None, queue_size=2, binary=False):
+
+    logging.info("Importing raw data (pipelined)")
+    lookups = PingLookups().load(session)
+
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    # the parser draws rids and registers new venues on its own connection
+    lookup_conn = engine.raw_connection()
+    lookup_cur = lookup_conn.cursor()
+    init_rid_allocator(cur, processed_rid_next(fileManager))
+    raw_conn.commit()
+
+    file_tab = fileManager.files_to_process
+    n = file_tab.shape[0]
+    work = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    parse_errors = []
+    timing = {'parse': 0.0, 'parse_wait': 0.0, 'copy': 0.0, 'copy_wait': 0.0}
+
+    def put(item):
+        t1 = time.perf_counter()
+        while not stop.is_set():
+            try:
+                work.put(item, timeout=1)
+                timing['parse_wait'] = timing['parse_wait'] + time.perf_counter() - t1
+                return(True)
+            except queue.Full:
+                pass
+        return(False)
+
+    def produce():
+        try:
+            num_files_parsed = 0
+            for f in range(0,n):
+                index = file_tab.iloc[f,0]
+                inFile = file_tab.iloc[f,1]
+                status = file_tab.iloc[f,2]
+                if status != 0:
+                    continue
+
+                rid_start = 0
+                rid_next = 0
+                t_file = 0.0
+                t1 = time.perf_counter()
+                try:
+                    if chunksize:
+                        # the writer keeps the file's transaction open across its
+                        # chunks, so partitions are created before the first one.
+                        # This waits at most for the writer to commit the previous
+                        # file, whose end marker is already queued
+                        ensure_file_partitions(lookup_cur, inFile)
+                        chunks = read_ping_file(inFile, chunksize)
+                    else:
+                        chunks = [read_ping_file(inFile)]
+                    for chunk in chunks:
+                        chunk = clean_ping_frame(chunk)
+                        if not chunksize:
+                            schema.ensure_partitions(lookup_cur, chunk['location_at'])
+                        rid_next = allocate_rids(lookup_cur, len(chunk))
+                        lookup_conn.commit()
+                        if not rid_start:
+                            rid_start = rid_next
+                        payload = render_ping_frame(chunk, index, rid_next, lookups, lookup_cur, binary)
+                        lookup_conn.commit()
+                        lookups.commit()
+                        rid_next = rid_next + len(chunk)
+                        t_file = t_file + time.perf_counter() - t1
+                        if not put(('chunk', f, payload)):
+                            return
+                        t1 = time.perf_counter()
+                except Exception as e:
+                    # missing or corrupt files (OSError, EOFError, parser
+                    # errors) fail this file only
+                    lookup_conn.rollback()
+                    lookups.rollback()
+                    if not put(('error', f, e)):
+                        return
+                    num_files_parsed = num_files_parsed + 1
+                    if num_files_parsed == num_files:
+                        break
+                    continue
+                timing['parse'] = timing['parse'] + t_file
+                if not put(('end', f, rid_start, rid_next, t_file)):
+                    return
+
+                num_files_parsed = num_files_parsed + 1
+                if num_files_parsed == num_files:
+                    break
+        except Exception as e:
+            parse_errors.append(e)
+        finally:
+            put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    failed = []
+    skip = None
+    t_copy = 0.0
+    t_start = time.perf_counter()
+
+    def fail(f, e):
+        index = file_tab.iloc[f,0]
+        inFile = file_tab.iloc[f,1]
+        logging.info(f"ERROR")
+        logging.info(f"\tFile: {inFile}")
+        logging.info(f"\t{type(e).__name__}: {e}")
+        logging.info(f"\tadding record to {fileManager.file_errors_path}")
+        raw_conn.rollback()
+        fileManager.add_file_error(index, inFile)
+        failed.append(f)
+
+    try:
+        while True:
+            t1 = time.perf_counter()
+            item = work.get()
+            t2 = time.perf_counter()
+            timing['copy_wait'] = timing['copy_wait'] + t2 - t1
+            if item is None:
+                break
+
+            f = item[1]
+            if f == skip:
+                continue
+            index = file_tab.iloc[f,0]
+            inFile = file_tab.iloc[f,1]
+            try:
+                if item[0] == 'chunk':
+                    copy_ping_payload(cur, [item[2]], binary)
+                    t_copy = t_copy + time.perf_counter() - t2
+                elif item[0] == 'error':
+                    fail(f, item[2])
+                    t_copy = 0.0
+                else:
+                    _, f, rid_start, rid_end, t_parse = item
+                    # Commit inserts to DB
+                    raw_conn.commit()
+                    t_copy = t_copy + time.perf_counter() - t2
+                    timing['copy'] = timing['copy'] + t_copy
+
+                    logging.info(f"Loaded {inFile}")
+                    logging.info(f"\tindex: {index}\trid_start: {rid_start}\trid_end:{rid_end}")
+                    logging.info(f"\tParsing: {t_parse:0.4f} seconds\tPushing to db: {t_copy:0.4f} seconds\n")
+                    t_copy = 0.0
+
+                    #update status and nrow
+                    fileManager.files_to_process.iloc[f,2] = 1
+                    fileManager.files_to_process.iloc[f,3] = rid_end
+                    fileManager.update_file_list()
+            except Exception as e:
+                fail(f, e)
+                skip = f
+                t_copy = 0.0
+    finally:
+        stop.set()
+        producer.join()
+        lookup_conn.close()
+        raw_conn.close()
+
+    if failed:
+        logging.info(f"\tremoving {len(failed)} records from {fileManager.files_to_process_path}")
+        fileManager.files_to_process = fileManager.files_to_process.drop(fileManager.files_to_process.index[failed])
+    fileManager.update_file_list()
+
+    t_end = time.perf_counter()
+    logging.info(f"Pipeline complete: {t_end-t_start:0.4f} seconds")
+    logging.info(f"\tparse: {timing['parse']:0.4f}s (blocked on queue {timing['parse_wait']:0.4f}s)")
+    logging.info(f"\tcopy: {timing['copy']:0.4f}s (waiting for parser {timing['copy_wait']:0.4f}s)\n")
+    if parse_errors:
+        raise parse_errors[0]
+
+
+
+
+#---
+# Pooled ingestion
+#
+# Files are parsed and rendered in this process and every chunk is COPYed on
+# one of a CopyWriter's connections, so several backends parse COPY input
+# while the next chunk is rendered. Chunks commit independently; a file is
+# marked done once all of its chunks have committed. If one fails, the rows
+# its other chunks committed are deleted by the file's rid ranges and the file
+# goes to error_files.csv. route='partition' splits chunks by pings partition
+# and writes each partition through one connection; route='rid' spreads chunks
+# (rid ranges) round robin.
+
+def init_ping_table_pooled(fileManager, num_files, num_connections=copy_connections, chunksize=None, binary=False, route='rid'):
+
+    logging.info(f"Importing raw data over {num_connections} connections")
+    lookups = PingLookups().load(session)
+
+    # parsing, lookups, partitions and bookkeeping; COPY runs on the writer's connections
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    writer = CopyWriter('pings', num_connections, binary)
+
+    file_tab = fileManager.files_to_process
+    n = file_tab.shape[0]
+    files = {}
+    failed = []
+
+    def close_file(f):
+        st = files.pop(f)
+        index = file_tab.iloc[f,0]
+        inFile = file_tab.iloc[f,1]
+        m = st['metrics']
+        rid_start = st['rids'][0][0] if st['rids'] else 0
+        rid_end = st['rids'][-1][1] if st['rids'] else 0
+        if st['error'] is None:
+            commit_metrics(m.records(), raw_conn)
+            logging.info(f"Loaded {inFile}")
+            logging.info(f"\tindex: {index}\trid_start: {rid_start}\trid_end:{rid_end}")
+            logging.info(f"\t{m.summary()}\n")
+            fileManager.files_to_process.iloc[f,2] = 1
+            fileManager.files_to_process.iloc[f,3] = rid_end
+        else:
+            logging.info(f"ERROR")
+            logging.info(f"\tFile: {inFile}")
+            logging.info(f"\t{type(st['error']).__name__}: {st['error']}")
+            for start, end in st['rids']:
+                cur.execute("DELETE FROM pings WHERE id >= %s AND id < %s", (start, end))
+            raw_conn.commit()
+            logging.info(f"\tadding record to {fileManager.file_errors_path}")
+            fileManager.add_file_error(index, inFile)
+            failed.append(f)
+        fileManager.update_file_list()
+
+    def finish(results):
+        # copy results are charged to the file's copy stage; busy time of
+        # several connections can add up to more than the file's wall time
+        for f, rows, nbytes, seconds, error in results:
+            st = files[f]
+            st['pending'] = st['pending'] - 1
+            st['metrics'].add('copy', rows, nbytes, seconds)
+            if error is not None and st['error'] is None:
+                st['error'] = error
+            if st['read'] and st['pending'] == 0:
+                close_file(f)
+
+    num_files_read = 0
+    init_rid_allocator(cur, processed_rid_next(fileManager))
+    raw_conn.commit()
+    t_start = time.perf_counter()
+    try:
+        for f in range(0,n):
+            index = file_tab.iloc[f,0]
+            inFile = file_tab.iloc[f,1]
+            status = file_tab.iloc[f,2]
+            if status != 0:
+                continue
+
+            m = FileMetrics(index, inFile).start()
+            # rid ranges drawn for the file's chunks, deleted if one fails
+            st = files[f] = {'metrics': m, 'pending': 0, 'read': False, 'error': None, 'rids': []}
+            logging.info(f"Reading {inFile}")
+            try:
+                if chunksize:
+                    chunks = timed_chunks(m, read_ping_file(inFile, chunksize, metrics=m))
+                else:
+                    with m.stage('parse') as ps:
+                        dat = read_ping_file(inFile, metrics=m)
+                        ps.add('parse', rows=len(dat))
+                    chunks = [dat]
+                for chunk in chunks:
+                    with m.stage('clean', rows=len(chunk)):
+                        chunk = clean_ping_frame(chunk)
+                    with m.stage('prepare'):
+                        rid_next = allocate_rids(cur, len(chunk))
+                        raw_conn.commit()
+                        st['rids'].append((rid_next, rid_next + len(chunk)))
+                        schema.ensure_partitions(cur, chunk['location_at'])
+                        if route == 'partition':
+                            parts = chunk.groupby(chunk['location_at'] // ping_partition_interval)
+                        else:
+                            parts = [(None, chunk)]
+                    for key, part in parts:
+                        part = part.reset_index(drop=True)
+                        payload = render_ping_frame(part, index, rid_next, lookups, cur, binary, m)
+                        # rows of new venues and codes must be visible to the writer's connections
+                        with m.stage('commit'):
+                            raw_conn.commit()
+                            lookups.commit()
+                        writer.submit(payload, len(part), tag=f, key=key)
+                        st['pending'] = st['pending'] + 1
+                        rid_next = rid_next + len(part)
+                    finish(writer.completed())
+                    if st['error'] is not None:
+                        break
+            except Exception as e:
+                # missing or corrupt files (OSError, EOFError, parser errors)
+                # fail this file only, like a failed batch
+                raw_conn.rollback()
+                lookups.rollback()
+                st['error'] = e
+            m.stop()
+            st['read'] = True
+            if st['pending'] == 0:
+                close_file(f)
+
+            num_files_read = num_files_read + 1
+            if num_files_read == num_files:
+                break
+    finally:
+        finish(writer.close())
+
+    if failed:
+        logging.info(f"\tremoving {len(failed)} records from {fileManager.files_to_process_path}")
+        fileManager.files_to_process = fileManager.files_to_process.drop(fileManager.files_to_process.index[failed])
+    fileManager.update_file_list()
+    raw_conn.close()
+
+    t_end = time.perf_counter()
+    logging.info(f"Pooled load complete: {t_end-t_start:0.4f} seconds")
+    writer.report()
+
+
+# pings columns the row-by-row loaders fill; tz_name and cell stay NULL
+legacy_ping_columns = ['id','device_id','location_at','timestamp','latitude','longitude','altitude',
+                       'horizontal_accuracy','vertical_accuracy','heading','speed','ipv_4','ipv_6',
+                       'final_country','user_agent','background','publisher_id','wifi_ssid','wifi_bssid',
+                       'venue_id','dwell_time','source']
+
+def check_legacy_loader(name):
+    # the row-by-row loaders write advertiser ids and strings as they are read
+    if integer_device_keys or encode_ping_strings:
+        raise ValueError(f"{name} writes raw advertiser ids and strings, it needs integer_device_keys and encode_ping_strings off")
+
+def init_ping_table2(fileList, index=0):
+    check_legacy_loader('init_ping_table2')
     venue_tab = get_venue_table()
     tf = TimezoneFinder()
 
@@ -280,6 +973,8 @@ def init_ping_table2(fileList):
     cur = raw_conn.cursor()
     cur.execute('SELECT version()')
     print(cur.fetchone()[0])
+    init_rid_allocator(cur)
+    raw_conn.commit()
 
 
     t1 = time.perf_counter()
@@ -287,15 +982,14 @@ def init_ping_table2(fileList):
     inFile = fileList[0]
     inds = {}
 
-    # Text output object
-    output = io.StringIO()
-    writer = csv.writer(output)
+    # rows without their id, which is drawn once the row count is known
+    rows = []
 
     data_to_insert = []
     c = 0
-    with gzip.open(inFile, 'rt') as f:
-        # csv_reader = csv.reader(f,escapechar='\\')
-        csv_reader = csv.reader((x.replace('\0', '') for x in f), escapechar='\\')
+    # NULs, tabs and escaped line breaks are cleaned up in blocks before parsing
+    with sanitize.open_sanitized(inFile, 'rt') as f:
+        csv_reader = csv.reader(f, escapechar='\\')
         for line in csv_reader:
             if c == 0:
                 inds = get_header_index(line)
@@ -373,51 +1067,49 @@ def init_ping_table2(fileList):
                         if heading == '':
                             heading = 'Null'
                         else:
-                            heading = heading.replace('\t',' ').strip()
+                            heading = heading.strip()
 
                         if ipv_4 == '':
                             ipv_4 = 'Null'
                         else:
-                            ipv_4 = ipv_4.replace('\t',' ').strip()
+                            ipv_4 = ipv_4.strip()
 
                         if ipv_6 == '':
                             ipv_6 = 'Null'
                         else:
-                            ipv_6 = ipv_6.replace('\t', ' ').strip()
+                            ipv_6 = ipv_6.strip()
 
                         if final_country == '':
                             final_country = 'Null'
                         else:
-                            final_country = final_country.replace('\t',' ').strip()
+                            final_country = final_country.strip()
 
                         if user_agent == '':
                             user_agent = 'Null'
                         else:
-                            user_agent = user_agent.replace('\t', ' ').strip()
+                            user_agent = user_agent.strip()
 
                         if background == '':
                             background = 'Null'
                         else:
-                            background = background.replace('\t', ' ').strip()
+                            background = background.strip()
 
                         if publisher_id == '':
                             publisher_id = 'Null'
                         else:
-                            publisher_id = publisher_id.replace('\t', ' ').strip()
+                            publisher_id = publisher_id.strip()
 
                         if wifi_ssid == '':
                             wifi_ssid = 'Null'
                         else:
-                            wifi_ssid = wifi_ssid.replace('\t', ' ')
                             wifi_ssid = wifi_ssid.strip()
 
                         if wifi_bssid == '':
                             wifi_bssid = 'Null'
                         else:
-                            wifi_bssid = wifi_bssid.replace('\t', ' ').strip()
+                            wifi_bssid = wifi_bssid.strip()
 
                         temp_dat = [
-                            c,
                             advertiser_id,
                             location_at,
                             timestamp,
@@ -437,14 +1129,15 @@ def init_ping_table2(fileList):
                             wifi_ssid,
                             wifi_bssid,
                             venue_id,
-                            dwell_time
+                            dwell_time,
+                            index
                         ]
 
                         out = str(temp_dat[0])
                         for i in range(1,len(temp_dat)-1):
                             out = out + "\t" + str(temp_dat[i])
                         out = out + '\t' + str(temp_dat[-1]) + "\n"
-                        output.write(out)
+                        rows.append(out)
                         #print(repr(out))
                         #writer.writerow(test)
 
@@ -466,10 +1159,10 @@ def init_ping_table2(fileList):
                 #break
 
     # final commit
-    output.seek(0)
-    contents = output.getvalue()
-    #print(repr(contents))
-    test = cur.copy_from(output, 'pings', sep='\t', null='Null')
+    rid_start = allocate_rids(cur, len(rows))
+    raw_conn.commit()
+    output = io.StringIO(''.join(f"{rid_start + i}\t{r}" for i, r in enumerate(rows)))
+    test = cur.copy_from(output, 'pings', sep='\t', null='Null', columns=legacy_ping_columns)
     # Commit inserts to DB
     raw_conn.commit()
 
@@ -479,19 +1172,36 @@ def init_ping_table2(fileList):
 
 
 
-def init_ping_table_temp(fileList):
+def commit_ping_batch(batch):
+    # gives the batch's pings consecutive ids, then inserts them
+    if not batch:
+        return
+    cur = session.connection().connection.cursor()
+    rid_start = allocate_rids(cur, len(batch))
+    for i, ping in enumerate(batch):
+        ping.id = rid_start + i
+    session.add_all(batch)
+    session.commit()
+
+def init_ping_table_temp(fileList, index=0):
+    check_legacy_loader('init_ping_table_temp')
 
     venue_tab = get_venue_table()
     tf = TimezoneFinder()
+    # ids are drawn from rid_allocator through the session's connection
+    cur = session.connection().connection.cursor()
+    init_rid_allocator(cur)
+    session.commit()
+    batch = []
 
     t1 = time.perf_counter()
     #assumption: first row of data must be header
     inFile = fileList[0]
     inds = {}
     c = 0
-    with gzip.open(inFile, 'rt') as f:
-        # csv_reader = csv.reader(f,escapechar='\\')
-        csv_reader = csv.reader((x.replace('\0', '') for x in f), escapechar='\\')
+    # NULs, tabs and escaped line breaks are cleaned up in blocks before parsing
+    with sanitize.open_sanitized(inFile, 'rt') as f:
+        csv_reader = csv.reader(f, escapechar='\\')
         for line in csv_reader:
             if c == 0:
                 inds = get_header_index(line)
@@ -606,10 +1316,11 @@ def init_ping_table_temp(fileList):
                             wifi_ssid = wifi_ssid,
                             wifi_bssid = wifi_bssid,
                             venue_id = venue_id,
-                            dwell_time = dwell_time
+                            dwell_time = dwell_time,
+                            source = index
 
                         )
-                        session.add(ping)
+                        batch.append(ping)
 
                     except UnknownTimeZoneError:
                         print("Time zone error")
@@ -623,12 +1334,13 @@ def init_ping_table_temp(fileList):
             #commit in batches of 1000
             c = c + 1
             if c % 5000 == 0:
-                session.commit()
+                commit_ping_batch(batch)
+                batch = []
                 print(str(c))
                 #break
 
     #final commit
-    session.commit()
+    commit_ping_batch(batch)
     t2 = time.perf_counter()
     print(f"Time {t2-t1:0.4f} seconds")
 
@@ -638,6 +1350,15 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--loglevel', type=str)
     parser.add_argument('--num_files', type=int)
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--chunksize', type=int, default=0)
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--binary', action='store_true')
+    parser.add_argument('--partitioned', action='store_true')
+    parser.add_argument('--bulk_load', action='store_true')
+    parser.add_argument('--manifest', action='store_true')
+    parser.add_argument('--connections', type=int, default=0, help='COPY over this many pooled connections')
+    parser.add_argument('--route', type=str, default='rid', choices=['rid', 'partition'])
     args = parser.parse_args(['--loglevel', 'info','--num_files','2'])
     utils.initLogger(args)
 
@@ -651,14 +1372,29 @@ def main():
     #files = glob.glob(xmode_dir + '/**/*.gz', recursive=True)
 
     #create table metadata
-    Base.metadata.create_all(engine)
+    schema.create_schema(engine, partitioned=args.partitioned)
+    if args.bulk_load:
+        # indexes and foreign keys are rebuilt in parallel once loading is done
+        schema.drop_ping_constraints(engine)
 
     #initialize tables
     #init_venue_tables()
     #init_device_tables()
 
 
-    init_ping_table3(fileManager,num_files)
+    if args.connections > 1:
+        init_ping_table_pooled(fileManager,num_files,args.connections,args.chunksize,args.binary,args.route)
+    elif args.manifest:
+        init_ping_table_manifest(fileManager,num_files,args.num_workers,args.chunksize,args.binary)
+    elif args.num_workers > 1:
+        init_ping_table_parallel(fileManager,num_files,args.num_workers,args.binary)
+    elif args.pipeline:
+        init_ping_table_pipelined(fileManager,num_files,args.chunksize,binary=args.binary)
+    else:
+        init_ping_table3(fileManager,num_files,args.chunksize,args.binary)
+
+    if args.bulk_load:
+        schema.rebuild_ping_constraints(engine)
 
 
 
@@ -0,0 +1,39 @@
+from venues import VenueCache
+from devices import DeviceCache
+from dictionaries import CodeCache
+from utils import ping_dictionaries
+
+# Dimension lookups shared by the ping loaders. New venues, devices and
+# dictionary encoded values found in a file are registered in the loader's transaction, so commit() and
+# rollback() follow the connection.
+class PingLookups():
+    def __init__(self, venues=None, devices=None):
+        self.venues = venues or VenueCache({})
+        self.devices = devices or DeviceCache()
+        # column -> CodeCache, empty unless encode_ping_strings is set
+        self.codes = {c: CodeCache(c) for c in ping_dictionaries}
+
+    def load(self, session):
+        self.venues.load(session)
+        self.devices.load(session)
+        for c in self.codes.values():
+            c.load(session)
+        return(self)
+
+    def commit(self):
+        self.venues.commit()
+        self.devices.commit()
+        for c in self.codes.values():
+            c.commit()
+
+    def rollback(self):
+        self.venues.rollback()
+        self.devices.rollback()
+        for c in self.codes.values():
+            c.rollback()
+
+    def string_type(self, column):
+        # binary COPY type of a ping string column as stored in pings
+        if column in self.codes:
+            return(self.codes[column].pg_type)
+        return('text')
@@ -0,0 +1,118 @@
+import logging
+import os
+from sqlalchemy import Table, Column, Integer, BigInteger, String, DateTime
+from utils import Base
+
+#---
+# Ingestion manifest
+#
+# Database-backed replacement for files_to_process.csv/error_files.csv. Each
+# file's progress is written by the loader in the same transaction as the COPY
+# it describes, so a crash never loses or double counts a chunk. Workers claim
+# files with SELECT ... FOR UPDATE SKIP LOCKED; a claim whose heartbeat is older
+# than stale_after is considered abandoned and can be claimed again, resuming
+# at rows_done. Resuming parses the file from the start and drops its first
+# rows_done rows: the parser reads ahead of the rows it returns, so there is
+# no byte offset of a chunk's end to seek to, and counting parsed rows rather
+# than lines keeps quoted line breaks from shifting the rows.
+
+PENDING = 0
+DONE = 1
+RUNNING = 2
+FAILED = -1
+
+ingest_manifest = Table('ingest_manifest', Base.metadata,
+                        Column('id', Integer, primary_key=True),
+                        Column('path', String, nullable=False),
+                        Column('status', Integer, nullable=False, default=PENDING),
+                        Column('rid_start', BigInteger, nullable=True),
+                        Column('nrow', BigInteger, nullable=True),
+                        Column('rows_done', BigInteger, nullable=False, default=0),
+                        Column('claimed_by', String, nullable=True),
+                        Column('heartbeat', DateTime(timezone=True), nullable=True),
+                        Column('error', String, nullable=True)
+                  )
+
+def worker_name(n=0):
+    return(f"{os.uname().nodename}:{os.getpid()}:{n}")
+
+def seed_from_file_list(cur, fileManager):
+    # copies files_to_process.csv into the manifest; files already known keep
+    # their state. Returns the number of new files.
+    rows = [
+        (int(r['index']), r['path'], int(r['status']), int(r['nrow']) if r['status'] == DONE else None)
+        for _, r in fileManager.files_to_process.iterrows()
+    ]
+    cur.executemany(
+        "INSERT INTO ingest_manifest (id, path, status, nrow, rows_done) VALUES (%s, %s, %s, %s, 0) ON CONFLICT (id) DO NOTHING",
+        rows
+    )
+    cur.execute("SELECT count(*) FROM ingest_manifest")
+    return(cur.fetchone()[0])
+
+def claim(cur, worker, stale_after='15 minutes'):
+    # returns (id, path, rid_start, rows_done) or None; commits
+    cur.execute("""
+        UPDATE ingest_manifest SET status = %s, claimed_by = %s, heartbeat = now()
+        WHERE id = (
+            SELECT id FROM ingest_manifest
+            WHERE status = %s OR (status = %s AND heartbeat < now() - %s::interval)
+            ORDER BY id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id, path, rid_start, rows_done
+    """, (RUNNING, worker, PENDING, RUNNING, stale_after))
+    row = cur.fetchone()
+    cur.connection.commit()
+    return(row)
+
+def checkpoint(cur, file_id, worker, rid_start, rid_end, rows_done):
+    # call inside the chunk's COPY transaction, before commit. Fails if the
+    # claim was taken over by another worker, so the chunk is rolled back.
+    cur.execute("""
+        UPDATE ingest_manifest
+        SET rid_start = coalesce(rid_start, %s), nrow = %s, rows_done = %s, heartbeat = now()
+        WHERE id = %s AND claimed_by = %s AND status = %s
+    """, (rid_start, rid_end, rows_done, file_id, worker, RUNNING))
+    if cur.rowcount != 1:
+        raise LookupError(f"manifest claim on file {file_id} lost by {worker}")
+
+def finish(cur, file_id, worker):
+    cur.execute(
+        "UPDATE ingest_manifest SET status = %s, claimed_by = NULL WHERE id = %s AND claimed_by = %s",
+        (DONE, file_id, worker)
+    )
+    cur.connection.commit()
+
+def fail(cur, file_id, worker, error):
+    # failed files stay in the manifest with their progress for a later retry
+    cur.execute(
+        "UPDATE ingest_manifest SET status = %s, claimed_by = NULL, error = %s WHERE id = %s AND claimed_by = %s",
+        (FAILED, str(error), file_id, worker)
+    )
+    cur.connection.commit()
+
+def retry_failed(cur):
+    cur.execute("UPDATE ingest_manifest SET status = %s, error = NULL WHERE status = %s", (PENDING, FAILED))
+    n = cur.rowcount
+    cur.connection.commit()
+    return(n)
+
+def export_file_list(cur, fileManager):
+    # mirror the manifest back into files_to_process.csv/error_files.csv
+    cur.execute("SELECT id, path, status, coalesce(nrow, 0) FROM ingest_manifest ORDER BY id")
+    rows = cur.fetchall()
+    tab = fileManager.files_to_process
+    done = {r[0]: r for r in rows if r[2] == DONE}
+    for f in range(0, tab.shape[0]):
+        r = done.get(int(tab.iloc[f,0]))
+        if r is not None:
+            tab.iloc[f,2] = DONE
+            tab.iloc[f,3] = r[3]
+    known = set(fileManager.file_errors['index'])
+    for r in rows:
+        if r[2] == FAILED and r[0] not in known:
+            fileManager.add_file_error(r[0], r[1])
+    fileManager.update_file_list()
+    logging.info(f"\tmanifest: {len(done)} of {len(rows)} files done")
@@ -0,0 +1,200 @@
+import cProfile
+import json
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from sqlalchemy import Table, Column, Integer, BigInteger, String, Float, DateTime
+from utils import Base
+from config import metrics_path, metrics_table, profile_dir
+
+#---
+# Per-file ingestion metrics
+#
+# A FileMetrics collects rows, bytes, seconds and the process's RSS high-water
+# mark (ru_maxrss, not the stage's own peak: it never goes down) at the end of
+# each named stage of one file: decompress, sanitize, parse, clean, prepare (rid
+# ranges, partitions), map (device, venue and code lookups, timezones,
+# cells), serialize, copy and commit. Time
+# spent in a stage nested inside another (decompression happens inside
+# parsing) is subtracted from the outer one, so stage times add up to the
+# file's time. Loaders write finished files through write_metrics as JSON
+# lines (metrics_path) and/or rows of ingest_metrics (metrics_table), after
+# the file's data is committed so the commit stage is among them.
+#
+# With profile_dir set every file is also run under cProfile and its stats
+# dumped to <profile_dir>/<index>.prof, e.g. for
+#   python -m pstats <profile_dir>/12.prof
+
+ingest_metrics = Table('ingest_metrics', Base.metadata,
+                       Column('id', Integer, primary_key=True),
+                       Column('recorded_at', DateTime(timezone=True), nullable=False),
+                       Column('host', String, nullable=False),
+                       Column('pid', Integer, nullable=False),
+                       Column('file_index', Integer, nullable=True),
+                       Column('path', String, nullable=True),
+                       Column('stage', String, nullable=False),
+                       Column('rows', BigInteger, nullable=False),
+                       Column('bytes', BigInteger, nullable=False),
+                       Column('seconds', Float, nullable=False),
+                       Column('process_peak_rss_mb', Float, nullable=False)
+                 )
+
+def peak_rss_mb():
+    # high-water mark of this process, ru_maxrss is in KiB on Linux
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+def current_rss_mb():
+    # resident size now, the high-water mark where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20)
+    except OSError:
+        return(peak_rss_mb())
+
+class FileMetrics():
+    def __init__(self, index=None, path=None):
+        self.index = index
+        self.path = path
+        self.stages = {}
+        self._nested = []
+        self._profiler = None
+        # largest resident size seen at the end of a stage of this file
+        self.rss_mb = 0.0
+
+    def add(self, name, rows=0, nbytes=0, seconds=0.0):
+        s = self.stages.setdefault(name, {'rows': 0, 'bytes': 0, 'seconds': 0.0, 'process_peak_rss_mb': 0.0})
+        s['rows'] = s['rows'] + rows
+        s['bytes'] = s['bytes'] + nbytes
+        s['seconds'] = s['seconds'] + seconds
+        s['process_peak_rss_mb'] = max(s['process_peak_rss_mb'], peak_rss_mb())
+        self.rss_mb = max(self.rss_mb, current_rss_mb())
+        if self._nested:
+            self._nested[-1] = self._nested[-1] + seconds
+
+    @contextmanager
+    def stage(self, name, rows=0, nbytes=0):
+        # rows and bytes may also be added to the stage afterwards with add()
+        self._nested.append(0.0)
+        t1 = time.perf_counter()
+        try:
+            yield self
+        finally:
+            seconds = time.perf_counter() - t1
+            nested = self._nested.pop()
+            self.add(name, rows, nbytes, seconds - nested)
+            if self._nested:
+                self._nested[-1] = self._nested[-1] + nested
+
+    def start(self):
+        if profile_dir is not None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return(self)
+
+    def stop(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(os.path.join(profile_dir, f"{self.index}.prof"))
+            self._profiler = None
+
+    def total(self):
+        return(sum(s['seconds'] for s in self.stages.values()))
+
+    def records(self):
+        now = datetime.now(timezone.utc)
+        host = os.uname().nodename
+        return([
+            dict(recorded_at=now, host=host, pid=os.getpid(), file_index=self.index, path=self.path, stage=name, **s)
+            for name, s in self.stages.items()
+        ])
+
+    def summary(self):
+        stages = '\t'.join(f"{name}: {s['seconds']:0.4f}s" for name, s in self.stages.items())
+        return(f"{stages}\trss: {self.rss_mb:0.0f} MB")
+
+@contextmanager
+def stage(metrics, name, rows=0, nbytes=0):
+    # FileMetrics.stage, or nothing when metrics is None
+    if metrics is None:
+        yield None
+    else:
+        with metrics.stage(name, rows, nbytes) as m:
+            yield m
+
+def timed_chunks(metrics, chunks, name='parse'):
+    # times each step of a chunk iterator as a stage, counting its rows
+    it = iter(chunks)
+    while True:
+        with stage(metrics, name) as m:
+            try:
+                chunk = next(it)
+            except StopIteration:
+                return
+            if m is not None:
+                m.add(name, rows=len(chunk))
+        yield chunk
+
+class TimedReader():
+    # binary file object wrapper charging read() time and bytes to a stage,
+    # e.g. around gzip.open so decompression is told apart from parsing
+    mode = 'rb'
+
+    def __init__(self, f, metrics, name='decompress'):
+        self.f = f
+        self.metrics = metrics
+        self.name = name
+
+    def _timed(self, fn, *args):
+        t1 = time.perf_counter()
+        data = fn(*args)
+        n = data if isinstance(data, int) else len(data)
+        self.metrics.add(self.name, nbytes=n, seconds=time.perf_counter() - t1)
+        return(data)
+
+    def read(self, size=-1):
+        return(self._timed(self.f.read, size))
+
+    def read1(self, size=-1):
+        return(self._timed(self.f.read1, size))
+
+    def readinto(self, b):
+        return(self._timed(self.f.readinto, b))
+
+    def __iter__(self):
+        return(iter(self.f))
+
+    def __getattr__(self, name):
+        return(getattr(self.f, name))
+
+def write_metrics(records, cur=None):
+    # records: list of FileMetrics.records(); the table rows are written
+    # through cur and committed with the caller's transaction
+    if not records:
+        return
+    if metrics_path is not None:
+        # one append per call, so lines from parallel workers do not interleave
+        lines = ''.join(json.dumps(dict(r, recorded_at=r['recorded_at'].isoformat())) + '\n' for r in records)
+        fd = os.open(metrics_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode())
+        finally:
+            os.close(fd)
+    if metrics_table and cur is not None:
+        cur.executemany(
+            "INSERT INTO ingest_metrics (recorded_at, host, pid, file_index, path, stage, rows, bytes, seconds, process_peak_rss_mb) "
+            "VALUES (%(recorded_at)s, %(host)s, %(pid)s, %(file_index)s, %(path)s, %(stage)s, %(rows)s, %(bytes)s, %(seconds)s, %(process_peak_rss_mb)s)",
+            records
+        )
+
+def commit_metrics(records, conn):
+    # writes records in a transaction of their own, once the data they
+    # describe is committed; losing them does not fail the load
+    try:
+        write_metrics(records, conn.cursor())
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logging.warning(f"\tmetrics not written: {e}")
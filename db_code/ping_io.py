@@ -0,0 +1,188 @@
+import hashlib
+import os.path
+import numpy as np
+import pandas as pd
+import logging
+import storage
+import sanitize
+from config import ping_dtypes, compact_ping_dtypes, compact_ping_reads, ping_memory_budget_mb, sanitize_ping_files, staging_dir
+from metrics import TimedReader, current_rss_mb
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+#---
+# Reading raw X-Mode ping files
+#
+# read_ping_file is the single entry point used by the loaders. When
+# staging_dir is set and holds a current Parquet copy of a file (see
+# staging.py), the typed, already cleaned copy is read instead of parsing
+# the gzip CSV again. s3:// paths are streamed from object storage (see
+# storage.py) and, with sanitize_ping_files, cleaned of NUL bytes, tabs and
+# escaped line breaks on the way (see sanitize.py).
+#
+# With compact_ping_reads, raw files are read with compact_ping_dtypes, and
+# with ping_memory_budget_mb set chunked reads pick each chunk's size from
+# the measured size of the rows read so far and the process's resident size.
+
+# resident bytes a chunk needs per byte of its frame: the frame, its mapped
+# copy and its rendered COPY payload are alive at the same time
+chunk_memory_factor = 4
+min_chunk_rows = 10000
+
+def read_raw_ping_file(inFile, chunksize=None, skiprows=0, metrics=None, compact=compact_ping_reads):
+    # with chunksize set this returns an iterator of DataFrames, of adaptive
+    # size under ping_memory_budget_mb; the first skiprows data rows are
+    # dropped. They are parsed and dropped rather than skipped as lines, so
+    # rows line up with an earlier read of the file whatever quoted line
+    # breaks they contain. With metrics, reads of the decompressed stream are
+    # charged to its decompress stage.
+    dtypes = compact_ping_dtypes if compact else ping_dtypes
+    source, opened = _open_source(inFile, metrics)
+    dat = pd.read_csv(
+        source,
+        usecols = [e for e in dtypes],
+        dtype = dtypes,
+        escapechar="\\",
+        chunksize = chunksize
+    )
+    if chunksize and ping_memory_budget_mb is not None:
+        dat = _budgeted_chunks(dat, chunksize, ping_memory_budget_mb)
+    if skiprows:
+        if chunksize:
+            dat = _skip_chunk_rows(dat, skiprows)
+        else:
+            dat = dat.iloc[skiprows:].reset_index(drop=True)
+    if opened:
+        if chunksize:
+            return(_closing(dat, source))
+        source.close()
+    return(dat)
+
+def _open_source(inFile, metrics=None):
+    # what read_csv reads a raw file from, and whether it was opened here
+    if not (metrics is not None or sanitize_ping_files or storage.is_remote(inFile)):
+        return(inFile, False)
+    source = storage.open_file(inFile)
+    if metrics is not None:
+        source = TimedReader(source, metrics)
+    if sanitize_ping_files:
+        source = sanitize.sanitized(source, metrics=metrics)
+    return(source, True)
+
+def read_ping_times(inFile, chunksize=1000000):
+    # iterator of the location_at column alone, for passes over a file that
+    # only need its times (e.g. creating partitions before a streamed COPY)
+    if staging_dir is not None and pq is not None:
+        staged = staged_path(inFile, staging_dir)
+        if is_current(inFile, staged):
+            return(read_staged(staged, chunksize, columns=['location_at']))
+    source, opened = _open_source(inFile)
+    dat = pd.read_csv(
+        source,
+        usecols = ['location_at'],
+        dtype = {'location_at': ping_dtypes['location_at']},
+        escapechar="\\",
+        chunksize = chunksize
+    )
+    if opened:
+        return(_closing(dat, source))
+    return(dat)
+
+def _budgeted_chunks(reader, chunksize, budget_mb):
+    # rows per chunk = the budget left over by everything but the last chunk,
+    # divided by the resident bytes a row needs; starts at chunksize
+    rows = chunksize
+    per_row = 0.0
+    while True:
+        try:
+            chunk = reader.get_chunk(rows)
+        except StopIteration:
+            return
+        if len(chunk) == 0:
+            continue
+        frame_mb = chunk.memory_usage(deep=True).sum() / 2**20
+        per_row = max(per_row, frame_mb / len(chunk))
+        yield chunk
+        # the consumer may still hold the chunk it was given
+        other_mb = current_rss_mb() - frame_mb
+        rows = int(max((budget_mb - other_mb) / (per_row * chunk_memory_factor), min_chunk_rows))
+        logging.debug(f"\tchunk of {len(chunk)} rows, {frame_mb:0.1f} MB, rss {other_mb + frame_mb:0.0f} MB, next chunk {rows} rows")
+
+def _skip_chunk_rows(chunks, skiprows):
+    for chunk in chunks:
+        if skiprows >= len(chunk):
+            skiprows = skiprows - len(chunk)
+            continue
+        if skiprows:
+            chunk = chunk.iloc[skiprows:].reset_index(drop=True)
+            skiprows = 0
+        yield chunk
+
+def _closing(chunks, f):
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        f.close()
+
+def read_ping_file(inFile, chunksize=None, skiprows=0, metrics=None):
+    if staging_dir is not None and pq is not None:
+        staged = staged_path(inFile, staging_dir)
+        if is_current(inFile, staged):
+            return(read_staged(staged, chunksize, skiprows))
+    return(read_raw_ping_file(inFile, chunksize, skiprows, metrics))
+
+def clean_ping_frame(dat):
+    # string formatting
+    dat['wifi_ssid'] = dat['wifi_ssid'].str.replace('"', '')
+    # line breaks inside quoted fields get past the byte-level sanitizer
+    dat['wifi_ssid'] = dat['wifi_ssid'].str.replace('\n', ' ', regex=False)
+    dat['wifi_ssid'] = dat['wifi_ssid'].str.strip()
+    dat['wifi_ssid'] = dat['wifi_ssid'].replace('<unknown ssid>', np.nan)
+    dat['wifi_bssid'] = dat['wifi_bssid'].replace('<unknown bssid>', np.nan)
+    #dat.replace(r'^\s*$', np.nan, regex=True, inplace=True)
+    return(dat)
+
+#---
+# Parquet staging cache
+
+def staged_path(inFile, staging_dir):
+    # part files of different prefixes or days can share a name, so the name
+    # carries a short hash of the full source path
+    source = inFile if storage.is_remote(inFile) else os.path.abspath(inFile)
+    digest = hashlib.sha1(source.encode()).hexdigest()[:12]
+    name = os.path.basename(inFile)
+    for ext in ('.gz', '.csv'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return(os.path.join(staging_dir, f"{name}-{digest}.parquet"))
+
+def is_current(inFile, staged):
+    # a staged copy is current if it was written from the file's present
+    # size and mtime
+    if not os.path.exists(staged):
+        return(False)
+    meta = pq.read_metadata(staged).metadata or {}
+    size, mtime = storage.stat(inFile)
+    return(meta.get(b'source_size') == str(size).encode() and
+           meta.get(b'source_mtime') == repr(mtime).encode())
+
+def read_staged(staged, chunksize=None, skiprows=0, columns=None):
+    # columns projects the read down to the named columns
+    pf = pq.ParquetFile(staged)
+    if not chunksize:
+        dat = pf.read(columns=columns).to_pandas()
+        return(dat.iloc[skiprows:].reset_index(drop=True))
+    return(_iter_staged(pf, chunksize, skiprows, columns))
+
+def _iter_staged(pf, chunksize, skiprows, columns):
+    for batch in pf.iter_batches(batch_size=chunksize, columns=columns):
+        if skiprows >= batch.num_rows:
+            skiprows = skiprows - batch.num_rows
+            continue
+        dat = batch.slice(skiprows).to_pandas()
+        skiprows = 0
+        yield dat
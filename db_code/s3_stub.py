@@ -0,0 +1,64 @@
+import io
+import os
+import os.path
+from datetime import datetime, timezone
+
+#---
+# Local stand-in for the boto3 s3 client
+#
+# Serves <root>/<bucket>/<key> files through the calls storage.py makes
+# (head_object, ranged get_object, list_objects_v2 with continuation tokens),
+# so s3:// loading can be run against a directory by setting
+#   s3_endpoint_url = 'file:///path/to/root'
+# in config.py. Every GET is counted in .requests.
+
+class StubClientError(Exception):
+    # shaped like botocore.exceptions.ClientError
+    def __init__(self, code, message=''):
+        super().__init__(f"{code}: {message}")
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+class DirectoryClient():
+    def __init__(self, root, page_size=1000):
+        self.root = root
+        self.page_size = page_size
+        self.requests = 0
+
+    def _path(self, bucket, key):
+        path = os.path.join(self.root, bucket, key)
+        if not os.path.isfile(path):
+            raise StubClientError('NoSuchKey', f"{bucket}/{key}")
+        return(path)
+
+    def head_object(self, Bucket, Key):
+        st = os.stat(self._path(Bucket, Key))
+        return({'ContentLength': st.st_size, 'LastModified': datetime.fromtimestamp(st.st_mtime, timezone.utc)})
+
+    def get_object(self, Bucket, Key, Range=None):
+        path = self._path(Bucket, Key)
+        self.requests = self.requests + 1
+        with open(path, 'rb') as f:
+            if Range is None:
+                data = f.read()
+            else:
+                start, end = Range[len('bytes='):].split('-')
+                f.seek(int(start))
+                data = f.read(int(end) - int(start) + 1)
+        return({'Body': io.BytesIO(data), 'ContentLength': len(data)})
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=None):
+        base = os.path.join(self.root, Bucket)
+        keys = []
+        for dirpath, _, files in os.walk(base):
+            for name in files:
+                key = os.path.relpath(os.path.join(dirpath, name), base).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    keys.append(key)
+        keys.sort()
+        start = int(ContinuationToken or 0)
+        end = start + (MaxKeys or self.page_size)
+        out = {'Contents': [{'Key': k, 'Size': os.path.getsize(os.path.join(base, k))} for k in keys[start:end]],
+               'IsTruncated': end < len(keys)}
+        if end < len(keys):
+            out['NextContinuationToken'] = str(end)
+        return(out)
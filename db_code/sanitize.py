@@ -0,0 +1,110 @@
+import io
+import time
+import storage
+from config import sanitize_block_size
+
+#---
+# Byte-level cleanup of raw ping files
+#
+# Some part files carry NUL bytes (which end a field early in pandas' C
+# parser), tabs inside free text fields (which end a field early in text
+# COPY) and backslash-escaped line breaks inside fields (which end a row
+# early in text COPY). SanitizingReader fixes all three on large decompressed
+# blocks before any parser sees them: NULs are dropped, tabs become spaces and
+# an escaped line break becomes a space. The files are comma separated, so a
+# tab is never a delimiter. A line break is escaped when an odd run of
+# backslashes precedes it. Only bytes.count/replace/find run over the block,
+# Python code only runs per escaped line break.
+
+class SanitizingReader(io.RawIOBase):
+    # read-only stream over the cleaned bytes of binary stream f. With metrics
+    # the cleanup time is charged to its sanitize stage.
+    def __init__(self, f, block_size=sanitize_block_size, metrics=None):
+        self.f = f
+        self.block_size = block_size
+        self.metrics = metrics
+        self.block = memoryview(b'')
+        self.carry = b''
+        self.eof = False
+        self.nul_bytes = 0
+        self.tabs = 0
+        self.line_breaks = 0
+
+    def readable(self):
+        return True
+
+    def _clean(self, block):
+        n = block.count(b'\x00')
+        if n:
+            block = block.replace(b'\x00', b'')
+            self.nul_bytes = self.nul_bytes + n
+        n = block.count(b'\t')
+        if n:
+            block = block.replace(b'\t', b' ')
+            self.tabs = self.tabs + n
+        edits = []
+        for brk in (b'\\\n', b'\\\r\n'):
+            i = block.find(brk)
+            while i >= 0:
+                # length of the backslash run ending at i
+                j = i
+                while j > 0 and block[j - 1] == 92:
+                    j = j - 1
+                if (i - j) % 2 == 0:
+                    edits.append((i, i + len(brk)))
+                i = block.find(brk, i + len(brk))
+        if edits:
+            parts = []
+            last = 0
+            for i, k in sorted(edits):
+                parts.append(block[last:i])
+                parts.append(b' ')
+                last = k
+            parts.append(block[last:])
+            block = b''.join(parts)
+            self.line_breaks = self.line_breaks + len(edits)
+        return(block)
+
+    def _next_block(self):
+        while not self.eof:
+            data = self.f.read(self.block_size)
+            t1 = time.perf_counter()
+            self.eof = not data
+            block = self.carry + data
+            self.carry = b''
+            if not self.eof:
+                # hold back trailing backslashes, CRs and NULs until the next
+                # block shows whether they escape a line break
+                end = len(block.rstrip(b'\\\r\x00'))
+                block, self.carry = block[:end], block[end:]
+            block = self._clean(block)
+            if self.metrics is not None:
+                self.metrics.add('sanitize', nbytes=len(data), seconds=time.perf_counter() - t1)
+            if block:
+                self.block = memoryview(block)
+                return(True)
+        return(False)
+
+    def readinto(self, b):
+        if not len(self.block) and not self._next_block():
+            return 0
+        n = min(len(b), len(self.block))
+        b[:n] = self.block[:n]
+        self.block = self.block[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+        super().close()
+
+def sanitized(f, block_size=sanitize_block_size, metrics=None):
+    # buffered binary stream of f's cleaned bytes
+    return(io.BufferedReader(SanitizingReader(f, block_size, metrics), buffer_size=1 << 20))
+
+def open_sanitized(path, mode='rb', metrics=None):
+    # cleaned, decompressed binary ('rb') or text ('rt') stream of a ping file
+    f = sanitized(storage.open_file(path), metrics=metrics)
+    if mode == 'rt':
+        return(io.TextIOWrapper(f, encoding='utf-8'))
+    return(f)
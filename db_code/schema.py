@@ -0,0 +1,225 @@
+import logging
+import time
+import zlib
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from sqlalchemy import Table, Column, String
+from sqlalchemy.schema import CreateIndex
+from utils import Base, Pings, ping_dictionaries
+from dictionaries import pings_text_view
+from config import ping_partition_interval
+
+#---
+# Schema management for the pings table
+#
+# With partitioned=True, pings is a range-partitioned table on location_at
+# (epoch seconds) with one partition per ping_partition_interval. Partitions
+# are created on demand by the loaders through ensure_partitions (loaders that
+# stream a whole file into one COPY create the file's partitions beforehand),
+# and a default partition catches rows no partition exists for yet; those rows
+# are moved out when their partition is created later.
+# Queries with a location_at predicate only scan the matching partitions.
+
+PARTITION_LOCK = zlib.crc32(b'pings_partitions')
+
+# definitions of indexes/constraints dropped for a bulk load, kept in the
+# database so an interrupted load can still rebuild them
+deferred_ddl = Table('deferred_ddl', Base.metadata,
+                     Column('name', String, primary_key=True),
+                     Column('kind', String, nullable=False),
+                     Column('definition', String, nullable=False)
+               )
+
+_partition_state = {'partitioned': None, 'known': set()}
+
+# idempotent DDL bringing tables created by earlier versions up to the models,
+# create_all never alters a table that already exists
+migrations = [
+    "ALTER TABLE IF EXISTS ingest_manifest DROP COLUMN IF EXISTS bytes_done",
+    "ALTER TABLE IF EXISTS pings ADD COLUMN IF NOT EXISTS tz_name varchar",
+    "ALTER TABLE IF EXISTS pings ADD COLUMN IF NOT EXISTS cell bigint",
+    # existing devices are numbered by the column default as it is added
+    "CREATE SEQUENCE IF NOT EXISTS device_key_seq",
+    "ALTER TABLE IF EXISTS device ADD COLUMN IF NOT EXISTS key integer NOT NULL DEFAULT nextval('device_key_seq')",
+    "CREATE UNIQUE INDEX IF NOT EXISTS device_key_key ON device (key)",
+    # peak_rss_mb was always the process-wide high-water mark
+    "DO $$ BEGIN "
+    "IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'ingest_metrics' AND column_name = 'peak_rss_mb') THEN "
+    "ALTER TABLE ingest_metrics RENAME COLUMN peak_rss_mb TO process_peak_rss_mb; "
+    "END IF; END $$"
+]
+
+def ping_table_ddl(dialect):
+    table = Pings.__table__
+    lines = []
+    for c in table.columns:
+        null = '' if c.nullable else ' NOT NULL'
+        lines.append(f"{c.name} {c.type.compile(dialect=dialect)}{null}")
+    # the partition key has to be part of the primary key
+    lines.append("PRIMARY KEY (id, location_at)")
+    for fk in table.foreign_keys:
+        lines.append(f"FOREIGN KEY ({fk.parent.name}) REFERENCES {fk.column.table.name} ({fk.column.name})")
+    cols = ',\n    '.join(lines)
+    return(f"CREATE TABLE IF NOT EXISTS pings (\n    {cols}\n) PARTITION BY RANGE (location_at)")
+
+def create_schema(engine, partitioned=False):
+    if not partitioned:
+        Base.metadata.create_all(engine)
+    else:
+        create_partitioned_pings(engine)
+    migrate(engine)
+    ensure_ping_indexes(engine)
+    if ping_dictionaries:
+        with engine.begin() as conn:
+            conn.execute(pings_text_view())
+
+def create_partitioned_pings(engine):
+    tables = [t for t in Base.metadata.sorted_tables if t.name != 'pings']
+    Base.metadata.create_all(engine, tables=tables)
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    cur.execute("SELECT to_regclass('pings') IS NOT NULL")
+    if cur.fetchone()[0] and not is_partitioned(cur):
+        logging.warning("pings already exists as a plain table, leaving it unpartitioned")
+    else:
+        cur.execute(ping_table_ddl(engine.dialect))
+        cur.execute("CREATE TABLE IF NOT EXISTS pings_default PARTITION OF pings DEFAULT")
+    raw_conn.commit()
+    raw_conn.close()
+
+def migrate(engine):
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    for ddl in migrations:
+        cur.execute(ddl)
+    raw_conn.commit()
+    raw_conn.close()
+
+def ensure_ping_indexes(engine):
+    # create_all skips tables that already exist, so indexes added to the
+    # Pings model later (and those of a partitioned pings) are created here.
+    # Indexes dropped for a bulk load are left to rebuild_ping_constraints.
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    cur.execute("SELECT name FROM deferred_ddl")
+    deferred = set(r[0] for r in cur.fetchall())
+    for index in Pings.__table__.indexes:
+        if index.name in deferred:
+            continue
+        ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+        cur.execute(ddl.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1))
+    raw_conn.commit()
+    raw_conn.close()
+
+def is_partitioned(cur):
+    if _partition_state['partitioned'] is None:
+        cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('pings'))")
+        _partition_state['partitioned'] = cur.fetchone()[0]
+    return(_partition_state['partitioned'])
+
+def partition_name(start):
+    return("pings_p" + datetime.utcfromtimestamp(start).strftime('%Y%m%d'))
+
+def ensure_partitions(cur, location_at, interval=ping_partition_interval):
+    # creates the partitions covering location_at and commits. Must run before
+    # the loader's transaction touches pings: attaching a partition locks the
+    # parent table. No-op when pings is not partitioned.
+    if not is_partitioned(cur) or len(location_at) == 0:
+        return(0)
+    starts = np.unique(np.asarray(location_at, dtype=np.int64) // interval) * interval
+    new = [int(s) for s in starts if int(s) not in _partition_state['known']]
+    if not new:
+        return(0)
+
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK,))
+    created = 0
+    for start in new:
+        name = partition_name(start)
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+        if not cur.fetchone()[0]:
+            cur.execute(f"CREATE TABLE {name} (LIKE pings INCLUDING DEFAULTS)")
+            cur.execute(f"""
+                WITH moved AS (
+                    DELETE FROM pings_default WHERE location_at >= %s AND location_at < %s RETURNING *
+                ) INSERT INTO {name} SELECT * FROM moved
+            """, (start, start + interval))
+            cur.execute(f"ALTER TABLE pings ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (start, start + interval))
+            created = created + 1
+        _partition_state['known'].add(start)
+    cur.connection.commit()
+    if created:
+        logging.info(f"\tcreated {created} pings partitions")
+    return(created)
+
+def ensure_partition_range(cur, t_start, t_end, interval=ping_partition_interval):
+    # pre-create every partition between two epoch times, e.g. ahead of a
+    # load whose time window is known
+    return(ensure_partitions(cur, np.arange(t_start - t_start % interval, t_end + 1, interval), interval))
+
+#---
+# Bulk-load mode
+
+def drop_ping_constraints(engine, include_pk=False):
+    # saves and drops the foreign keys and secondary indexes on pings
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    cur.execute("""
+        SELECT conname, 'constraint', pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = 'pings'::regclass AND (contype = 'f' OR (contype = 'p' AND %s))
+    """, (include_pk,))
+    constraints = cur.fetchall()
+    cur.execute("""
+        SELECT i.relname, 'index', pg_get_indexdef(i.oid)
+        FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = 'pings'::regclass
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)
+    """)
+    indexes = cur.fetchall()
+
+    for name, kind, definition in constraints + indexes:
+        cur.execute(
+            "INSERT INTO deferred_ddl (name, kind, definition) VALUES (%s, %s, %s) ON CONFLICT (name) DO NOTHING",
+            (name, kind, definition)
+        )
+        if kind == 'constraint':
+            cur.execute(f"ALTER TABLE pings DROP CONSTRAINT {name}")
+        else:
+            cur.execute(f"DROP INDEX {name}")
+        logging.info(f"\tdropped {kind} {name}")
+    raw_conn.commit()
+    raw_conn.close()
+    return(len(constraints) + len(indexes))
+
+def _rebuild_one(args):
+    engine, name, kind, definition = args
+    t1 = time.perf_counter()
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    if kind == 'constraint':
+        cur.execute(f"ALTER TABLE pings ADD CONSTRAINT {name} {definition}")
+    else:
+        cur.execute(definition)
+    cur.execute("DELETE FROM deferred_ddl WHERE name = %s", (name,))
+    raw_conn.commit()
+    raw_conn.close()
+    return(name, time.perf_counter() - t1)
+
+def rebuild_ping_constraints(engine, num_workers=4):
+    # rebuilds everything saved by drop_ping_constraints, one connection per
+    # index so the builds run in parallel on the server
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    cur.execute("SELECT name, kind, definition FROM deferred_ddl")
+    todo = cur.fetchall()
+    raw_conn.close()
+
+    # primary keys first so foreign keys and indexes find them
+    pk = [t for t in todo if t[2].startswith('PRIMARY KEY')]
+    rest = [t for t in todo if not t[2].startswith('PRIMARY KEY')]
+    with ThreadPool(num_workers) as pool:
+        for batch in (pk, rest):
+            for name, seconds in pool.imap_unordered(_rebuild_one, [(engine,) + t for t in batch]):
+                logging.info(f"\trebuilt {name}: {seconds:0.4f} seconds")
+    return(len(todo))
@@ -0,0 +1,135 @@
+import itertools
+import numpy as np
+from utils import Pings
+from config import engine
+from trajectories import column_dtype, to_array
+
+#---
+# Spatial cells and bounding-box/radius queries
+#
+# pings.cell is a Z-order (Morton) code: latitude and longitude are each
+# quantized to CELL_BITS bits (about 2.4 m at the equator) and their bits
+# interleaved into one integer. Dropping the last 2*k bits gives the cell k
+# levels up, so every cell at any level is one contiguous range of cell
+# values. A query covers its box with a bounded number of cells at the
+# finest level that fits, scans those ranges of ix_pings_cell, and filters
+# the fetched rows exactly in NumPy.
+
+CELL_BITS = 24
+EARTH_RADIUS = 6371008.8
+
+_cursor_count = itertools.count()
+
+def _spread(x):
+    # spreads the low 32 bits of x to the even bits of a 64 bit integer
+    x = x.astype(np.uint64)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x3333333333333333)
+    x = (x | (x << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return(x)
+
+def _quantize(lat, lng, bits):
+    n = 1 << bits
+    i = np.clip(np.floor((np.asarray(lat, dtype=np.float64) + 90.0) / 180.0 * n), 0, n - 1)
+    j = np.clip(np.floor((np.asarray(lng, dtype=np.float64) + 180.0) / 360.0 * n), 0, n - 1)
+    return(i.astype(np.int64), j.astype(np.int64))
+
+def _morton(i, j):
+    return((_spread(j) | (_spread(i) << np.uint64(1))).astype(np.int64))
+
+def cell_ids(lat, lng):
+    # cell of each coordinate pair, None where either is missing
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    ok = ~(np.isnan(lat) | np.isnan(lng))
+    i, j = _quantize(np.where(ok, lat, 0), np.where(ok, lng, 0), CELL_BITS)
+    out = _morton(i, j).astype(object)
+    out[~ok] = None
+    return(out)
+
+def cell_ranges(lat_min, lat_max, lng_min, lng_max, max_cells=64):
+    # sorted, merged [start, end) ranges of cell values covering the box
+    for level in range(CELL_BITS, -1, -1):
+        i0, j0 = _quantize(lat_min, lng_min, level)
+        i1, j1 = _quantize(lat_max, lng_max, level)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) <= max_cells:
+            break
+    i, j = np.meshgrid(np.arange(i0, i1 + 1), np.arange(j0, j1 + 1))
+    shift = np.int64(2 * (CELL_BITS - level))
+    starts = np.sort(_morton(i.ravel(), j.ravel())) << shift
+    ends = starts + (np.int64(1) << shift)
+    # merge cells that are adjacent along the curve
+    breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+    return(list(zip(starts[np.r_[0, breaks]].tolist(), ends[np.r_[breaks - 1, len(ends) - 1]].tolist())))
+
+def haversine(lat1, lng1, lat2, lng2):
+    # great circle distance in meters
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2)**2
+    return(2 * EARTH_RADIUS * np.arcsin(np.sqrt(a)))
+
+def _query_cells(ranges, columns, t_start, t_end, keep, batch_size, conn):
+    # scans the cell ranges and returns the rows keep() accepts as column arrays
+    table = Pings.__table__
+    columns = list(columns)
+    for c in ['latitude', 'longitude']:
+        if c not in columns:
+            columns.append(c)
+    for c in columns:
+        if c not in table.columns:
+            raise KeyError(f"pings has no column {c}")
+    where = ["(" + " OR ".join(["(cell >= %s AND cell < %s)"] * len(ranges)) + ")"]
+    params = [v for r in ranges for v in r]
+    if t_start is not None:
+        where.append("location_at >= %s")
+        params.append(int(t_start))
+    if t_end is not None:
+        where.append("location_at < %s")
+        params.append(int(t_end))
+    sql = f"SELECT {', '.join(columns)} FROM pings WHERE {' AND '.join(where)}"
+
+    own_conn = conn is None
+    if own_conn:
+        conn = engine.raw_connection()
+    dtypes = [column_dtype(table.c[c]) for c in columns]
+    parts = {c: [] for c in columns}
+    try:
+        cur = conn.cursor(name=f"cells_{next(_cursor_count)}")
+        cur.itersize = batch_size
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            batch = {name: to_array(v, dtype) for name, dtype, v in zip(columns, dtypes, zip(*rows))}
+            mask = keep(batch['latitude'], batch['longitude'])
+            for c in columns:
+                parts[c].append(batch[c][mask])
+        cur.close()
+    finally:
+        if own_conn:
+            conn.rollback()
+            conn.close()
+    return({c: np.concatenate(v) if v else np.empty(0, dtype=d) for (c, v), d in zip(parts.items(), dtypes)})
+
+def query_bbox(lat_min, lat_max, lng_min, lng_max, columns=('device_id', 'location_at'),
+               t_start=None, t_end=None, max_cells=64, batch_size=100000, conn=None):
+    # pings inside the box, optionally within [t_start, t_end), as column arrays
+    def keep(lat, lng):
+        return((lat >= lat_min) & (lat <= lat_max) & (lng >= lng_min) & (lng <= lng_max))
+    ranges = cell_ranges(lat_min, lat_max, lng_min, lng_max, max_cells)
+    return(_query_cells(ranges, columns, t_start, t_end, keep, batch_size, conn))
+
+def query_radius(lat, lng, radius, columns=('device_id', 'location_at'),
+                 t_start=None, t_end=None, max_cells=64, batch_size=100000, conn=None):
+    # pings within radius meters of (lat, lng); adds a 'distance' array
+    dlat = np.degrees(radius / EARTH_RADIUS)
+    dlng = min(dlat / max(np.cos(np.radians(lat)), 1e-6), 180.0)
+    def keep(plat, plng):
+        return(haversine(lat, lng, plat, plng) <= radius)
+    ranges = cell_ranges(lat - dlat, lat + dlat, lng - dlng, lng + dlng, max_cells)
+    out = _query_cells(ranges, columns, t_start, t_end, keep, batch_size, conn)
+    out['distance'] = haversine(lat, lng, out['latitude'], out['longitude'])
+    return(out)
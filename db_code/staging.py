@@ -0,0 +1,96 @@
+import argparse
+import functools
+import logging
+import multiprocessing
+import os
+import time
+import utils
+import storage
+from config import ping_dtypes, staging_dir
+from ping_io import read_raw_ping_file, clean_ping_frame, staged_path, is_current
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+#---
+# Parquet staging
+#
+# Converts each raw part-*.csv.gz once into a typed, compressed Parquet file
+# with the cleaning from clean_ping_frame already applied. The source size and
+# mtime are stored in the file metadata; read_ping_file picks up the staged
+# copy as long as they still match. Analyses can read single columns with
+# ping_io.read_staged(path, columns=[...]).
+
+stage_chunksize = 500000
+
+_arrow_types = {'str': 'string', 'int': 'int64', 'float': 'float64'}
+
+def ping_schema():
+    return(pa.schema([(c, _arrow_types[t]) for c, t in ping_dtypes.items()]))
+
+def stage_file(inFile, out_dir=staging_dir, compression='zstd'):
+    # returns (inFile, rows written, seconds); 0 rows when already current
+    staged = staged_path(inFile, out_dir)
+    if is_current(inFile, staged):
+        return((inFile, 0, 0.0))
+
+    t1 = time.perf_counter()
+    size, mtime = storage.stat(inFile)
+    schema = ping_schema().with_metadata({
+        'source_path': inFile,
+        'source_size': str(size),
+        'source_mtime': repr(mtime)
+    })
+    nrow = 0
+    tmp = staged + '.tmp'
+    try:
+        with pq.ParquetWriter(tmp, schema, compression=compression) as writer:
+            for chunk in read_raw_ping_file(inFile, stage_chunksize, compact=False):
+                chunk = clean_ping_frame(chunk)
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                nrow = nrow + len(chunk)
+        # readers never see a partially written file
+        os.replace(tmp, staged)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return((inFile, nrow, time.perf_counter() - t1))
+
+def stage_files(fileManager, out_dir=staging_dir, num_workers=1):
+    if pa is None:
+        utils.ERROR("pyarrow is required for Parquet staging")
+    if out_dir is None:
+        utils.ERROR("no staging directory configured")
+    os.makedirs(out_dir, exist_ok=True)
+
+    logging.info(f"Staging files to {out_dir}")
+    files = list(fileManager.files_to_process['path'])
+    t1 = time.perf_counter()
+    n = 0
+    with multiprocessing.Pool(num_workers) as pool:
+        for inFile, nrow, seconds in pool.imap_unordered(functools.partial(stage_file, out_dir=out_dir), files):
+            if nrow:
+                n = n + 1
+                logging.info(f"\t{inFile}: {nrow} rows in {seconds:0.4f} seconds")
+    t2 = time.perf_counter()
+    logging.info(f"\t{n} files staged, {len(files) - n} already current")
+    logging.info(f"\tComplete: {t2-t1:0.4f} seconds\n")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loglevel', type=str)
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+    utils.initLogger(args)
+
+    wd = "/Users/jadrake/Documents/Misc/COVID/Mobility/xmode/"
+    fileManager = utils.FileManager(wd + 'db_code/')
+    stage_files(fileManager, staging_dir, args.num_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import argparse
+import logging
+import multiprocessing
+import time
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import utils
+import spatial
+from dimensions import copy_rows
+from trajectories import iter_trajectories
+from config import engine, integer_device_keys, stay_distance, stay_duration, stay_max_gap
+
+#---
+# Stay-point detection
+#
+# A stay starts at an anchor ping and extends over the following pings while
+# they stay within stay_distance meters of the anchor and no two consecutive
+# pings are more than stay_max_gap seconds apart; it counts if it lasts at
+# least stay_duration seconds. The reach of every ping as an anchor is
+# computed at once over a window of following pings, so the only Python loop
+# is one step per detected stay. Trajectories of many devices are
+# concatenated and handled together, with device changes treated as breaks.
+#
+# Devices are split into chunks that a process pool works through; each chunk
+# replaces its devices' stays in the window in one transaction.
+
+stay_columns = ['device_id','start_at','end_at','latitude','longitude','n_pings','venue_id','cell']
+
+def stay_reach(t, lat, lng, group, distance, max_gap, window=8):
+    # last index each ping reaches as an anchor. Distances use a local
+    # equirectangular projection, accurate to well under a meter at stay
+    # scales. Anchors that reach past the window look further, with the
+    # window doubling each round.
+    n = len(t)
+    y = np.radians(lat) * spatial.EARTH_RADIUS
+    x = np.radians(lng) * spatial.EARTH_RADIUS
+    scale = np.cos(np.radians(lat))
+    limit = distance * distance
+
+    # a stay never runs past the ping before the next device change or gap
+    brk = np.r_[(group[1:] != group[:-1]) | (np.diff(t) > max_gap), True]
+    end = np.minimum.accumulate(np.where(brk, np.arange(n), n)[::-1])[::-1]
+
+    reach = end.copy()
+    active = np.flatnonzero(end > np.arange(n))
+    offset = 1
+    while len(active):
+        idx = np.minimum(active[:, None] + np.arange(offset, offset + window)[None, :], end[active, None])
+        far = ((x[idx] - x[active, None]) * scale[active, None])**2 + (y[idx] - y[active, None])**2 > limit
+        hit = far.any(axis=1)
+        reach[active[hit]] = active[hit] + offset + far[hit].argmax(axis=1) - 1
+        active = active[~hit & (active + offset + window <= end[active])]
+        offset = offset + window
+        window = window * 2
+    return(reach)
+
+def detect_stays(t, lat, lng, group=None, distance=stay_distance, duration=stay_duration, max_gap=stay_max_gap):
+    # returns (first, last) ping indexes of each stay; t sorted within group
+    t = np.asarray(t, dtype=np.int64)
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    group = np.zeros(len(t), dtype=np.int64) if group is None else np.asarray(group)
+    if len(t) == 0:
+        return(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    reach = stay_reach(t, lat, lng, group, distance, max_gap)
+    candidates = np.flatnonzero(t[reach] - t >= duration)
+
+    first = []
+    last = []
+    pos = 0
+    while True:
+        k = np.searchsorted(candidates, pos)
+        if k == len(candidates):
+            break
+        i = candidates[k]
+        first.append(i)
+        last.append(reach[i])
+        pos = reach[i] + 1
+    return(np.array(first, dtype=np.int64), np.array(last, dtype=np.int64))
+
+def summarize_stays(first, last, t, lat, lng, venue_id):
+    # centroid, duration and most frequent non-null venue of each stay
+    n_pings = last - first + 1
+    csum_lat = np.r_[0, np.cumsum(lat)]
+    csum_lng = np.r_[0, np.cumsum(lng)]
+    out = pd.DataFrame({
+        'start_at': t[first],
+        'end_at': t[last],
+        'latitude': (csum_lat[last + 1] - csum_lat[first]) / n_pings,
+        'longitude': (csum_lng[last + 1] - csum_lng[first]) / n_pings,
+        'n_pings': n_pings
+    })
+
+    # stay number of every ping, -1 outside stays
+    marks = np.zeros(len(t) + 1, dtype=np.int64)
+    np.add.at(marks, first, 1)
+    np.add.at(marks, last + 1, -1)
+    inside = np.cumsum(marks)[:len(t)] > 0
+    starts = np.zeros(len(t), dtype=np.int64)
+    starts[first] = 1
+    sid = np.cumsum(starts) - 1
+
+    venue_id = np.asarray(venue_id, dtype=np.float64)
+    keep = inside & ~np.isnan(venue_id)
+    venues = pd.DataFrame({'stay': sid[keep], 'venue_id': venue_id[keep]})
+    top = venues.groupby(['stay', 'venue_id']).size().reset_index(name='n')
+    top = top.sort_values(['stay', 'n'], ascending=[True, False]).drop_duplicates('stay')
+    venue = np.full(len(out), None, dtype=object)
+    venue[top['stay'].to_numpy()] = top['venue_id'].astype('int64').to_numpy()
+    out['venue_id'] = venue
+    out['cell'] = spatial.cell_ids(out['latitude'], out['longitude'])
+    return(out)
+
+def stays_for_trajectories(trajectories):
+    # trajectories: list of (device_id, arrays) as from iter_trajectories
+    if not trajectories:
+        return(pd.DataFrame(columns=stay_columns))
+    devices = [d for d, _ in trajectories]
+    lengths = np.array([len(a['location_at']) for _, a in trajectories])
+    cat = {c: np.concatenate([a[c] for _, a in trajectories]) for c in trajectories[0][1]}
+    group = np.repeat(np.arange(len(devices)), lengths)
+
+    first, last = detect_stays(cat['location_at'], cat['latitude'], cat['longitude'], group)
+    out = summarize_stays(first, last, cat['location_at'], cat['latitude'], cat['longitude'], cat['venue_id'])
+    out.insert(0, 'device_id', np.array(devices, dtype=object)[group[first]])
+    return(out)
+
+def active_devices(cur, t_start, t_end):
+    # advertiser_ids with pings in [t_start, t_end)
+    key = 'key' if integer_device_keys else 'id'
+    cur.execute(f"""
+        SELECT d.id FROM device d
+        WHERE EXISTS (SELECT 1 FROM pings p WHERE p.device_id = d.{key} AND p.location_at >= %s AND p.location_at < %s)
+    """, (t_start, t_end))
+    return([r[0] for r in cur.fetchall()])
+
+_worker_window = None
+
+def _init_stay_worker(t_start, t_end):
+    global _worker_window
+    _worker_window = (t_start, t_end)
+
+def stay_worker(device_ids, batch_rows=200000):
+    t_start, t_end = _worker_window
+    t1 = time.perf_counter()
+    raw_conn = engine.raw_connection()
+    cur = raw_conn.cursor()
+    try:
+        parts = []
+        pending = []
+        nrows = 0
+        n_pings = 0
+        columns = ['location_at', 'latitude', 'longitude', 'venue_id']
+        for device, traj in iter_trajectories(device_ids, t_start, t_end, columns, conn=raw_conn):
+            pending.append((device, traj))
+            nrows = nrows + len(traj['location_at'])
+            if nrows >= batch_rows:
+                parts.append(stays_for_trajectories(pending))
+                n_pings = n_pings + nrows
+                pending = []
+                nrows = 0
+        parts.append(stays_for_trajectories(pending))
+        n_pings = n_pings + nrows
+        stays = pd.concat(parts, ignore_index=True)
+
+        # replace earlier results for these devices and this window
+        cur.execute(
+            "DELETE FROM stays WHERE device_id = ANY(%s) AND start_at >= %s AND start_at < %s",
+            (list(device_ids), t_start, t_end)
+        )
+        copy_rows(cur, 'stays', stay_columns, stays[stay_columns].itertuples(index=False, name=None))
+        raw_conn.commit()
+        return((len(device_ids), n_pings, len(stays), None, time.perf_counter() - t1))
+    except Exception as e:
+        # bad data in one chunk fails that chunk only, like a database error
+        raw_conn.rollback()
+        return((len(device_ids), 0, 0, f"{type(e).__name__}: {e}", time.perf_counter() - t1))
+    finally:
+        raw_conn.close()
+
+def detect_stays_parallel(t_start, t_end, num_workers, chunks_per_worker=8):
+    logging.info(f"Detecting stays from {t_start} to {t_end} with {num_workers} workers")
+    utils.Base.metadata.create_all(engine, tables=[utils.Stay.__table__])
+    raw_conn = engine.raw_connection()
+    devices = active_devices(raw_conn.cursor(), t_start, t_end)
+    raw_conn.close()
+    jobs = [list(c) for c in np.array_split(np.array(devices, dtype=object), num_workers * chunks_per_worker) if len(c)]
+    logging.info(f"\t{len(devices)} devices in {len(jobs)} chunks")
+    # nothing pooled may be forked, a child closing an inherited socket would
+    # close the parent's
+    engine.dispose()
+
+    t1 = time.perf_counter()
+    totals = np.zeros(3, dtype=np.int64)
+    with multiprocessing.Pool(num_workers, initializer=_init_stay_worker, initargs=(t_start, t_end)) as pool:
+        for n_devices, n_pings, n_stays, err, seconds in pool.imap_unordered(stay_worker, jobs):
+            if err is None:
+                totals = totals + [n_devices, n_pings, n_stays]
+                logging.debug(f"\t{n_devices} devices, {n_pings} pings, {n_stays} stays: {seconds:0.4f} seconds")
+            else:
+                logging.info(f"ERROR")
+                logging.info(f"\t{n_devices} devices")
+                logging.info(f"\t{err}")
+    t2 = time.perf_counter()
+    logging.info(f"\tComplete: {totals[2]} stays from {totals[1]} pings of {totals[0]} devices in {t2-t1:0.4f} seconds\n")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loglevel', type=str)
+    parser.add_argument('--start', type=str, required=True, help='YYYY-MM-DD, UTC')
+    parser.add_argument('--end', type=str, required=True, help='YYYY-MM-DD, UTC, exclusive')
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+    utils.initLogger(args)
+
+    t_start = int(datetime.strptime(args.start, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+    t_end = int(datetime.strptime(args.end, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+    detect_stays_parallel(t_start, t_end, args.num_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import glob
+import gzip
+import io
+import os
+import os.path
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from config import s3_endpoint_url, s3_part_size, s3_prefetch_parts, s3_download_threads
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+#---
+# Ping file storage
+#
+# Ping file paths are local paths or s3://bucket/key URIs of an S3 compatible
+# store (s3_endpoint_url, a file:// endpoint serves a local directory through
+# s3_stub instead). Objects are read without landing on disk: open_raw
+# downloads s3_part_size byte ranges on s3_download_threads threads, keeping at
+# most s3_prefetch_parts ranges in flight or buffered ahead of the reader, and
+# open_file decompresses .gz objects as they arrive. Memory per open object is
+# bounded by s3_prefetch_parts * s3_part_size whatever its size.
+
+_clients = {}
+
+def is_remote(path):
+    return(path.startswith('s3://'))
+
+def split_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return(bucket, key)
+
+def get_client():
+    # one client per process, clients are not safe to share across a fork
+    pid = os.getpid()
+    if pid not in _clients:
+        if s3_endpoint_url is not None and s3_endpoint_url.startswith('file://'):
+            import s3_stub
+            _clients[pid] = s3_stub.DirectoryClient(s3_endpoint_url[len('file://'):])
+        elif boto3 is None:
+            raise ImportError("boto3 is required for s3:// paths")
+        else:
+            _clients[pid] = boto3.client('s3', endpoint_url=s3_endpoint_url)
+    return(_clients[pid])
+
+def set_client(client):
+    # use client for s3:// paths in this process
+    _clients[os.getpid()] = client
+
+class RangedReader(io.RawIOBase):
+    # read-only stream over an object, fetched in concurrent ranged GETs
+    def __init__(self, client, bucket, key, size=None, part_size=s3_part_size, prefetch=s3_prefetch_parts, threads=s3_download_threads):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = client.head_object(Bucket=bucket, Key=key)['ContentLength'] if size is None else size
+        self.part_size = part_size
+        self.prefetch = prefetch
+        self.pool = ThreadPool(min(threads, prefetch))
+        self.pending = deque()
+        self.offset = 0
+        self.part = memoryview(b'')
+        self.bytes_read = 0
+        self._fill()
+
+    def _fetch(self, start, end):
+        resp = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end - 1}")
+        data = resp['Body'].read()
+        if len(data) != end - start:
+            raise IOError(f"s3://{self.bucket}/{self.key}: got {len(data)} bytes of range {start}-{end - 1}")
+        return(data)
+
+    def _fill(self):
+        while len(self.pending) < self.prefetch and self.offset < self.size:
+            end = min(self.offset + self.part_size, self.size)
+            self.pending.append(self.pool.apply_async(self._fetch, (self.offset, end)))
+            self.offset = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not len(self.part):
+            if not self.pending:
+                return 0
+            self.part = memoryview(self.pending.popleft().get())
+            self._fill()
+        n = min(len(b), len(self.part))
+        b[:n] = self.part[:n]
+        self.part = self.part[n:]
+        self.bytes_read = self.bytes_read + n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.pool.terminate()
+            self.pending.clear()
+        super().close()
+
+class _GzipReader(gzip.GzipFile):
+    # GzipFile that also closes the stream it decompresses
+    def __init__(self, raw):
+        super().__init__(fileobj=raw, mode='rb')
+        self.raw = raw
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.raw.close()
+
+def open_raw(path):
+    # binary stream of the stored bytes
+    if not is_remote(path):
+        return(open(path, 'rb'))
+    bucket, key = split_uri(path)
+    return(io.BufferedReader(RangedReader(get_client(), bucket, key), buffer_size=1 << 20))
+
+def open_file(path, mode='rb'):
+    # decompressed binary ('rb') or text ('rt') stream of a ping file
+    if not is_remote(path):
+        f = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    else:
+        f = open_raw(path)
+        if path.endswith('.gz'):
+            f = _GzipReader(f)
+    if mode == 'rt':
+        return(io.TextIOWrapper(f, encoding='utf-8'))
+    return(f)
+
+def stat(path):
+    # (size, mtime) of a file or object
+    if not is_remote(path):
+        st = os.stat(path)
+        return((st.st_size, st.st_mtime))
+    bucket, key = split_uri(path)
+    head = get_client().head_object(Bucket=bucket, Key=key)
+    return((head['ContentLength'], head['LastModified'].timestamp()))
+
+def list_files(location, suffix='.gz'):
+    # sorted paths of the files under a directory or s3:// prefix
+    if not is_remote(location):
+        files = glob.glob(location + '/**/*' + suffix, recursive=True)
+        return(sorted(files))
+    bucket, prefix = split_uri(location)
+    files = []
+    token = {}
+    while True:
+        resp = get_client().list_objects_v2(Bucket=bucket, Prefix=prefix, **token)
+        files.extend(f"s3://{bucket}/{o['Key']}" for o in resp.get('Contents', []) if o['Key'].endswith(suffix))
+        if not resp.get('IsTruncated'):
+            break
+        token = {'ContinuationToken': resp['NextContinuationToken']}
+    return(sorted(files))
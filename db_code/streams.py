@@ -0,0 +1,51 @@
+import io
+
+
+# Read-only file object over an iterator of text (or, with binary=True, bytes)
+# blocks. Lets cursor.copy_from/copy_expert consume rows as they are produced
+# instead of from one materialized buffer.
+class CopyStream(io.TextIOBase):
+    def __init__(self, blocks, binary=False):
+        self._blocks = iter(blocks)
+        self._buffer = io.BytesIO if binary else io.StringIO
+        self._empty = b'' if binary else ''
+        self._current = self._buffer()
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def _next_block(self):
+        for block in self._blocks:
+            if block:
+                self._current = self._buffer(block)
+                return True
+        return False
+
+    def read(self, size=-1):
+        parts = []
+        remaining = size
+        while size < 0 or remaining > 0:
+            part = self._current.read(remaining if size >= 0 else -1)
+            if part:
+                parts.append(part)
+                remaining = remaining - len(part)
+            elif not self._next_block():
+                break
+        out = self._empty.join(parts)
+        self.bytes_read = self.bytes_read + len(out)
+        return out
+
+    def readline(self, size=-1):
+        parts = []
+        while True:
+            part = self._current.readline()
+            if part:
+                parts.append(part)
+                if part[-1:] in ('\n', b'\n'):
+                    break
+            elif not self._next_block():
+                break
+        out = self._empty.join(parts)
+        self.bytes_read = self.bytes_read + len(out)
+        return out
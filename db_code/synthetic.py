@@ -0,0 +1,165 @@
+import argparse
+import logging
+import os.path
+import pickle
+import time
+import numpy as np
+import pandas as pd
+import utils
+from config import ping_dtypes, tz_preload_bbox
+
+#---
+# Synthetic X-Mode data
+#
+# Writes gzip CSV part files with the ping_dtypes header and value shapes
+# modeled on the real feed: devices with a home location and a time ordered
+# walk around it, sparse optional fields, a small venue/dwell tail, and the
+# dirt the loaders have to survive (backslash escapes, quotes and commas in
+# free text, tabs, NUL bytes, <unknown ssid>/<unknown bssid> and empty
+# fields). Matching venue and device masterlist pickles are written next to
+# the part files, so a scratch database can be set up with the regular
+# dimension loaders. Everything is drawn from one seed, so a dataset is
+# reproducible.
+
+user_agents = [
+    'Mozilla/5.0 (Linux; Android 10; SM-G960U) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/84.0.4147.125 Mobile Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 13_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148',
+    'Dalvik/2.1.0 (Linux; U; Android 9; moto g(7) power Build/PCOS29.114-134-2)',
+    'WeatherApp/4.2 (iOS 13.5; iPhone11,8)',
+    'okhttp/3.12.1'
+]
+ssids = ['HomeNet', 'NETGEAR42', 'xfinitywifi', 'ATT9qA3', 'Starbucks WiFi', '"Quoted SSID"', 'Cafe, Guest', 'back\\slash']
+dirty_ssids = ['tab\there', 'nul\x00byte', 'line\\\nbreak']
+platforms = ['ANDROID', 'IOS']
+carriers = ['T-Mobile', 'AT&T', 'Verizon', 'Sprint', 'Cricket']
+models = ['SM-G960U', 'iPhone11,8', 'moto g(7) power', 'Pixel 3a', 'LM-Q720']
+categories = ['auto', 'food', 'gas station', 'grocery', 'school', 'hospital', 'church', 'park', 'retail', 'bank']
+
+def _hex_ids(rng, n, nbytes=16):
+    raw = rng.integers(0, 256, size=(n, nbytes), dtype=np.uint8)
+    return(np.array([r.tobytes().hex() for r in raw], dtype=object))
+
+def _sometimes(rng, values, rate):
+    # values with roughly rate of them replaced by NaN
+    values = pd.Series(values)
+    return(values.where(rng.random(len(values)) >= rate))
+
+def _walk(rng, group, scale=0.002, limit=0.05):
+    # random walk restarting at 0 for each run of equal group values, moving
+    # on about a third of the steps and clipped to +-limit degrees
+    n = len(group)
+    step = rng.normal(0, scale, n) * (rng.random(n) < 0.3)
+    pos = np.cumsum(step)
+    starts = np.r_[0, np.flatnonzero(np.diff(group)) + 1]
+    base = np.repeat(pos[starts] - step[starts], np.diff(np.r_[starts, n]))
+    return(np.clip(pos - base, -limit, limit))
+
+class SyntheticFeed():
+    def __init__(self, num_devices=5000, num_venues=500, dirty_rate=0.001, seed=0, day=1583020800):
+        self.rng = np.random.default_rng(seed)
+        self.dirty_rate = dirty_rate
+        self.day = day
+        rng = self.rng
+        self.devices = _hex_ids(rng, num_devices)
+        lat_min, lat_max, lng_min, lng_max = tz_preload_bbox
+        self.home_lat = rng.uniform(lat_min, lat_max, num_devices)
+        self.home_lng = rng.uniform(lng_min, lng_max, num_devices)
+        # a few heavy devices, many light ones
+        weight = rng.pareto(1.2, num_devices) + 1
+        self.weight = weight / weight.sum()
+        self.venues = np.array([f"venue {i}" for i in range(num_venues)], dtype=object)
+        self.publishers = _hex_ids(rng, 200, 8)
+
+    def masterlists(self):
+        # (venue name -> categories, advertiser_id -> [platform, carrier, model])
+        rng = self.rng
+        venues_tab = {}
+        for v in self.venues:
+            venues_tab[v] = list(rng.choice(categories, size=rng.integers(1, 4), replace=False))
+        device_tab = {}
+        for d in self.devices:
+            device_tab[d] = [rng.choice(platforms), rng.choice(carriers), rng.choice(models)]
+        return(venues_tab, device_tab)
+
+    def frame(self, nrow, day_offset=0):
+        rng = self.rng
+        d = np.sort(rng.choice(len(self.devices), size=nrow, p=self.weight))
+        t = self.day + day_offset * 86400 + rng.integers(0, 86400, nrow)
+        order = np.lexsort((t, d))
+        d = d[order]
+        t = t[order]
+        lat = self.home_lat[d] + _walk(rng, d)
+        lng = self.home_lng[d] + _walk(rng, d)
+
+        ipv4 = pd.Series([f"10.{a}.{b}.{c}" for a, b, c in rng.integers(0, 256, (nrow, 3))])
+        at_venue = rng.random(nrow) < 0.05
+        ssid = pd.Series(rng.choice(ssids + ['<unknown ssid>'], nrow), dtype=object)
+        dirty = rng.random(nrow) < self.dirty_rate
+        ssid[dirty] = rng.choice(dirty_ssids, int(dirty.sum()))
+        bssid = pd.Series([':'.join(f"{x:02x}" for x in r) for r in rng.integers(0, 256, (nrow, 6))], dtype=object)
+        bssid[rng.random(nrow) < 0.2] = '<unknown bssid>'
+
+        dat = pd.DataFrame({
+            'advertiser_id': self.devices[d],
+            'location_at': t,
+            'latitude': lat.round(6),
+            'longitude': lng.round(6),
+            'altitude': _sometimes(rng, rng.normal(200, 50, nrow).round(1), 0.4),
+            'horizontal_accuracy': rng.uniform(3, 100, nrow).round(1),
+            'vertical_accuracy': _sometimes(rng, rng.uniform(2, 30, nrow).round(1), 0.6),
+            'heading': _sometimes(rng, rng.integers(0, 360, nrow).astype(float), 0.5),
+            'speed': _sometimes(rng, rng.exponential(3, nrow).round(2), 0.5),
+            'ipv_4': ipv4.where(rng.random(nrow) >= 0.2),
+            'ipv_6': pd.Series([None] * nrow, dtype=object),
+            'final_country': pd.Series(rng.choice(['US', 'US', 'US', 'MX'], nrow)),
+            'user_agent': _sometimes(rng, rng.choice(user_agents, nrow), 0.1),
+            'background': _sometimes(rng, rng.choice(['true', 'false'], nrow), 0.1),
+            'publisher_id': self.publishers[rng.integers(0, len(self.publishers), nrow)],
+            'wifi_ssid': ssid.where(rng.random(nrow) >= 0.5),
+            'wifi_bssid': bssid.where(rng.random(nrow) >= 0.5),
+            'venue_name': pd.Series(rng.choice(self.venues, nrow)).where(at_venue),
+            'dwell_time': pd.Series(rng.exponential(900, nrow).round(0)).where(at_venue & (rng.random(nrow) < 0.5))
+        })
+        return(dat[list(ping_dtypes)])
+
+def write_part_file(dat, path):
+    dat.to_csv(path, index=False, escapechar='\\', doublequote=False, compression='gzip')
+
+def generate_dataset(out_dir, num_files=4, rows_per_file=100000, num_devices=5000, num_venues=500, dirty_rate=0.001, seed=0):
+    # writes part files and masterlist pickles to out_dir, returns [(path, nrow)]
+    logging.info(f"Generating {num_files} files of {rows_per_file} rows in {out_dir}")
+    t1 = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+    feed = SyntheticFeed(num_devices, num_venues, dirty_rate, seed)
+    venues_tab, device_tab = feed.masterlists()
+    with open(os.path.join(out_dir, 'xmode_venue_masterlist.pickle'), 'wb') as f:
+        pickle.dump(venues_tab, f)
+    with open(os.path.join(out_dir, 'xmode_tx_device_masterlist.pickle'), 'wb') as f:
+        pickle.dump(device_tab, f)
+
+    files = []
+    for i in range(0, num_files):
+        path = os.path.join(out_dir, f"part-{i:05d}-synthetic-c000.csv.gz")
+        write_part_file(feed.frame(rows_per_file, i), path)
+        files.append((path, rows_per_file))
+    t2 = time.perf_counter()
+    logging.info(f"\tComplete: {t2-t1:0.4f} seconds\n")
+    return(files)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loglevel', type=str)
+    parser.add_argument('--out_dir', type=str, required=True)
+    parser.add_argument('--num_files', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--devices', type=int, default=5000)
+    parser.add_argument('--venues', type=int, default=500)
+    parser.add_argument('--dirty_rate', type=float, default=0.001)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    utils.initLogger(args)
+    generate_dataset(args.out_dir, args.num_files, args.rows, args.devices, args.venues, args.dirty_rate, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,22 @@
-import pandas as pd
 import numpy as np
 import os
 import io
+import gzip
+import queue
+import threading
+import time
 from sqlalchemy import *
 from utilities.db import get_np_na_value, get_np_data_type, get_data_type
 from config.connection import connection_string, metadata_schema, data_file_directory, raw_schema
 
 '''
     3 - Loads the raw data from the CDC files into the raw data schema, creating the tables based on the types and
+        positions in the fields_ metadata views.
+
+    Records are sliced straight out of large blocks of the file: every block is turned into a NumPy record array
+    whose fields are the fixed-width columns, blank fields are found on the raw bytes and numeric fields are
+    converted with one astype per column. Chunks are rendered to COPY text and handed to a background thread
+    that COPYs and commits them while the next chunk is parsed.
 '''
 
 # SETTINGS #
@@ -16,121 +25,194 @@ from config.connection import connection_string, metadata_schema, data_file_dire
 files_table = 'files_2016'
 fields_view_prefix = 'fields_'
 
-chunk_size = 10000  # Records per chunk
+chunk_bytes = 32 << 20  # Bytes of input per chunk, the rows per chunk follow from the record length
+min_chunk_rows = 10000
+max_chunk_rows = 1000000
 limit_chunks = 0  # 0 means unlimited
-
-# Instantiate DB engine
-engine = create_engine(connection_string, echo=False)
-
-# Obtain connection to metadata schema
-meta = MetaData(schema=metadata_schema)
-
-# Open connection
-# The SQLAlchemy connection to the database
-conn = engine.connect()
-# A raw psycopg2 DB connection
-raw_conn = engine.raw_connection()
-# A cursor using the raw connection
-cur = raw_conn.cursor()
-# Text output object
-output = io.StringIO()
-
-# Get list of files based on the settings
-files = Table(files_table, meta, autoload=True, autoload_with=engine)
-files_view = conn.execute(select([files]))
-
-# Loop through the files that we are importing into the database
-for file in files_view:
-    # Obtain file characteristics for each file from the file record.
-    year = file[files.c.year]
-    fraction = file[files.c.fraction]
-    file_type = file[files.c.type]
-    file = file[files.c.name]
-
-    # Construct import table name from file record characteristics
-    target_table = file_type.lower() + "_" + fraction.lower() + "_" + str(year)
-
-    # Define fields view
-    fields = Table(fields_view_prefix + target_table, meta, autoload=True, autoload_with=engine)
-
-    # Select fields metadata
-    fields_view = conn.execute(select([fields]))
-    colSpecs = []
-    colNames = []
-    dTypes_db = {}
-    dTypes_np = {}
-    dTypes_na = {}
-
-    # Loop through the fields for this file and build up the lists and dictionaries we need to
-    # define the target tables and write them to the DB
-    for row in fields_view:
-        # Get the column name for each field
-        col = row[fields.c.friendly_header]
-        # Build the column specifications list by providing the start and end index in the fixed-width file.
-        colSpecs.append([row[fields.c.start_base_zero], row[fields.c.end_base_zero]])
-        # Build the column names list
-        colNames.append(col)
-        # Build the database column type dictionary
-        dTypes_db[col] = get_data_type(row[fields.c.type], row[fields.c.length])
-        # Build the numpy column type dictionary
-        dTypes_np[col] = get_np_data_type(row[fields.c.type])
-        # Build the nan/na value dictionary
-        if row[fields.c.type] != 'VARCHAR':
-            dTypes_na[col] = get_np_na_value(row[fields.c.length])
-
-    # Grab the import file from the file system
-    filename = os.path.join(data_file_directory, str(year), file_type, file)
-
-    # grab just the first row for table creation purposes. Note that the column order is important and
-    # must match the order of the fixed width file
-    # See https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.read_fwf.html for details of the
-    # Pandas fixed-width file reader.
-    first_row = pd.read_fwf(filename, colspecs=colSpecs, dtype=dTypes_np, header=None, names=colNames,
-                            skip_blank_lines=False, na_values=dTypes_na,
-                            delim_whitespace=True, nrows=1)
-
-    # grab the rest of the data frame, all but the first row
-    reader = pd.read_fwf(filename, colspecs=colSpecs, dtype=dTypes_np, header=None, names=colNames,
-                         skip_blank_lines=False, na_values=dTypes_na,
-                         delim_whitespace=True, chunksize=chunk_size, skiprows=1)
-
-    # Start "chunking" through the file
-    for i, chunk in enumerate(reader):
-        # Create temporary CSV file in memory
-        output = io.StringIO()
-        # Is this the first chunk?
-        if i == 0:
-            # Create empty table
-            # Replace empty fields with proper numpy null value
-            first_row.replace(r'^\s*$', np.nan, regex=True, inplace=True)
-            # Set the index field at 1,000,000 and increment by one for the first row
-            first_row.insert(0, 'id', range(1000000, 1000001))
-            # Write first row to DB which will also generate the target table based on the metadata
-            # if the table already exists, replace it.
-            first_row.to_sql(target_table, con=conn, schema=raw_schema,
-                             index=False, dtype=dTypes_db,
-                             if_exists='replace')
-        # Replace all blank cells with NaN
-        # Define the current input row index
-        index = i * chunk_size + 1000001
-        # Replace empty fields with proper numpy null value
-        chunk.replace(r'^\s*$', np.nan, regex=True, inplace=True)
-        # Set the index field for the subsequent inserts
-        chunk.insert(0, 'id', range(index, index + len(chunk)))
-        # Strange syntax (see: https://pandas.pydata.org/pandas-docs/stable/generated/pandas.notnull.html)
-        # This is replacing all NaN with the string 'Null'
-        chunk = chunk.where((pd.notnull(chunk)), 'Null')
-        # Converts data frame to CSV in memory
-        chunk.to_csv(output, sep='\t', header=False, index=False)
-        # Set reader to beginning of in-memory csv
-        output.seek(0)
-        # Start reading contents of in-memory csv
-        contents = output.getvalue()
-        # writes rows to DB using COPY command on raw psycopg2 connection, much faster than pandas' to_sql
-        cur.copy_from(output, raw_schema + '.' + target_table, null='Null')
-        # Commit inserts to DB
-        raw_conn.commit()
-        print(file + ', ' + file_type + ", " + str(year) + ', ' + fraction + ': ' + str((i + 1) * chunk_size))
-        if limit_chunks > 0:
-            if i == limit_chunks - 1:
+queue_size = 2  # Rendered chunks waiting for the COPY thread
+first_id = 1000000  # id of the first record of each file
+
+
+class FixedWidthSpec():
+    # Column names, positions and types of one fixed-width file, from its fields_ view
+    def __init__(self, conn, meta, target_table):
+        fields = Table(fields_view_prefix + target_table, meta, autoload=True, autoload_with=conn.engine)
+        self.names = []
+        self.colspecs = []
+        self.types = {}
+        self.db_types = {}
+        self.np_types = {}
+        self.na_values = {}
+        for row in conn.execute(select([fields])):
+            col = row[fields.c.friendly_header]
+            self.names.append(col)
+            # start and end index in the fixed-width record
+            self.colspecs.append((row[fields.c.start_base_zero], row[fields.c.end_base_zero]))
+            self.types[col] = row[fields.c.type]
+            self.db_types[col] = get_data_type(row[fields.c.type], row[fields.c.length])
+            self.np_types[col] = np.dtype(get_np_data_type(row[fields.c.type]))
+            if row[fields.c.type] != 'VARCHAR':
+                self.na_values[col] = np.atleast_1d(get_np_na_value(row[fields.c.length]))
+        self.record_length = max(end for _, end in self.colspecs)
+        # every column as a fixed-size bytes field at its offset in the record
+        self.record_dtype = np.dtype({
+            'names': self.names,
+            'formats': [f"S{end - start}" for start, end in self.colspecs],
+            'offsets': [start for start, _ in self.colspecs],
+            'itemsize': self.record_length
+        })
+
+    def chunk_rows(self):
+        # larger chunks for narrower records
+        return(int(min(max(chunk_bytes // (self.record_length + 1), min_chunk_rows), max_chunk_rows)))
+
+
+def create_target_table(engine, spec, target_table):
+    # Empty target table with an id column and the metadata's types. If the table already exists, replace it.
+    table = Table(target_table, MetaData(schema=raw_schema),
+                  Column('id', BigInteger),
+                  *[Column(col, spec.db_types[col]) for col in spec.names])
+    table.drop(engine, checkfirst=True)
+    table.create(engine)
+    return(table)
+
+
+def read_records(filename, spec, chunk_rows):
+    # Yields record arrays of up to chunk_rows lines. Short lines are padded with NULs, which read as blanks.
+    opener = gzip.open if filename.endswith('.gz') else open
+    block_size = chunk_rows * (spec.record_length + 1)
+    rest = b''
+    with opener(filename, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind(b'\n')
+            if end < 0:
+                rest = block
+                continue
+            rest = block[end + 1:]
+            lines = block[:end].replace(b'\r', b'').split(b'\n')
+            yield np.array(lines, dtype=f"S{spec.record_length}").view(spec.record_dtype)
+        if rest.strip(b'\r'):
+            yield np.array([rest.replace(b'\r', b'')], dtype=f"S{spec.record_length}").view(spec.record_dtype)
+
+
+def blank_mask(values):
+    # True where a fixed-width bytes field holds only spaces (or padding)
+    width = values.dtype.itemsize
+    raw = np.ascontiguousarray(values).view(np.uint8).reshape(len(values), width)
+    return(((raw == 32) | (raw == 0)).all(axis=1))
+
+
+def column_text(values, np_type, na_values=None):
+    # COPY text of one column, \N for blank fields and na values
+    null = blank_mask(values)
+    out = np.full(len(values), '\\N', dtype=object)
+    if np_type.kind in 'iuf':
+        typed = values[~null].astype(np_type)
+        keep = ~np.isin(typed, na_values.astype(np_type)) if na_values is not None else np.ones(len(typed), dtype=bool)
+        idx = np.flatnonzero(~null)[keep]
+        out[idx] = typed[keep].astype(str)
+    elif not null.all():
+        text = np.char.decode(np.char.strip(values[~null]), 'latin-1')
+        text = np.char.replace(np.char.replace(np.char.replace(text, '\\', '\\\\'), '\t', '\\t'), '\n', '\\n')
+        out[~null] = text
+    return(out)
+
+
+def render_chunk(records, spec, id_start):
+    # Tab separated COPY text of a record array, with ids from id_start
+    columns = [np.arange(id_start, id_start + len(records)).astype(str)]
+    for col in spec.names:
+        columns.append(column_text(records[col], spec.np_types[col], spec.na_values.get(col)))
+    return('\n'.join(map('\t'.join, zip(*columns))) + '\n')
+
+
+def copy_writer(raw_conn, target, chunks, errors):
+    # COPYs and commits rendered chunks until None arrives
+    cur = raw_conn.cursor()
+    while True:
+        item = chunks.get()
+        if item is None:
+            return
+        if errors:
+            continue
+        payload, label = item
+        try:
+            cur.copy_expert(f"COPY {target} FROM STDIN", io.StringIO(payload))
+            raw_conn.commit()
+            print(label)
+        except Exception as e:
+            raw_conn.rollback()
+            errors.append(e)
+
+
+def load_fixed_width_file(engine, raw_conn, spec, filename, target_table, label=''):
+    # Creates the target table and loads the file into it. Returns the number of records.
+    create_target_table(engine, spec, target_table)
+    chunk_rows = spec.chunk_rows()
+    chunks = queue.Queue(maxsize=queue_size)
+    errors = []
+    writer = threading.Thread(target=copy_writer, args=(raw_conn, raw_schema + '.' + target_table, chunks, errors), daemon=True)
+    writer.start()
+    nrow = 0
+    try:
+        for i, records in enumerate(read_records(filename, spec, chunk_rows)):
+            if errors:
+                break
+            chunks.put((render_chunk(records, spec, first_id + nrow), label + str(nrow + len(records))))
+            nrow = nrow + len(records)
+            if limit_chunks > 0 and i == limit_chunks - 1:
                 break
+    finally:
+        chunks.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    return(nrow)
+
+
+def main():
+    # Instantiate DB engine
+    engine = create_engine(connection_string, echo=False)
+
+    # Obtain connection to metadata schema
+    meta = MetaData(schema=metadata_schema)
+
+    # The SQLAlchemy connection to the database
+    conn = engine.connect()
+    # A raw psycopg2 DB connection, used by the COPY thread
+    raw_conn = engine.raw_connection()
+
+    # Get list of files based on the settings
+    files = Table(files_table, meta, autoload=True, autoload_with=engine)
+    files_view = conn.execute(select([files])).fetchall()
+
+    # Loop through the files that we are importing into the database
+    for file in files_view:
+        # Obtain file characteristics for each file from the file record.
+        year = file[files.c.year]
+        fraction = file[files.c.fraction]
+        file_type = file[files.c.type]
+        file = file[files.c.name]
+
+        # Construct import table name from file record characteristics
+        target_table = file_type.lower() + "_" + fraction.lower() + "_" + str(year)
+        spec = FixedWidthSpec(conn, meta, target_table)
+
+        # Grab the import file from the file system
+        filename = os.path.join(data_file_directory, str(year), file_type, file)
+        t1 = time.perf_counter()
+        nrow = load_fixed_width_file(engine, raw_conn, spec, filename, target_table,
+                                     file + ', ' + file_type + ", " + str(year) + ', ' + fraction + ': ')
+        t2 = time.perf_counter()
+        print(f"{file}: {nrow} records in {t2-t1:0.4f} seconds")
+
+    raw_conn.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import threading
+import pytest
+import copy_writer
+from copy_writer import CopyWriter
+
+class FakeConnection():
+    def __init__(self, fail_copy=False, fail_rollback=False):
+        self.fail_copy = fail_copy
+        self.fail_rollback = fail_rollback
+        self.copied = []
+        self.invalidated = False
+
+    def cursor(self):
+        return(self)
+
+    def copy_from(self, f, table, sep, null, size):
+        if self.fail_copy:
+            raise ValueError('bad row')
+        self.copied.append(f.read())
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        if self.fail_rollback:
+            raise OSError('connection lost')
+
+    def invalidate(self):
+        self.invalidated = True
+
+    def close(self):
+        pass
+
+class FakeEngine():
+    def __init__(self, conns):
+        self.conns = list(conns)
+
+    def raw_connection(self):
+        conn = self.conns.pop(0)
+        if isinstance(conn, Exception):
+            raise conn
+        return(conn)
+
+def test_batches_are_copied(monkeypatch):
+    conn = FakeConnection()
+    monkeypatch.setattr(copy_writer, 'engine', FakeEngine([conn]))
+    w = CopyWriter(num_connections=1)
+    w.submit('1\ta\n', 1, tag='x')
+    w.submit('2\tb\n', 1, tag='y')
+    results = w.close()
+    assert [(r[0], r[1], r[4]) for r in results] == [('x', 1, None), ('y', 1, None)]
+    assert conn.copied == ['1\ta\n', '2\tb\n']
+
+def test_connect_failure_is_the_batch_error(monkeypatch):
+    monkeypatch.setattr(copy_writer, 'engine', FakeEngine([OSError('refused'), FakeConnection()]))
+    w = CopyWriter(num_connections=1)
+    w.submit('1\ta\n', 1, tag='x')
+    w.submit('2\tb\n', 1, tag='y')
+    results = w.close()
+    assert isinstance(results[0][4], OSError)
+    assert results[1][4] is None
+
+def test_broken_connection_is_replaced(monkeypatch):
+    broken = FakeConnection(fail_copy=True, fail_rollback=True)
+    good = FakeConnection()
+    monkeypatch.setattr(copy_writer, 'engine', FakeEngine([broken, good]))
+    w = CopyWriter(num_connections=1)
+    w.submit('1\ta\n', 1, tag='x')
+    w.submit('2\tb\n', 1, tag='y')
+    results = w.close()
+    assert isinstance(results[0][4], ValueError)
+    assert broken.invalidated
+    assert results[1][4] is None
+    assert good.copied == ['2\tb\n']
+
+def test_dead_thread_does_not_block(monkeypatch):
+    release = threading.Event()
+    def die(self, i):
+        # exits leaving its queued batch behind
+        release.wait()
+    monkeypatch.setattr(CopyWriter, '_run', die)
+    w = CopyWriter(num_connections=1, queue_size=1)
+    w.submit('1\ta\n', 1, tag='x')
+    release.set()
+    w.threads[0].join()
+    w.submit('2\tb\n', 1, tag='y')
+    results = w.close()
+    assert sorted(r[0] for r in results) == ['x', 'y']
+    assert all(isinstance(r[4], RuntimeError) for r in results)
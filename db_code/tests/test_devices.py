@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import devices
+from devices import DeviceCache
+
+def cache(ids, keys):
+    c = DeviceCache()
+    c.index = pd.Index(ids, dtype=object)
+    c.keys = np.array(keys, dtype=np.int64)
+    return(c)
+
+def test_empty_cache():
+    assert DeviceCache()._lookup(np.array(['a', 'b'], dtype=object)).tolist() == [-1, -1]
+
+def test_unknown_ids():
+    c = cache(['a', 'b'], [10, 20])
+    assert c._lookup(np.array(['b', 'x', 'a'], dtype=object)).tolist() == [20, -1, 10]
+
+def test_ids_only_in_extra():
+    c = DeviceCache()
+    c.extra = {'n': 7}
+    assert c._lookup(np.array(['n', 'x'], dtype=object)).tolist() == [7, -1]
+    c = cache(['a'], [1])
+    c.extra = {'n': 7}
+    assert c._lookup(np.array(['a', 'n', 'x'], dtype=object)).tolist() == [1, 7, -1]
+
+def test_map_without_cursor_keeps_rows(monkeypatch):
+    monkeypatch.setattr(devices, 'integer_device_keys', True)
+    c = cache(['a'], [1])
+    out = c.map(pd.Series(['a', 'x', 'a']))
+    assert out.tolist() == [1, None, 1]
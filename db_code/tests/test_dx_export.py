@@ -0,0 +1,91 @@
+from dx_export import TokenBucket, RateLimitedClient, JobStore, plan_exports, run_exports, COMPLETED, FAILED
+from dx_stub import StubDataExchange
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return(self.now)
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now = self.now + seconds
+
+def client(stub):
+    return(RateLimitedClient(stub, rates={}, default_rate=10000, sleep=lambda s: None))
+
+def planned(stub, **kwargs):
+    store = JobStore()
+    plan_exports(client(stub), store, 'ds', **kwargs)
+    return(store)
+
+def run(stub, store, max_attempts=3):
+    return(run_exports(client(stub), store, 'ds', 'bucket', poll_interval=0.0, max_attempts=max_attempts, sleep=lambda s: None))
+
+def test_token_bucket_limits_and_refills():
+    clock = FakeClock()
+    bucket = TokenBucket(2, clock=clock, sleep=clock.sleep)
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.slept == []
+    bucket.acquire()
+    assert clock.slept == [0.5]
+    # idle time never refills past capacity
+    clock.now = clock.now + 100
+    bucket.acquire()
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.slept == [0.5, 0.5]
+
+def test_plan_skips_assets_republished_by_a_newer_revision():
+    stub = StubDataExchange(num_revisions=3, assets_per_revision=5, duplicate_every=2, requests_per_second=1000)
+    store = planned(stub, assets_per_job=2)
+    old, first, republished = [r['Id'] for r in stub.revisions]
+    assert store.revisions[first]['exported'] == 0
+    assert store.revisions[republished]['exported'] == 5
+    assert store.revisions[old]['exported'] == 5
+    assert len(store.jobs) == 6
+    # planning again adds nothing
+    plan_exports(client(stub), store, 'ds', assets_per_job=2)
+    assert len(store.jobs) == 6
+
+class FailingOnce(StubDataExchange):
+    # every job ends in ERROR the first time it runs
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.failed = set()
+
+    def get_job(self, JobId):
+        resp = super().get_job(JobId)
+        key = tuple(d['Key'] for d in self.jobs[JobId]['Details']['ExportAssetsToS3']['AssetDestinations'])
+        if key not in self.failed:
+            self.failed.add(key)
+            return({'Id': JobId, 'State': 'ERROR', 'Errors': [{'Code': 'stub'}]})
+        return(resp)
+
+def test_failed_jobs_are_retried():
+    stub = FailingOnce(num_revisions=2, assets_per_revision=3, duplicate_every=0, requests_per_second=1000, job_seconds=0.0)
+    store = planned(stub)
+    assert run(stub, store) == {COMPLETED: 2}
+    assert all(j['attempts'] == 2 for j in store.jobs.values())
+
+class Unreadable(StubDataExchange):
+    def get_job(self, JobId):
+        raise RuntimeError('connection reset')
+
+def test_gives_up_on_jobs_that_cannot_be_read():
+    stub = Unreadable(num_revisions=1, assets_per_revision=3, requests_per_second=1000)
+    store = planned(stub)
+    assert run(stub, store, max_attempts=2) == {FAILED: 1}
+    job = next(iter(store.jobs.values()))
+    assert job['poll_failures'] == 2
+
+def test_permanent_failure():
+    stub = StubDataExchange(num_revisions=1, assets_per_revision=3, requests_per_second=1000, job_seconds=0.0, error_rate=1.0)
+    store = planned(stub)
+    assert run(stub, store, max_attempts=3) == {FAILED: 1}
+    job = next(iter(store.jobs.values()))
+    assert job['attempts'] == 3
+    assert stub.exported == []
@@ -0,0 +1,42 @@
+import gzip
+import pytest
+import init_file_list
+from init_file_list import count_rows
+
+def write(path, data):
+    if str(path).endswith('.gz'):
+        data = gzip.compress(data)
+    path.write_bytes(data)
+    return(str(path))
+
+@pytest.fixture(params=['part.csv', 'part.csv.gz'])
+def name(request):
+    return(request.param)
+
+@pytest.mark.parametrize('data, rows', [
+    (b'', 0),
+    (b'a,b\n', 0),
+    (b'a,b', 0),
+    (b'a,b\n1,2\n3,4\n', 2),
+    (b'a,b\n1,2\n3,4', 2),
+])
+def test_counts_data_rows(tmp_path, name, data, rows):
+    path = write(tmp_path / name, data)
+    assert count_rows(path)[:2] == (path, rows)
+
+def test_small_blocks(tmp_path, name, monkeypatch):
+    monkeypatch.setattr(init_file_list, 'read_block_size', 3)
+    data = b'a,b\n' + b''.join(f"{i},x\n".encode() for i in range(100)) + b'100,y'
+    path = write(tmp_path / name, data)
+    assert count_rows(path)[1] == 101
+
+def test_concatenated_gzip_members(tmp_path):
+    path = tmp_path / 'part.csv.gz'
+    path.write_bytes(gzip.compress(b'a,b\n1,2\n') + gzip.compress(b'3,4\n5,6'))
+    assert count_rows(str(path))[1] == 3
+
+def test_fingerprint_follows_content(tmp_path):
+    a = write(tmp_path / 'a.csv', b'a,b\n1,2\n')
+    b = write(tmp_path / 'b.csv', b'a,b\n1,2\n')
+    c = write(tmp_path / 'c.csv', b'a,b\n1,3\n')
+    assert count_rows(a)[2] == count_rows(b)[2] != count_rows(c)[2]
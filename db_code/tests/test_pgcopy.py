@@ -0,0 +1,68 @@
+import struct
+import numpy as np
+import pandas as pd
+import pytest
+import pgcopy
+
+def decode(payload, types):
+    # rows of a binary COPY body (no header/trailer), None for NULL
+    rows = []
+    pos = 0
+    while pos < len(payload):
+        (nfields,) = struct.unpack_from('!h', payload, pos)
+        assert nfields == len(types)
+        pos = pos + 2
+        row = []
+        for pg_type in types:
+            (n,) = struct.unpack_from('!i', payload, pos)
+            pos = pos + 4
+            if n == -1:
+                row.append(None)
+                continue
+            raw = payload[pos:pos + n]
+            pos = pos + n
+            if pg_type == 'text':
+                row.append(raw.decode('utf-8'))
+            elif pg_type == 'timestamptz':
+                row.append(struct.unpack('!q', raw)[0] + pgcopy.PG_EPOCH_US)
+            else:
+                fmt = {'int2': '!h', 'int4': '!i', 'int8': '!q', 'float8': '!d'}[pg_type]
+                row.append(struct.unpack(fmt, raw)[0])
+        rows.append(row)
+    return(rows)
+
+def test_round_trip_with_nulls():
+    fields = [
+        ('int2', pd.Series([1, None, -32768], dtype='Int64')),
+        ('int4', [2**31 - 1, 0, -5]),
+        ('int8', [2**40, 7, None]),
+        ('float8', [1.5, np.nan, -0.25]),
+        ('timestamptz', [1580515200, None, 0]),
+        ('text', ['café', None, ''])
+    ]
+    rows = decode(pgcopy.encode_tuples(fields), [t for t, _ in fields])
+    assert rows == [
+        [1, 2**31 - 1, 2**40, 1.5, 1580515200 * 1000000, 'café'],
+        [None, 0, 7, None, None, None],
+        [-32768, -5, None, -0.25, 0, '']
+    ]
+
+def test_datetime_timestamps():
+    ts = pd.Series(pd.to_datetime([1580515200, 1580515201], unit='s', utc=True))
+    rows = decode(pgcopy.encode_tuples([('timestamptz', ts)]), ['timestamptz'])
+    assert rows == [[1580515200 * 1000000], [1580515201 * 1000000]]
+
+def test_header_and_trailer():
+    assert pgcopy.HEADER.startswith(b'PGCOPY\n\xff\r\n\x00')
+    assert len(pgcopy.HEADER) == 19
+    assert pgcopy.TRAILER == b'\xff\xff'
+
+@pytest.mark.parametrize('pg_type, value', [('int4', 2**31 + 5), ('int4', -2**31 - 1), ('int2', 40000)])
+def test_out_of_range_integers(pg_type, value):
+    with pytest.raises(ValueError):
+        pgcopy.encode_tuples([(pg_type, [1, value])])
+
+def test_compact_floats_keep_their_decimal_value():
+    from init_xmode_db import float8_values
+    values = pd.Series([1.1, np.nan, 0.3], dtype='float32')
+    assert decode(pgcopy.encode_tuples([('float8', float8_values(values))]), ['float8']) == [[1.1], [None], [0.3]]
@@ -0,0 +1,14 @@
+import os
+from ping_io import staged_path
+
+def test_staged_names_differ_by_source_path():
+    a = staged_path('s3://bucket/2020/01/01/part-00000-x-c000.csv.gz', '/stage')
+    b = staged_path('s3://bucket/2020/01/02/part-00000-x-c000.csv.gz', '/stage')
+    assert a != b
+    assert os.path.dirname(a) == '/stage'
+    assert os.path.basename(a).startswith('part-00000-x-c000-')
+    assert a.endswith('.parquet')
+
+def test_staged_name_is_stable(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert staged_path('part-0.csv.gz', '/stage') == staged_path(str(tmp_path / 'part-0.csv.gz'), '/stage')
@@ -0,0 +1,48 @@
+import io
+import random
+import re
+import pytest
+from sanitize import SanitizingReader, sanitized
+
+def reference(data):
+    # the whole input cleaned at once: NULs dropped, tabs to spaces, a line
+    # break after an odd run of backslashes to a space
+    data = data.replace(b'\x00', b'').replace(b'\t', b' ')
+    return(re.sub(rb'(?<!\\)((?:\\\\)*)\\\r?\n', rb'\1 ', data))
+
+def read_all(data, block_size):
+    r = SanitizingReader(io.BytesIO(data), block_size=block_size)
+    out = bytearray()
+    buf = bytearray(7)
+    while True:
+        n = r.readinto(buf)
+        if not n:
+            break
+        out.extend(buf[:n])
+    return(bytes(out), r)
+
+def random_input(rng, n):
+    alphabet = [b'a', b',', b'\\', b'\\', b'\r', b'\n', b'\x00', b'\t']
+    return(b''.join(rng.choice(alphabet) for _ in range(n)))
+
+@pytest.mark.parametrize('seed', range(20))
+def test_block_boundaries_do_not_change_output(seed):
+    rng = random.Random(seed)
+    data = random_input(rng, 300)
+    expected = reference(data)
+    whole, r = read_all(data, len(data) + 1)
+    assert whole == expected
+    for block_size in (1, 2, 3, 5, 8, 64):
+        out, rb = read_all(data, block_size)
+        assert out == expected, block_size
+        assert (rb.nul_bytes, rb.tabs, rb.line_breaks) == (r.nul_bytes, r.tabs, r.line_breaks)
+
+def test_escapes():
+    data = b'a\\\nb,c\\\\\nd,e\\\r\nf,g\t\x00h\n'
+    out, r = read_all(data, 2)
+    assert out == b'a b,c\\\\\nd,e f,g h\n'
+    assert (r.nul_bytes, r.tabs, r.line_breaks) == (1, 1, 2)
+
+def test_trailing_backslashes_are_kept_at_eof():
+    with sanitized(io.BytesIO(b'x\\\\\x00'), block_size=1) as f:
+        assert f.read() == b'x\\\\'
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import spatial
+
+def covered(cells, ranges):
+    starts = np.array([r[0] for r in ranges])
+    ends = np.array([r[1] for r in ranges])
+    pos = np.searchsorted(starts, cells, side='right') - 1
+    return((pos >= 0) & (cells < ends[np.maximum(pos, 0)]))
+
+@pytest.mark.parametrize('box', [
+    (30.0, 30.5, -97.9, -97.5),
+    (29.99, 30.01, -98.0001, -97.9999),
+    (-10.0, 10.0, -5.0, 5.0),
+    (25.8, 36.6, -106.7, -93.5)
+])
+@pytest.mark.parametrize('max_cells', [1, 16, 64])
+def test_ranges_cover_box(box, max_cells):
+    lat_min, lat_max, lng_min, lng_max = box
+    rng = np.random.default_rng(0)
+    lat = np.r_[rng.uniform(lat_min, lat_max, 5000), lat_min, lat_max, lat_min, lat_max]
+    lng = np.r_[rng.uniform(lng_min, lng_max, 5000), lng_min, lng_max, lng_max, lng_min]
+    ranges = spatial.cell_ranges(lat_min, lat_max, lng_min, lng_max, max_cells)
+    assert len(ranges) <= max_cells
+    cells = spatial.cell_ids(lat, lng).astype(np.int64)
+    assert covered(cells, ranges).all()
+
+def test_ranges_are_sorted_and_merged():
+    ranges = spatial.cell_ranges(30.0, 30.5, -97.9, -97.5, 64)
+    for (s0, e0), (s1, e1) in zip(ranges, ranges[1:]):
+        assert s0 < e0 < s1 < e1
+
+def test_cell_ids_missing_coordinates():
+    out = spatial.cell_ids([30.0, np.nan, 30.0], [-97.0, -97.0, np.nan])
+    assert out[0] is not None and out[1] is None and out[2] is None
+
+def test_cell_ids_nest():
+    # the cell one level up is the cell with its last two bits dropped
+    lat = np.array([30.2672, -33.8688, 51.5074])
+    lng = np.array([-97.7431, 151.2093, -0.1278])
+    cells = spatial.cell_ids(lat, lng).astype(np.int64)
+    i, j = spatial._quantize(lat, lng, spatial.CELL_BITS - 1)
+    assert (cells >> 2 == spatial._morton(i, j)).all()
+
+def test_haversine():
+    # one degree of latitude is about 111.2 km
+    assert spatial.haversine(30.0, -97.0, 31.0, -97.0) == pytest.approx(111195, rel=1e-3)
+    assert spatial.haversine(30.0, -97.0, 30.0, -97.0) == 0
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+import spatial
+import stays
+
+def reference_stays(t, lat, lng, group, distance, duration, max_gap):
+    # one ping at a time: extend from the anchor while the next ping is close
+    # and not after a gap or device change
+    n = len(t)
+    y = np.radians(lat) * spatial.EARTH_RADIUS
+    x = np.radians(lng) * spatial.EARTH_RADIUS
+    first = []
+    last = []
+    i = 0
+    while i < n:
+        scale = np.cos(np.radians(lat[i]))
+        j = i
+        while (j + 1 < n and group[j + 1] == group[i] and t[j + 1] - t[j] <= max_gap and
+               ((x[j + 1] - x[i]) * scale)**2 + (y[j + 1] - y[i])**2 <= distance * distance):
+            j = j + 1
+        if t[j] - t[i] >= duration:
+            first.append(i)
+            last.append(j)
+            i = j + 1
+        else:
+            i = i + 1
+    return(first, last)
+
+def synthetic_pings(seed, n_devices=5, n=600):
+    # devices wander between a few places, pausing at them, with some gaps
+    rng = np.random.default_rng(seed)
+    t, lat, lng, group = [], [], [], []
+    for d in range(n_devices):
+        places = rng.uniform([30.0, -98.0], [30.1, -97.9], size=(4, 2))
+        step = rng.integers(30, 600, n)
+        step[rng.random(n) < 0.02] = 7200
+        ts = 1580515200 + np.cumsum(step)
+        place = places[np.repeat(rng.integers(0, 4, n // 20 + 1), 20)[:n]]
+        jitter = rng.normal(0, rng.choice([0.0003, 0.003]), size=(n, 2))
+        t.append(ts)
+        lat.append(place[:, 0] + jitter[:, 0])
+        lng.append(place[:, 1] + jitter[:, 1])
+        group.append(np.full(n, d))
+    return(np.concatenate(t), np.concatenate(lat), np.concatenate(lng), np.concatenate(group))
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('distance, duration, max_gap', [(200.0, 1200, 3600), (50.0, 600, 900), (1000.0, 3600, 3600)])
+def test_matches_reference(seed, distance, duration, max_gap):
+    t, lat, lng, group = synthetic_pings(seed)
+    first, last = stays.detect_stays(t, lat, lng, group, distance, duration, max_gap)
+    ref_first, ref_last = reference_stays(t, lat, lng, group, distance, duration, max_gap)
+    assert len(ref_first) > 0
+    assert first.tolist() == ref_first
+    assert last.tolist() == ref_last
+
+def test_reach_beyond_window():
+    # one long stay needs several rounds of the doubling window
+    n = 500
+    t = np.arange(n) * 60
+    lat = np.full(n, 30.0)
+    lng = np.full(n, -97.0)
+    reach = stays.stay_reach(t, lat, lng, np.zeros(n), 200.0, 3600)
+    assert reach[0] == n - 1
+    first, last = stays.detect_stays(t, lat, lng)
+    assert first.tolist() == [0] and last.tolist() == [n - 1]
+
+def test_stays_do_not_cross_devices():
+    t = np.r_[np.arange(40) * 60, np.arange(40) * 60]
+    lat = np.full(80, 30.0)
+    lng = np.full(80, -97.0)
+    group = np.repeat([0, 1], 40)
+    first, last = stays.detect_stays(t, lat, lng, group, duration=600)
+    assert first.tolist() == [0, 40] and last.tolist() == [39, 79]
+
+def test_empty():
+    first, last = stays.detect_stays([], [], [])
+    assert len(first) == 0 and len(last) == 0
+
+def test_summarize():
+    t = np.arange(6) * 600
+    lat = np.array([30.0, 30.0002, 30.0004, 31.0, 31.0, 31.0])
+    lng = np.full(6, -97.0)
+    venue = np.array([np.nan, 5, 5, 7, np.nan, 8])
+    out = stays.summarize_stays(np.array([0, 3]), np.array([2, 5]), t, lat, lng, venue)
+    assert out['n_pings'].tolist() == [3, 3]
+    assert out['latitude'].tolist() == pytest.approx([30.0002, 31.0])
+    assert out['start_at'].tolist() == [0, 1800]
+    assert out['end_at'].tolist() == [1200, 3000]
+    assert out['venue_id'][0] == 5
@@ -0,0 +1,58 @@
+import gzip
+import os
+import pytest
+import storage
+from s3_stub import DirectoryClient, StubClientError
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, '_clients', {})
+    c = DirectoryClient(str(tmp_path))
+    storage.set_client(c)
+    return(c)
+
+def put(client, key, data):
+    path = os.path.join(client.root, 'bucket', key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+@pytest.mark.parametrize('part_size, prefetch', [(1, 1), (7, 2), (64, 3), (1000, 4)])
+def test_ranged_reader_returns_every_byte(client, part_size, prefetch):
+    data = bytes(range(256)) * 3
+    put(client, 'obj', data)
+    r = storage.RangedReader(client, 'bucket', 'obj', part_size=part_size, prefetch=prefetch, threads=2)
+    out = bytearray()
+    buf = bytearray(5)
+    while True:
+        n = r.readinto(buf)
+        if not n:
+            break
+        out.extend(buf[:n])
+    r.close()
+    assert bytes(out) == data
+    assert r.bytes_read == len(data)
+    assert client.requests == -(-len(data) // part_size)
+
+def test_empty_object(client):
+    put(client, 'empty', b'')
+    r = storage.RangedReader(client, 'bucket', 'empty')
+    assert r.readinto(bytearray(10)) == 0
+    r.close()
+
+def test_open_file_decompresses(client):
+    text = ''.join(f"{i},line {i}\n" for i in range(5000))
+    put(client, 'dir/part-0.csv.gz', gzip.compress(text.encode()))
+    with storage.open_file('s3://bucket/dir/part-0.csv.gz', 'rt') as f:
+        assert f.read() == text
+
+def test_list_files_pages(client):
+    client.page_size = 2
+    for i in range(5):
+        put(client, f"dir/part-{i}.csv.gz", b'')
+    put(client, 'dir/notes.txt', b'')
+    assert storage.list_files('s3://bucket/dir') == [f"s3://bucket/dir/part-{i}.csv.gz" for i in range(5)]
+
+def test_missing_object(client):
+    with pytest.raises(StubClientError):
+        storage.stat('s3://bucket/missing.gz')
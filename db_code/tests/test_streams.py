@@ -0,0 +1,38 @@
+from streams import CopyStream
+
+def test_read_across_blocks():
+    s = CopyStream(['a\tb\n', '', 'c\td\n', 'e\tf\n'])
+    assert s.read(3) == 'a\tb'
+    assert s.read(4) == '\nc\td'
+    assert s.read() == '\ne\tf\n'
+    assert s.read() == ''
+    assert s.bytes_read == 12
+
+def test_readline_joins_split_lines():
+    s = CopyStream(['1\tx', 'y\n2\t', 'z\n', '3'])
+    assert s.readline() == '1\txy\n'
+    assert s.readline() == '2\tz\n'
+    assert s.readline() == '3'
+    assert s.readline() == ''
+
+def test_binary_blocks():
+    blocks = (bytes([i]) * 5 for i in range(4))
+    s = CopyStream(blocks, binary=True)
+    out = []
+    while True:
+        part = s.read(3)
+        if not part:
+            break
+        out.append(part)
+    assert b''.join(out) == b''.join(bytes([i]) * 5 for i in range(4))
+    assert s.bytes_read == 20
+
+def test_blocks_are_consumed_lazily():
+    consumed = []
+    def blocks():
+        for i in range(3):
+            consumed.append(i)
+            yield f"{i}\n"
+    s = CopyStream(blocks())
+    assert s.read(2) == '0\n'
+    assert consumed == [0]
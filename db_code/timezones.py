@@ -0,0 +1,110 @@
+import logging
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from timezonefinder import TimezoneFinder
+
+#---
+# Batch timezone resolution
+#
+# Coordinates are quantized to a grid of cell_size degrees. The zone at every
+# grid vertex is memoized in an LRU cache, and a cell whose four corners agree
+# is treated as interior to that zone. Points in cells that straddle a border
+# are looked at again on a grid refine times finer, and only points still in a
+# border cell there go to the exact polygon lookup. One call resolves a whole
+# chunk of lat/lng arrays with a few lookups per distinct cell.
+
+BORDER = ''
+
+# offset/stride packing a pair of cell indices into one int64 key
+_OFF = 1 << 22
+
+class TimezoneGrid():
+    def __init__(self, cell_size=0.05, refine=16, maxsize=500000, finder=None):
+        self.cell_sizes = [cell_size, cell_size / refine]
+        self.maxsize = maxsize
+        self.tf = finder or TimezoneFinder()
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.exact = 0
+
+    def _cached(self, key, compute):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.hits = self.hits + 1
+            return(self._cache[key])
+        self.misses = self.misses + 1
+        value = compute()
+        self._cache[key] = value
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return(value)
+
+    def vertex_zone(self, level, i, j):
+        s = self.cell_sizes[level]
+        return(self._cached(('v', level, i, j), lambda: self.tf.timezone_at(lng=j * s, lat=i * s)))
+
+    def cell_zone(self, level, i, j):
+        def compute():
+            zones = set([
+                self.vertex_zone(level, i, j), self.vertex_zone(level, i + 1, j),
+                self.vertex_zone(level, i, j + 1), self.vertex_zone(level, i + 1, j + 1)
+            ])
+            if len(zones) == 1:
+                return(zones.pop())
+            return(BORDER)
+        return(self._cached(('c', level, i, j), compute))
+
+    def preload(self, lat_min, lat_max, lng_min, lng_max):
+        # fill the cache for a bounding box, e.g. the state being loaded
+        t1 = time.perf_counter()
+        s = self.cell_sizes[0]
+        n = 0
+        for i in range(int(np.floor(lat_min / s)), int(np.floor(lat_max / s)) + 1):
+            for j in range(int(np.floor(lng_min / s)), int(np.floor(lng_max / s)) + 1):
+                self.cell_zone(0, i, j)
+                n = n + 1
+        t2 = time.perf_counter()
+        logging.info(f"\tpreloaded {n} timezone cells: {t2-t1:0.4f} seconds")
+
+    def _resolve_level(self, level, lat, lng):
+        s = self.cell_sizes[level]
+        key = (np.floor(lat / s).astype(np.int64) + _OFF) * (2 * _OFF) + (np.floor(lng / s).astype(np.int64) + _OFF)
+        cells, inverse = np.unique(key, return_inverse=True)
+        i, j = np.divmod(cells, 2 * _OFF)
+        zones = np.array([self.cell_zone(level, int(a), int(b)) for a, b in zip(i - _OFF, j - _OFF)], dtype=object)
+        return(zones[inverse.reshape(-1)])
+
+    def resolve(self, lat, lng):
+        # returns an object array of zone names, None where no zone is found
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        out = np.full(len(lat), BORDER, dtype=object)
+        todo = np.flatnonzero(~(np.isnan(lat) | np.isnan(lng)))
+        out[np.isnan(lat) | np.isnan(lng)] = None
+
+        for level in range(0, len(self.cell_sizes)):
+            if len(todo) == 0:
+                break
+            zones = self._resolve_level(level, lat[todo], lng[todo])
+            out[todo] = zones
+            todo = todo[zones == BORDER]
+
+        # exact lookups for what is left, once per distinct coordinate
+        if len(todo):
+            codes, uniques = pd.factorize(pd.MultiIndex.from_arrays([lat[todo], lng[todo]]))
+            exact = np.array([self.tf.timezone_at(lng=u[1], lat=u[0]) for u in uniques], dtype=object)
+            out[todo] = exact[codes]
+            self.exact = self.exact + len(uniques)
+        return(out)
+
+def localize(location_at, zones):
+    # local wall-clock times for epoch seconds, one vectorized conversion per zone
+    utc = pd.to_datetime(pd.Series(location_at), unit='s', utc=True)
+    zones = pd.Series(zones, index=utc.index)
+    out = pd.Series(pd.NaT, index=utc.index, dtype='datetime64[ns]')
+    for zone, idx in zones.groupby(zones).groups.items():
+        out[idx] = utc[idx].dt.tz_convert(zone).dt.tz_localize(None)
+    return(out)
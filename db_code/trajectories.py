@@ -0,0 +1,169 @@
+import itertools
+import numpy as np
+import pandas as pd
+from sqlalchemy import Integer, BigInteger, SmallInteger, Float, DateTime
+from utils import Pings, ping_dictionaries
+from config import engine, integer_device_keys
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+#---
+# Trajectory read path
+#
+# Pings are streamed in (device_id, location_at) order through a named
+# (server-side) cursor, so only one batch of rows is ever held by the client,
+# and each batch is turned into one NumPy array (or Arrow array) per column
+# without building ORM objects. The ix_pings_device_location index serves
+# both the device filter and the ordering; a location_at window also prunes
+# partitions when pings is partitioned.
+#
+#   for device_id, traj in iter_trajectories(['a1b2...'], t_start, t_end):
+#       traj['location_at'], traj['latitude'], traj['longitude']
+
+default_columns = ('location_at', 'latitude', 'longitude')
+
+_cursor_count = itertools.count()
+
+def column_dtype(column):
+    t = column.type
+    if isinstance(t, Float):
+        return(np.float64)
+    if isinstance(t, (Integer, BigInteger, SmallInteger)) and column.name not in ping_dictionaries:
+        # nullable integers come back as float so None can be NaN
+        return(np.float64 if column.nullable else np.int64)
+    if isinstance(t, DateTime):
+        return('datetime64[us]')
+    return(object)
+
+def to_array(values, dtype):
+    if dtype == 'datetime64[us]':
+        return(pd.to_datetime(pd.Series(values), utc=True).dt.tz_localize(None).to_numpy(dtype='datetime64[us]'))
+    return(np.array(values, dtype=dtype))
+
+def device_keys(cur, device_ids):
+    # advertiser_id -> device.key for the ids that exist
+    cur.execute("SELECT id, key FROM device WHERE id = ANY(%s)", (list(device_ids),))
+    return(dict(cur.fetchall()))
+
+def trajectory_query(columns, device_ids=None, t_start=None, t_end=None):
+    # SQL and parameters for the ordered scan; device_ids are values of
+    # pings.device_id (device keys when integer_device_keys is set)
+    table = Pings.__table__
+    for c in columns:
+        if c not in table.columns:
+            raise KeyError(f"pings has no column {c}")
+    # encoded string columns are read back as text through the view
+    source = 'pings_text' if any(c in ping_dictionaries for c in columns) else 'pings'
+    where = []
+    params = []
+    if device_ids is not None:
+        where.append("device_id = ANY(%s)")
+        params.append(list(device_ids))
+    if t_start is not None:
+        where.append("location_at >= %s")
+        params.append(int(t_start))
+    if t_end is not None:
+        where.append("location_at < %s")
+        params.append(int(t_end))
+    sql = f"SELECT device_id, {', '.join(columns)} FROM {source}"
+    if where:
+        sql = sql + " WHERE " + " AND ".join(where)
+    return(sql + " ORDER BY device_id, location_at", params)
+
+def iter_ping_batches(device_ids=None, t_start=None, t_end=None, columns=default_columns,
+                      batch_size=100000, arrow=False, conn=None):
+    # yields dicts of column arrays (or pyarrow RecordBatches with arrow=True)
+    # of at most batch_size rows, ordered by device_id then location_at.
+    # device_ids are advertiser_ids, None reads every device; the window is
+    # [t_start, t_end) in epoch seconds. A device may span several batches,
+    # see iter_trajectories for one batch per device.
+    if arrow and pa is None:
+        raise ImportError("pyarrow is required for arrow=True")
+    columns = [c for c in columns if c != 'device_id']
+    own_conn = conn is None
+    if own_conn:
+        conn = engine.raw_connection()
+    try:
+        keys = None
+        if device_ids is not None:
+            device_ids = list(device_ids)
+            if integer_device_keys:
+                cur = conn.cursor()
+                keys = device_keys(cur, device_ids)
+                cur.close()
+                device_ids = list(keys.values())
+        sql, params = trajectory_query(columns, device_ids, t_start, t_end)
+
+        table = Pings.__table__
+        dtypes = [column_dtype(table.c[c]) for c in columns]
+        ids = None
+        if integer_device_keys:
+            ids = {v: k for k, v in keys.items()} if keys is not None else None
+
+        cur = conn.cursor(name=f"trajectory_{next(_cursor_count)}")
+        cur.itersize = batch_size
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            values = list(zip(*rows))
+            device = np.array(values[0], dtype=object)
+            if integer_device_keys:
+                device = _device_names(conn, device, ids)
+            batch = {'device_id': device}
+            for name, dtype, v in zip(columns, dtypes, values[1:]):
+                batch[name] = to_array(v, dtype)
+            if arrow:
+                batch = pa.RecordBatch.from_pydict(batch)
+            yield batch
+        cur.close()
+    finally:
+        if own_conn:
+            conn.rollback()
+            conn.close()
+
+def _device_names(conn, keys, ids):
+    # maps a batch of device keys back to advertiser_ids; when reading every
+    # device the names are fetched per batch
+    codes, uniques = pd.factorize(keys)
+    if ids is None or any(u not in ids for u in uniques):
+        cur = conn.cursor()
+        cur.execute("SELECT key, id FROM device WHERE key = ANY(%s)", ([int(u) for u in uniques],))
+        found = dict(cur.fetchall())
+        cur.close()
+        if ids is None:
+            ids = found
+        else:
+            ids.update(found)
+    names = np.array([ids.get(u) for u in uniques], dtype=object)
+    return(names[codes])
+
+def iter_trajectories(device_ids=None, t_start=None, t_end=None, columns=default_columns,
+                      batch_size=100000, conn=None):
+    # yields (advertiser_id, {column: array}) with one device's pings in time
+    # order. Rows of a device that straddle a fetch are stitched together, so
+    # memory is bounded by batch_size plus the longest single trajectory.
+    carry = None
+    for batch in iter_ping_batches(device_ids, t_start, t_end, columns, batch_size, False, conn):
+        device = batch['device_id']
+        # start of each run of equal device ids
+        starts = np.flatnonzero(np.r_[True, device[1:] != device[:-1]])
+        ends = np.r_[starts[1:], len(device)]
+        for s, e in zip(starts, ends):
+            part = {k: v[s:e] for k, v in batch.items() if k != 'device_id'}
+            if carry is not None:
+                if carry[0] == device[s]:
+                    part = {k: np.concatenate([carry[1][k], part[k]]) for k in part}
+                else:
+                    yield carry
+                carry = None
+            if e < len(device):
+                yield (device[s], part)
+            else:
+                carry = (device[s], part)
+    if carry is not None:
+        yield carry
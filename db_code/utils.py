@@ -5,8 +5,9 @@ import configparser
 import pandas as pd
 import numpy as np
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, ForeignKey, Integer, String, Float, Table, DateTime
+from sqlalchemy import Column, ForeignKey, Index, SmallInteger, Integer, BigInteger, String, Float, Table, DateTime, Sequence
 from sqlalchemy.orm import relationship
+from config import integer_device_keys, encode_ping_strings
 Base = declarative_base()
 
 
@@ -45,6 +46,7 @@ class Venue(Base):
     name = Column(String, nullable=False)
     venue_category = relationship('Venue_category', secondary = venue_venue_category,back_populates='venue')
     pings = relationship('Pings', back_populates = 'venue')
+    stays = relationship('Stay', back_populates = 'venue')
 
 class Venue_category(Base):
     __tablename__ = 'venue_category'
@@ -64,9 +66,13 @@ class Device_model(Base):
     model_name = Column(String, nullable=True)
     device = relationship('Device', back_populates='model')
 
+device_key_seq = Sequence('device_key_seq')
+
 class Device(Base):
     __tablename__ = 'device'
     id = Column(String, primary_key=True)
+    # compact surrogate key, referenced by pings when integer_device_keys is set
+    key = Column(Integer, device_key_seq, server_default=device_key_seq.next_value(), unique=True, nullable=False)
 
     model_id = Column(Integer, ForeignKey('device_model.id'),nullable=True)
     model = relationship('Device_model', back_populates='device', uselist = True)
@@ -76,12 +82,39 @@ class Device(Base):
 
     platform = Column(String, nullable=False)
     pings = relationship('Pings', back_populates='device')
-
+    stays = relationship('Stay', back_populates='device')
+
+# low-cardinality ping columns and their code type, dictionary encoded into
+# ping_<column> tables when encode_ping_strings is set
+encoded_ping_columns = {
+    'heading': Integer,
+    'final_country': SmallInteger,
+    'user_agent': Integer,
+    'background': SmallInteger,
+    'publisher_id': Integer,
+    'wifi_bssid': Integer
+}
+
+ping_dictionaries = {}
+if encode_ping_strings:
+    for name, code_type in encoded_ping_columns.items():
+        ping_dictionaries[name] = Table('ping_' + name, Base.metadata,
+                                        Column('id', code_type, primary_key=True),
+                                        Column('value', String, nullable=False, unique=True)
+                                  )
+
+def ping_string_column(name):
+    if name in ping_dictionaries:
+        return(Column(encoded_ping_columns[name], ForeignKey(f'ping_{name}.id'), nullable=True))
+    return(Column(String, nullable=True))
 
 class Pings(Base):
     __tablename__ = 'pings'
     id = Column(Integer, primary_key=True)
-    device_id = Column(String, ForeignKey('device.id'), nullable=False)
+    if integer_device_keys:
+        device_id = Column(Integer, ForeignKey('device.key'), nullable=False)
+    else:
+        device_id = Column(String, ForeignKey('device.id'), nullable=False)
     location_at = Column(Integer, nullable=False)
     timestamp = Column(DateTime(timezone=True),nullable=False)
     latitude = Column(Float, nullable=False)
@@ -89,32 +122,70 @@ class Pings(Base):
     altitude = Column(Float, nullable=True)
     horizontal_accuracy = Column(Float, nullable=True)
     vertical_accuracy = Column(Float, nullable=True)
-    heading = Column(String, nullable=True)
+    heading = ping_string_column('heading')
     speed = Column(Float, nullable=True)
     ipv_4 = Column(String, nullable=True)
     ipv_6 = Column(String, nullable=True)
-    final_country = Column(String, nullable=True)
-    user_agent = Column(String, nullable=True)
-    background = Column(String, nullable=True)
-    publisher_id = Column(String, nullable=True)
+    final_country = ping_string_column('final_country')
+    user_agent = ping_string_column('user_agent')
+    background = ping_string_column('background')
+    publisher_id = ping_string_column('publisher_id')
     wifi_ssid = Column(String, nullable=True)
-    wifi_bssid = Column(String, nullable=True)
+    wifi_bssid = ping_string_column('wifi_bssid')
 
     venue_id = Column(Integer, ForeignKey('venue.id'), nullable=True)
     dwell_time = Column(Float,nullable=True)
     source = Column(Integer,nullable=False)
+    # IANA zone of the ping location
+    tz_name = Column(String, nullable=True)
+    # Z-order cell of latitude/longitude, see spatial.py
+    cell = Column(BigInteger, nullable=True, index=True)
 
-    device = relationship("Device", back_populates = 'pings')
+    device = relationship("Device", back_populates = 'pings', foreign_keys = [device_id])
     venue = relationship(Venue, back_populates = 'pings')
 
+    # trajectory reads: one device's pings in time order
+    __table_args__ = (Index('ix_pings_device_location', 'device_id', 'location_at'),)
+
+# stay points derived from pings, see stays.py
+class Stay(Base):
+    __tablename__ = 'stays'
+    id = Column(Integer, primary_key=True)
+    device_id = Column(String, ForeignKey('device.id'), nullable=False)
+    start_at = Column(Integer, nullable=False)
+    end_at = Column(Integer, nullable=False)
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    n_pings = Column(Integer, nullable=False)
+    # most frequent venue reported by the feed during the stay
+    venue_id = Column(Integer, ForeignKey('venue.id'), nullable=True)
+    cell = Column(BigInteger, nullable=True, index=True)
+
+    device = relationship(Device, back_populates = 'stays')
+    venue = relationship(Venue, back_populates = 'stays')
+
+    __table_args__ = (Index('ix_stays_device_start', 'device_id', 'start_at'),)
+
+# next free pings.id, shared by parallel loaders
+rid_allocator = Table('rid_allocator', Base.metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('next_rid', BigInteger, nullable=False)
+                )
+
+file_list_dtypes = {'index':'int','path':'str','status':'int','nrow':'int','rows':'int'}
+
 class FileManager():
     def __init__(self,wd):
         #check if files_to_process.csv exists
         self.wd = wd
         self.files_to_process_path = self.wd + 'files_to_process.csv'
         #self.files_to_process = pd.DataFrame(columns=['index','path','status'], dtype={'index':'int','path':'str','status':'int'})
+        # nrow is the rid end of a processed file, rows the data row count
+        # found by init_file_list (0 if unknown)
         if os.path.exists(self.files_to_process_path):
-            self.files_to_process = pd.read_csv(self.files_to_process_path, usecols=['index','path','status','nrow'],dtype={'index':'int','path':'str','status':'int','nrow':'int'})
+            self.files_to_process = pd.read_csv(self.files_to_process_path, usecols=lambda c: c in file_list_dtypes, dtype=file_list_dtypes)
+            if 'rows' not in self.files_to_process:
+                self.files_to_process['rows'] = 0
         else:
             logging.ERROR("files_to_process.csv not found: required")
 
@@ -126,6 +197,12 @@ class FileManager():
         if os.path.exists(self.file_errors_path):
             self.file_errors = pd.read_csv(self.file_errors_path)
 
+    def add_file_error(self, index, path):
+        self.file_errors = pd.concat([
+            self.file_errors,
+            pd.DataFrame({'index':[index], 'path':[path], 'status':[0]})
+        ], ignore_index=True)
+
     def update_file_list(self):
         #write updated files_to_process_path
         self.files_to_process.to_csv(self.files_to_process_path,sep=",",header=True,index=False)
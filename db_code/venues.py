@@ -0,0 +1,74 @@
+import logging
+import zlib
+import numpy as np
+import pandas as pd
+from utils import Venue
+
+# advisory lock key taken while registering venues, so concurrent loaders
+# never insert the same name twice
+VENUE_LOCK = zlib.crc32(b'venue')
+
+
+# venue name -> id lookup shared across files. Names are resolved once per
+# distinct value in a chunk rather than once per row.
+class VenueCache():
+    def __init__(self, venue_tab=None):
+        self.venue_tab = venue_tab
+        self.pending = set()
+        self.missing = set()
+
+    def load(self, session):
+        self.venue_tab = {}
+        for v_id, name in session.query(Venue.id, Venue.name).order_by(Venue.id):
+            self.venue_tab[name] = v_id
+        return(self)
+
+    def __len__(self):
+        return(len(self.venue_tab))
+
+    def __contains__(self, name):
+        return(name in self.venue_tab)
+
+    def map(self, names, cur=None):
+        # returns an object Series of venue ids, None where the name is empty;
+        # unknown names are registered through cur when one is given
+        codes, uniques = pd.factorize(names)
+        unknown = [u for u in uniques if u not in self.venue_tab]
+        if unknown:
+            if cur is not None:
+                self.register(cur, unknown)
+            else:
+                for u in unknown:
+                    if u not in self.missing:
+                        logging.error("Venue " + u + " not found in database")
+                        self.missing.add(u)
+
+        ids = np.empty(len(uniques) + 1, dtype=object)
+        for i, u in enumerate(uniques):
+            ids[i] = self.venue_tab.get(u)
+        ids[-1] = None
+        return(pd.Series(ids.take(codes), index=names.index, dtype=object))
+
+    def register(self, cur, names):
+        # inserts run in cur's transaction, which should be short: the lock is
+        # held until it ends. Call commit() or rollback() on the cache alongside
+        # the connection
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (VENUE_LOCK,))
+        cur.execute("SELECT id, name FROM venue WHERE name = ANY(%s)", (list(names),))
+        for v_id, name in cur.fetchall():
+            self.venue_tab[name] = v_id
+        new = [n for n in names if n not in self.venue_tab]
+        if new:
+            cur.execute("INSERT INTO venue (name) SELECT unnest(%s::text[]) RETURNING id, name", (new,))
+            for v_id, name in cur.fetchall():
+                self.venue_tab[name] = v_id
+                self.pending.add(name)
+            logging.info(f"\tregistered {len(new)} new venues")
+
+    def commit(self):
+        self.pending = set()
+
+    def rollback(self):
+        for name in self.pending:
+            del self.venue_tab[name]
+        self.pending = set()